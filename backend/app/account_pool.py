@@ -0,0 +1,181 @@
+# account_pool.py
+# Пул аккаунтов Telegram для ингеста. Лимиты Telegram (FloodWait) считаются по аккаунту,
+# поэтому каналы распределяются между несколькими авторизованными аккаунтами:
+# с учётом текущей нагрузки, недавних FloodWait и DC канала. Отозванная сессия
+# выводится из пула, а канал продолжает обработку на другом аккаунте.
+
+import asyncio
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from telethon import TelegramClient
+from telethon.errors import (
+    AuthKeyDuplicatedError,
+    AuthKeyUnregisteredError,
+    SessionExpiredError,
+    SessionRevokedError,
+    UserDeactivatedBanError,
+    UserDeactivatedError,
+)
+
+from app.entity_cache import known_channel_dc
+from app.supabase_manager import delete_user_telegram_credentials
+from app.telegram_governor import TelegramGovernor
+
+# Ошибки, после которых сессия аккаунта больше непригодна
+SESSION_ERRORS = (
+    AuthKeyUnregisteredError,
+    AuthKeyDuplicatedError,
+    SessionRevokedError,
+    SessionExpiredError,
+    UserDeactivatedError,
+    UserDeactivatedBanError,
+)
+
+
+@dataclass
+class AccountPoolSettings:
+    """Параметры пула (секция `account_pool` в config.yaml)."""
+    enabled: bool = True
+    max_accounts: int = 10
+    flood_window_seconds: float = 600.0
+    flood_penalty_per_minute: float = 1.0   # минута недавнего FloodWait «весит» как один занятый канал
+    dc_bonus: float = 0.5                   # предпочтение аккаунту с тем же домашним DC, что и у канала
+
+    @classmethod
+    def from_config(cls, cfg: Optional[Dict[str, Any]]) -> "AccountPoolSettings":
+        cfg = cfg or {}
+        defaults = cls()
+        return cls(
+            enabled=bool(cfg.get("enabled", defaults.enabled)),
+            max_accounts=max(1, int(cfg.get("max_accounts", defaults.max_accounts))),
+            flood_window_seconds=float(cfg.get("flood_window_seconds", defaults.flood_window_seconds)),
+            flood_penalty_per_minute=float(cfg.get("flood_penalty_per_minute", defaults.flood_penalty_per_minute)),
+            dc_bonus=float(cfg.get("dc_bonus", defaults.dc_bonus)),
+        )
+
+
+@dataclass
+class IngestAccount:
+    """Аккаунт пула: подключённый клиент, его регулятор и текущая нагрузка."""
+    name: str
+    credentials: Dict[str, Any]
+    client: TelegramClient
+    governor: TelegramGovernor
+    dc_id: Optional[int] = None
+    active: int = 0
+    assigned: int = 0
+    revoked: bool = False
+
+
+@dataclass
+class ChannelProgress:
+    """
+    Прогресс канала, переживающий переезд на другой аккаунт:
+    посты из counted уже учтены в total, посты из done уже дошли до сохранения.
+    """
+    counted: set = field(default_factory=set)
+    done: set = field(default_factory=set)
+
+
+class AccountPool:
+    """
+    Выбирает аккаунт для канала: минимальная оценка
+    active + (недавний FloodWait и текущая блокировка в минутах) * penalty − бонус за совпадение DC.
+    При ошибке сессии аккаунт исключается (и деактивируется в БД), канал повторяется
+    на следующем аккаунте с учётом уже сохранённых постов.
+    """
+
+    def __init__(self, accounts: List[IngestAccount], settings: AccountPoolSettings, manager=None):
+        self.accounts = accounts
+        self.settings = settings
+        self.manager = manager
+
+    @classmethod
+    async def connect(cls, manager, credentials_list: List[Dict[str, Any]],
+                      governor_factory: Callable[[TelegramClient], TelegramGovernor],
+                      settings: AccountPoolSettings) -> "AccountPool":
+        """
+        Подключает аккаунты через менеджер клиентов; неавторизованные пропускаются.
+        Клиенты закрепляются в пуле на весь запуск (снимается release) — иначе долгий
+        ингест без новых get() закрылся бы по idle_ttl посреди работы.
+        """
+        accounts: List[IngestAccount] = []
+        for credentials in credentials_list[:settings.max_accounts]:
+            name = credentials.get("user_identifier") or str(credentials.get("telegram_api_id"))
+            try:
+                client = await manager.get(credentials)
+            except Exception as e:
+                print(f"Account pool: skipping account '{name}': {e}")
+                continue
+            manager.pin(client)
+            accounts.append(IngestAccount(
+                name=name,
+                credentials=credentials,
+                client=client,
+                governor=governor_factory(client),
+                dc_id=getattr(client.session, "dc_id", None),
+            ))
+        if not accounts:
+            raise RuntimeError("No authorized Telegram accounts available for ingest.")
+        print(f"Account pool: {len(accounts)} account(s): "
+              + ", ".join(f"{a.name} (DC {a.dc_id})" for a in accounts))
+        return cls(accounts, settings, manager)
+
+    @property
+    def healthy(self) -> List[IngestAccount]:
+        return [a for a in self.accounts if not a.revoked]
+
+    def score(self, account: IngestAccount, channel_dc: Optional[int]) -> float:
+        flood_minutes = (account.governor.recent_flood_seconds(self.settings.flood_window_seconds)
+                         + account.governor.blocked_seconds()) / 60.0
+        score = account.active + flood_minutes * self.settings.flood_penalty_per_minute
+        if channel_dc and account.dc_id == channel_dc:
+            score -= self.settings.dc_bonus
+        return score
+
+    async def pick(self, ch: str, exclude: set) -> Optional[IngestAccount]:
+        candidates = [a for a in self.healthy if a.name not in exclude]
+        if not candidates:
+            return None
+        channel_dc = await known_channel_dc(ch) if len(candidates) > 1 else None
+        # При равной оценке — аккаунт, которому досталось меньше каналов за запуск
+        return min(candidates, key=lambda a: (self.score(a, channel_dc), a.assigned))
+
+    async def mark_revoked(self, account: IngestAccount, error: BaseException) -> None:
+        if account.revoked:
+            return
+        account.revoked = True
+        print(f"Account pool: session of '{account.name}' is no longer valid ({type(error).__name__}); "
+              f"removing it from the pool.")
+        await asyncio.to_thread(delete_user_telegram_credentials, account.name)
+        if self.manager is not None:
+            await self.manager.discard(account.client)
+
+    def release(self) -> None:
+        """Снимает закрепление клиентов в менеджере (конец запуска)."""
+        if self.manager is None:
+            return
+        for account in self.accounts:
+            self.manager.unpin(account.client)
+
+    async def run_channel(self, ch: str,
+                          worker: Callable[[IngestAccount, ChannelProgress], Awaitable[Any]]) -> Any:
+        """Обрабатывает канал на выбранном аккаунте, переключаясь на другой при отзыве сессии."""
+        progress = ChannelProgress()
+        tried: set = set()
+        while True:
+            account = await self.pick(ch, tried)
+            if account is None:
+                raise RuntimeError(f"No Telegram account left to process {ch}.")
+            tried.add(account.name)
+            account.active += 1
+            account.assigned += 1
+            try:
+                return await worker(account, progress)
+            except SESSION_ERRORS as e:
+                await self.mark_revoked(account, e)
+                print(f"Account pool: moving {ch} to another account "
+                      f"({len(progress.done)} post(s) already processed).")
+            finally:
+                account.active -= 1
@@ -0,0 +1,251 @@
+# chunked_download.py
+# Параллельная загрузка больших документов Telegram: файл делится на сегменты,
+# несколько iter_download (GetFile) качают их одновременно с разных смещений
+# и пишут на место в заранее выделенный файл. Готовые сегменты записываются
+# в sidecar-файл, поэтому после таймаута/падения загрузка продолжается с того же места.
+# iter_document отдаёт документ потоком с любого выровненного смещения — для выгрузки
+# в Storage без временного файла.
+
+import asyncio
+import json
+import os
+import pathlib
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, Optional
+
+from telethon import utils
+from telethon.errors import FloodWaitError
+
+# Размер одного запроса GetFile: Telegram принимает не больше 512 КБ, кратно 4 КБ
+MAX_PART_SIZE = 512 * 1024
+MIN_PART_SIZE = 4 * 1024
+
+
+def part_size(kb: float) -> int:
+    """
+    Размер запроса GetFile из килобайт конфига: степень двойки от 4 до 512 КБ (округление вниз).
+    Иначе 1 МБ не делится на размер блока и Telegram отвергает запрос (LIMIT_INVALID).
+    """
+    size = MIN_PART_SIZE
+    while size * 2 <= min(MAX_PART_SIZE, int(kb * 1024)):
+        size *= 2
+    return size
+
+
+@dataclass
+class DownloadSettings:
+    """Параметры загрузки медиа (секция `download` в config.yaml)."""
+    max_file_bytes: int = 2000 * 1024 * 1024      # политика: больше — заглушка oversized
+    parallel_threshold_bytes: int = 20 * 1024 * 1024
+    connections: int = 4
+    segment_bytes: int = 8 * 1024 * 1024
+    part_bytes: int = MAX_PART_SIZE
+    segment_timeout: float = 120.0
+    max_attempts: int = 3
+
+    @classmethod
+    def from_config(cls, cfg: Optional[Dict[str, Any]]) -> "DownloadSettings":
+        cfg = cfg or {}
+        defaults = cls()
+        mb = 1024 * 1024
+        part = part_size(float(cfg.get("part_kb", defaults.part_bytes // 1024)))
+        segment = int(float(cfg.get("segment_mb", defaults.segment_bytes / mb)) * mb)
+        # Сегмент кратен размеру запроса — смещения всех запросов выровнены
+        segment = max(part, segment - segment % part)
+        return cls(
+            max_file_bytes=int(float(cfg.get("max_file_mb", defaults.max_file_bytes / mb)) * mb),
+            parallel_threshold_bytes=int(float(cfg.get("parallel_threshold_mb", defaults.parallel_threshold_bytes / mb)) * mb),
+            connections=max(1, int(cfg.get("connections", defaults.connections))),
+            segment_bytes=segment,
+            part_bytes=part,
+            segment_timeout=float(cfg.get("segment_timeout", defaults.segment_timeout)),
+            max_attempts=max(1, int(cfg.get("max_attempts", defaults.max_attempts))),
+        )
+
+
+def _document_of(message):
+    media = getattr(message, "media", None)
+    return getattr(media, "document", None) if media is not None else None
+
+
+def supports_chunked(message, settings: DownloadSettings) -> bool:
+    """Параллельная загрузка имеет смысл для документов (видео/файлы) выше порога."""
+    doc = _document_of(message)
+    return doc is not None and int(getattr(doc, "size", 0) or 0) >= settings.parallel_threshold_bytes
+
+
+class _ResumeState:
+    """Sidecar `<файл>.part.json`: какой документ качается и какие сегменты уже на диске."""
+
+    def __init__(self, path: pathlib.Path, doc_id: int, size: int, segment_bytes: int):
+        self.path = path
+        self.doc_id = doc_id
+        self.size = size
+        self.segment_bytes = segment_bytes
+        self.done: set = set()
+
+    def load(self) -> bool:
+        try:
+            data = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return False
+        if (data.get("doc_id"), data.get("size"), data.get("segment_bytes")) != (self.doc_id, self.size, self.segment_bytes):
+            return False
+        self.done = set(int(i) for i in data.get("done", []))
+        return True
+
+    def save(self) -> None:
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({
+            "doc_id": self.doc_id,
+            "size": self.size,
+            "segment_bytes": self.segment_bytes,
+            "done": sorted(self.done),
+        }))
+        os.replace(tmp, self.path)
+
+
+async def download_document(client, message, target: str, settings: DownloadSettings, governor) -> str:
+    """
+    Скачивает документ сообщения сегментами параллельно в `target` + расширение.
+    Возвращает путь к готовому файлу. При ошибке частичный файл и sidecar остаются
+    на диске, и следующий вызов с тем же target продолжит загрузку.
+    """
+    doc = _document_of(message)
+    if doc is None:
+        raise ValueError(f"Message {message.id} has no document to download")
+    size = int(doc.size)
+    final_path = pathlib.Path(target + (utils.get_extension(message.media) or ""))
+    part_path = final_path.with_name(final_path.name + ".part")
+    state = _ResumeState(final_path.with_name(final_path.name + ".part.json"), int(doc.id), size, settings.segment_bytes)
+
+    resumed = part_path.exists() and state.load()
+    if not resumed:
+        # Резервируем место сразу: сегменты пишутся по своим смещениям в любом порядке
+        with open(part_path, "wb") as f:
+            f.truncate(size)
+        state.done = set()
+        state.save()
+
+    segments = (size + settings.segment_bytes - 1) // settings.segment_bytes
+    pending = [i for i in range(segments) if i not in state.done]
+    if resumed:
+        print(f"Resuming download of message {message.id}: {len(state.done)}/{segments} segments already on disk")
+
+    started = time.monotonic()
+    fd = os.open(part_path, os.O_WRONLY)
+    queue: asyncio.Queue = asyncio.Queue()
+    for i in pending:
+        queue.put_nowait(i)
+
+    async def fetch_segment(index: int) -> None:
+        offset = index * settings.segment_bytes
+        length = min(settings.segment_bytes, size - offset)
+        parts = (length + settings.part_bytes - 1) // settings.part_bytes
+        position = offset
+        async for chunk in client.iter_download(doc, offset=offset, limit=parts,
+                                                request_size=settings.part_bytes, file_size=size):
+            chunk = chunk[:offset + length - position]
+            os.pwrite(fd, chunk, position)
+            position += len(chunk)
+        if position != offset + length:
+            raise IOError(f"Segment {index} of message {message.id} is incomplete ({position - offset}/{length} bytes)")
+
+    async def worker() -> None:
+        while True:
+            try:
+                index = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            for attempt in range(1, settings.max_attempts + 1):
+                try:
+                    await governor.call("download", lambda: asyncio.wait_for(fetch_segment(index), settings.segment_timeout))
+                    break
+                except asyncio.TimeoutError:
+                    if attempt == settings.max_attempts:
+                        raise
+                    print(f"Segment {index} of message {message.id} timed out, retrying ({attempt}/{settings.max_attempts})")
+            state.done.add(index)
+            state.save()
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(settings.connections, max(1, len(pending))))]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        for t in workers:
+            t.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        raise
+    finally:
+        os.close(fd)
+
+    os.replace(part_path, final_path)
+    state.path.unlink(missing_ok=True)
+    elapsed = max(time.monotonic() - started, 1e-6)
+    fetched = sum(min(settings.segment_bytes, size - i * settings.segment_bytes) for i in pending)
+    print(f"Downloaded {size / 1024 / 1024:.1f} MB for message {message.id} in {elapsed:.1f}s "
+          f"({fetched / 1024 / 1024 / elapsed:.1f} MB/s, {settings.connections} streams)")
+    return str(final_path)
+
+
+async def download_document_sequential(client, message, target: str, settings: DownloadSettings, governor) -> str:
+    """
+    Небольшой документ одним потоком в `target` + расширение через iter_document: токен 'download'
+    берётся на каждые segment_bytes, и FloodWait не начинает загрузку с нулевого байта.
+    """
+    final_path = pathlib.Path(target + (utils.get_extension(message.media) or ""))
+    part_path = final_path.with_name(final_path.name + ".part")
+    with open(part_path, "wb") as f:
+        async for chunk in iter_document(client, message, 0, settings, governor):
+            f.write(chunk)
+    os.replace(part_path, final_path)
+    return str(final_path)
+
+
+async def iter_document(client, message, offset: int, settings: DownloadSettings, governor) -> AsyncIterator[bytes]:
+    """
+    Байты документа сообщения подряд, начиная с offset, без записи на диск.
+    Токен класса 'download' берётся на каждые segment_bytes; после FloodWait поток продолжается
+    с последнего выданного байта. Запрос, не ответивший за segment_timeout, — asyncio.TimeoutError.
+    """
+    doc = _document_of(message)
+    if doc is None:
+        raise ValueError(f"Message {message.id} has no document to download")
+    size = int(doc.size)
+    # GetFile читает с выровненных смещений — лишнее начало первого блока отбрасываем
+    position = offset - offset % settings.part_bytes
+    skip = offset - position
+    attempt = 0
+    while position < size:
+        await governor.acquire("download")
+        parts = (size - position + settings.part_bytes - 1) // settings.part_bytes
+        stream = client.iter_download(doc, offset=position, limit=parts,
+                                      request_size=settings.part_bytes, file_size=size)
+        taken = position
+        try:
+            while position < size:
+                try:
+                    chunk = await asyncio.wait_for(stream.__anext__(), settings.segment_timeout)
+                except StopAsyncIteration:
+                    break
+                chunk = chunk[:size - position]
+                position += len(chunk)
+                if skip:
+                    chunk, skip = chunk[skip:], max(0, skip - len(chunk))
+                if chunk:
+                    yield chunk
+                if position - taken >= settings.segment_bytes:
+                    governor.on_success("download")
+                    await governor.acquire("download")
+                    taken = position
+            governor.on_success("download")
+            if position < size:
+                raise IOError(f"Document of message {message.id} ended at {position}/{size} bytes")
+        except FloodWaitError as e:
+            attempt += 1
+            if attempt > governor.max_retries:
+                raise
+            await governor.on_flood_wait("download", e)
+        finally:
+            await stream.close()
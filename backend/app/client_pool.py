@@ -0,0 +1,221 @@
+# client_pool.py
+# Долгоживущие TelegramClient в веб-процессе: один авторизованный и подключённый
+# клиент на набор credentials, проверка здоровья с переподключением и «прогретые»
+# соединения к DC, где лежат медиа. Жизненный цикл привязан к lifespan FastAPI.
+
+import asyncio
+import hashlib
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from telethon import TelegramClient, functions
+from telethon.sessions import StringSession
+
+from app.crypto_utils import decrypt_string
+
+
+@dataclass
+class PooledClient:
+    client: TelegramClient
+    key: str
+    api_id: int
+    me: Any = None
+    last_used: float = field(default_factory=time.monotonic)
+    warm_dcs: List[int] = field(default_factory=list)
+    holders: int = 0            # долгоживущие владельцы (наблюдение, заполнитель) — не закрывать по простою
+
+
+def credentials_fingerprint(credentials: Dict[str, Any]) -> str:
+    """Ключ клиента: api_id + хэш зашифрованной сессии (новая сессия — новый клиент)."""
+    raw = f"{credentials.get('telegram_api_id')}:{credentials.get('telegram_string_session')}"
+    return hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+
+class TelegramClientManager:
+    """
+    Пул клиентов Telegram по credentials.
+    get() возвращает уже подключённый клиент (миллисекунды) или подключает новый.
+    Клиенты не отключаются после запуска пайплайна — только при остановке сервера
+    или после idle_ttl без использования. Клиент, закреплённый через pin(), по простою
+    не закрывается: его держат фоновые задачи, которые не вызывают get().
+    """
+
+    def __init__(self):
+        self.running = False
+        self._clients: Dict[str, PooledClient] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._health_task: Optional[asyncio.Task] = None
+        self._cfg: Dict[str, Any] = {}
+        self._global_credentials: Optional[Dict[str, Any]] = None
+        self._global_credentials_at = 0.0
+
+    async def start(self, cfg: Optional[Dict[str, Any]] = None) -> None:
+        self._cfg = cfg or {}
+        self.running = True
+        self._health_task = asyncio.create_task(self._health_loop())
+
+    async def stop(self) -> None:
+        self.running = False
+        if self._health_task:
+            self._health_task.cancel()
+            await asyncio.gather(self._health_task, return_exceptions=True)
+            self._health_task = None
+        for pooled in list(self._clients.values()):
+            await self._disconnect(pooled)
+        self._clients.clear()
+
+    # --- credentials ---
+
+    def global_credentials(self) -> Optional[Dict[str, Any]]:
+        """Глобальные credentials с коротким кэшем, чтобы не ходить в Supabase на каждый запуск."""
+        from app.supabase_manager import get_global_telegram_credentials
+
+        ttl = float(self._cfg.get("credentials_ttl_seconds", 60))
+        if self._global_credentials and time.monotonic() - self._global_credentials_at < ttl:
+            return self._global_credentials
+        self._global_credentials = get_global_telegram_credentials()
+        self._global_credentials_at = time.monotonic()
+        return self._global_credentials
+
+    def invalidate_credentials(self) -> None:
+        """Сбрасывает кэш credentials (после сохранения/удаления в настройках)."""
+        self._global_credentials = None
+        self._global_credentials_at = 0.0
+
+    # --- клиенты ---
+
+    async def get(self, credentials: Dict[str, Any]) -> TelegramClient:
+        """Возвращает подключённый и авторизованный клиент для credentials."""
+        key = credentials_fingerprint(credentials)
+        pooled = self._clients.get(key)
+        if pooled and pooled.client.is_connected():
+            pooled.last_used = time.monotonic()
+            return pooled.client
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            pooled = self._clients.get(key)
+            if pooled and pooled.client.is_connected():
+                pooled.last_used = time.monotonic()
+                return pooled.client
+            if pooled:
+                await self._reconnect(pooled)
+                return pooled.client
+            pooled = await self._connect(key, credentials)
+            self._clients[key] = pooled
+            return pooled.client
+
+    async def get_global(self) -> TelegramClient:
+        credentials = self.global_credentials()
+        if not credentials:
+            raise RuntimeError(
+                "Global Telegram credentials not found. "
+                "Administrator must add credentials in settings."
+            )
+        return await self.get(credentials)
+
+    async def discard(self, client: TelegramClient) -> None:
+        """Убирает клиента из пула и отключает его (например, после отзыва сессии)."""
+        for key, pooled in list(self._clients.items()):
+            if pooled.client is client:
+                self._clients.pop(key, None)
+                await self._disconnect(pooled)
+
+    def pin(self, client: TelegramClient) -> None:
+        """Закрепляет клиента за долгоживущим владельцем (снимается unpin)."""
+        for pooled in self._clients.values():
+            if pooled.client is client:
+                pooled.holders += 1
+                pooled.last_used = time.monotonic()
+
+    def unpin(self, client: TelegramClient) -> None:
+        for pooled in self._clients.values():
+            if pooled.client is client:
+                pooled.holders = max(0, pooled.holders - 1)
+                pooled.last_used = time.monotonic()
+
+    def me(self, client: TelegramClient) -> Any:
+        for pooled in self._clients.values():
+            if pooled.client is client:
+                return pooled.me
+        return None
+
+    async def _connect(self, key: str, credentials: Dict[str, Any]) -> PooledClient:
+        api_id = int(credentials["telegram_api_id"])
+        session_string = decrypt_string(credentials["telegram_string_session"])
+        client = TelegramClient(StringSession(session_string), api_id, credentials["telegram_api_hash"])
+        await client.connect()
+        if not await client.is_user_authorized():
+            await client.disconnect()
+            raise RuntimeError(f"Telegram session for API ID {api_id} is not authorized")
+        me = await client.get_me()
+        print(f"Telegram client pool: connected as {getattr(me, 'username', None) or getattr(me, 'first_name', '')} (API ID: {api_id})")
+        pooled = PooledClient(client=client, key=key, api_id=api_id, me=me)
+        await self._prewarm(pooled)
+        return pooled
+
+    async def _reconnect(self, pooled: PooledClient) -> None:
+        print(f"Telegram client pool: reconnecting client {pooled.key[:8]}...")
+        await pooled.client.connect()
+        pooled.last_used = time.monotonic()
+        await self._prewarm(pooled)
+
+    async def _disconnect(self, pooled: PooledClient) -> None:
+        try:
+            if pooled.client.is_connected():
+                await pooled.client.disconnect()
+        except Exception as e:
+            print(f"Telegram client pool: disconnect error: {e}")
+
+    async def _prewarm(self, pooled: PooledClient) -> None:
+        """
+        Заранее экспортирует авторизацию и подключается к DC с медиа, чтобы первая
+        загрузка файла не платила за ExportAuthorization/ImportAuthorization.
+        Использует внутренний API Telethon, поэтому любые ошибки только логируются.
+        """
+        dc_ids = [int(dc) for dc in (self._cfg.get("prewarm_dcs") or [])]
+        home_dc = getattr(pooled.client.session, "dc_id", None)
+        borrow = getattr(pooled.client, "_borrow_exported_sender", None)
+        give_back = getattr(pooled.client, "_return_exported_sender", None)
+        if not borrow or not give_back:
+            return
+        warmed = []
+        for dc_id in dc_ids:
+            if dc_id == home_dc:
+                continue
+            try:
+                sender = await borrow(dc_id)
+                await give_back(sender)
+                warmed.append(dc_id)
+            except Exception as e:
+                print(f"Telegram client pool: failed to prewarm DC {dc_id}: {e}")
+        pooled.warm_dcs = warmed
+
+    async def _health_loop(self) -> None:
+        interval = float(self._cfg.get("health_check_seconds", 45))
+        idle_ttl = float(self._cfg.get("idle_ttl_seconds", 6 * 3600))
+        while True:
+            await asyncio.sleep(interval)
+            for key, pooled in list(self._clients.items()):
+                try:
+                    if not pooled.holders and time.monotonic() - pooled.last_used > idle_ttl:
+                        print(f"Telegram client pool: closing idle client {key[:8]}")
+                        self._clients.pop(key, None)
+                        await self._disconnect(pooled)
+                        continue
+                    if not pooled.client.is_connected():
+                        await self._reconnect(pooled)
+                        continue
+                    # Лёгкий запрос держит соединение живым и проверяет авторизацию
+                    await pooled.client(functions.updates.GetStateRequest())
+                    # Экспортированные соединения Telethon закрывает после минуты простоя
+                    await self._prewarm(pooled)
+                except Exception as e:
+                    print(f"Telegram client pool: health check failed for {key[:8]}: {e}")
+                    try:
+                        await self._reconnect(pooled)
+                    except Exception as e2:
+                        print(f"Telegram client pool: reconnect failed for {key[:8]}: {e2}")
+
+
+client_manager = TelegramClientManager()
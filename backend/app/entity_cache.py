@@ -0,0 +1,156 @@
+# entity_cache.py
+# Постоянный кэш разрешённых каналов (id, access_hash, title, username) по аккаунту.
+# Два уровня: память процесса и таблица telegram_entity_cache в Supabase.
+# Повторные запуски не вызывают ResolveUsername, пока запись не устарела (TTL).
+
+import asyncio
+import re
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, Tuple
+
+from telethon import types
+from telethon.errors import (
+    ChannelInvalidError,
+    ChannelPrivateError,
+    UsernameInvalidError,
+    UsernameNotOccupiedError,
+)
+
+from app.supabase_manager import (
+    delete_cached_channel_entity,
+    get_cached_channel_dc,
+    get_cached_channel_entity,
+    save_cached_channel_entity,
+)
+
+# Ошибки, после которых запись кэша больше нельзя использовать
+INVALIDATING_ERRORS = (ChannelPrivateError, ChannelInvalidError, UsernameInvalidError, UsernameNotOccupiedError)
+
+DEFAULT_TTL_SECONDS = 7 * 24 * 3600
+
+
+@dataclass
+class ResolvedChannel:
+    """Разрешённый канал: entity для запросов Telethon и его метаданные."""
+    entity: Any
+    title: str
+    username: Optional[str]
+    channel_id: Optional[int] = None
+    from_cache: bool = False
+    dc_id: Optional[int] = None
+
+
+# (account_id, channel_key) -> (ResolvedChannel, expires_at)
+_memory: Dict[Tuple[int, str], Tuple[ResolvedChannel, float]] = {}
+# channel_key -> DC канала (общий для всех аккаунтов)
+_channel_dc: Dict[str, int] = {}
+
+
+def channel_key(ch: str) -> str:
+    """Нормализует канал: t.me/<name>, @name и name дают один ключ."""
+    s = (ch or "").strip()
+    m = re.match(r"^(?:https?://)?t\.me/(?!c/|\+|joinchat/)([^/?#]+)", s, flags=re.IGNORECASE)
+    if m:
+        s = m.group(1)
+    return s.lstrip("@").lower()
+
+
+def _entity_dc(entity) -> Optional[int]:
+    photo = getattr(entity, "photo", None)
+    dc_id = getattr(photo, "dc_id", None)
+    return int(dc_id) if dc_id else None
+
+
+async def known_channel_dc(ch: str) -> Optional[int]:
+    """DC канала, если он уже известен по кэшу любого аккаунта; без запросов к Telegram."""
+    key = channel_key(ch)
+    if key not in _channel_dc:
+        dc_id = await asyncio.to_thread(get_cached_channel_dc, key)
+        if dc_id:
+            _channel_dc[key] = dc_id
+    return _channel_dc.get(key)
+
+
+async def _account_id(client) -> int:
+    # get_me(input_peer=True) кэшируется Telethon после авторизации — без сетевого запроса
+    me = await client.get_me(input_peer=True)
+    return int(getattr(me, "user_id", 0) or 0)
+
+
+def _parse_ts(value: Any) -> float:
+    if not value:
+        return 0.0
+    try:
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00")).astimezone(timezone.utc).timestamp()
+    except ValueError:
+        return 0.0
+
+
+async def resolve_channel(client, ch: str, *, governor, ttl_seconds: float = DEFAULT_TTL_SECONDS,
+                          force_refresh: bool = False) -> ResolvedChannel:
+    """
+    Возвращает канал из кэша или разрешает его через Telegram (класс 'resolve' регулятора).
+    Каналы кэшируются; пользователи/группы без access_hash канала — нет.
+    """
+    key = channel_key(ch)
+    account_id = await _account_id(client)
+    now = time.time()
+
+    if not force_refresh:
+        cached = _memory.get((account_id, key))
+        if cached and cached[1] > now:
+            return cached[0]
+        row = await asyncio.to_thread(get_cached_channel_entity, account_id, key)
+        if row and _parse_ts(row.get("resolved_at")) + ttl_seconds > now:
+            resolved = ResolvedChannel(
+                entity=types.InputPeerChannel(int(row["channel_id"]), int(row["access_hash"])),
+                title=row.get("title") or ch,
+                username=row.get("username") or key,
+                channel_id=int(row["channel_id"]),
+                from_cache=True,
+                dc_id=row.get("dc_id"),
+            )
+            if resolved.dc_id:
+                _channel_dc[key] = int(resolved.dc_id)
+            _memory[(account_id, key)] = (resolved, _parse_ts(row.get("resolved_at")) + ttl_seconds)
+            return resolved
+
+    try:
+        entity = await governor.call("resolve", lambda: client.get_entity(ch))
+    except INVALIDATING_ERRORS:
+        await invalidate_channel(client, ch)
+        raise
+    title = getattr(entity, "title", None) or ch
+    username = getattr(entity, "username", None) or ch.lstrip("@").replace("t.me/", "")
+    resolved = ResolvedChannel(entity=entity, title=title, username=username,
+                               channel_id=getattr(entity, "id", None), dc_id=_entity_dc(entity))
+    if resolved.dc_id:
+        _channel_dc[key] = resolved.dc_id
+    access_hash = getattr(entity, "access_hash", None)
+    if isinstance(entity, types.Channel) and access_hash is not None:
+        _memory[(account_id, key)] = (resolved, now + ttl_seconds)
+        await asyncio.to_thread(save_cached_channel_entity, account_id, key, entity.id, access_hash,
+                                title, getattr(entity, "username", None), resolved.dc_id)
+    return resolved
+
+
+async def invalidate_channel(client, ch: str) -> None:
+    """Удаляет канал из обоих уровней кэша."""
+    key = channel_key(ch)
+    account_id = await _account_id(client)
+    _memory.pop((account_id, key), None)
+    await asyncio.to_thread(delete_cached_channel_entity, account_id, key)
+
+
+@asynccontextmanager
+async def invalidate_on_error(client, ch: str):
+    """Сбрасывает кэш канала, если запросы к нему упали с ошибкой доступа/имени."""
+    try:
+        yield
+    except INVALIDATING_ERRORS as e:
+        print(f"Channel {ch} is no longer accessible ({type(e).__name__}); dropping cached entity.")
+        await invalidate_channel(client, ch)
+        raise
@@ -0,0 +1,241 @@
+# ffmpeg_runner.py
+# Асинхронный запуск ffmpeg: процессы через asyncio.create_subprocess_exec, поэтому
+# долгое видео не блокирует цикл событий. Число одновременных кодирований ограничено
+# (по ядрам), остальные ждут в очереди. Прогресс читается из `-progress pipe:1`.
+# Отмена задачи (например, /stop-pipeline) убивает ffmpeg и удаляет недописанный файл.
+
+import asyncio
+import os
+import pathlib
+import time
+from collections import deque
+from dataclasses import asdict, dataclass, field
+from typing import Any, Deque, Dict, List, Optional
+
+
+@dataclass(frozen=True)
+class EncodeProfile:
+    """Профиль кодирования видео при наложении логотипа."""
+    codec: str = "libx264"
+    preset: str = "veryfast"
+    crf: int = 23
+
+    @classmethod
+    def from_config(cls, cfg: Optional[Dict[str, Any]]) -> "EncodeProfile":
+        cfg = cfg or {}
+        defaults = cls()
+        return cls(
+            codec=str(cfg.get("codec", defaults.codec)),
+            preset=str(cfg.get("preset", defaults.preset)),
+            crf=int(cfg.get("crf", defaults.crf)),
+        )
+
+    def args(self) -> List[str]:
+        return ["-c:v", self.codec, "-preset", self.preset, "-crf", str(self.crf), "-pix_fmt", "yuv420p"]
+
+
+# Профили по умолчанию, если в config.yaml секция profiles не задана
+DEFAULT_PROFILES = {
+    "speed": EncodeProfile(preset="veryfast", crf=23),
+    "balanced": EncodeProfile(preset="medium", crf=21),
+    "archival": EncodeProfile(preset="slow", crf=18),
+}
+
+# moov-атом в начале файла: плеер начинает воспроизведение из Storage, не дожидаясь конца файла
+FASTSTART = ["-movflags", "+faststart"]
+
+
+@dataclass
+class FfmpegSettings:
+    """Параметры запуска ffmpeg (секция `ffmpeg` в config.yaml)."""
+    max_jobs: int = 0               # 0 — половина ядер (x264 сам многопоточный)
+    timeout_seconds: float = 600.0
+    history: int = 50               # сколько завершённых задач хранить для статистики
+    brand_videos: bool = True       # False — без логотипа, только перепаковка с faststart
+    default_profile: str = "speed"
+    long_video_profile: str = "speed"   # для длинных/крупных роликов (пороги ниже; 0 — порог выключен)
+    long_video_seconds: float = 300.0
+    long_video_bytes: int = 200 * 1024 * 1024
+    profiles: Dict[str, EncodeProfile] = field(default_factory=lambda: dict(DEFAULT_PROFILES))
+
+    @classmethod
+    def from_config(cls, cfg: Optional[Dict[str, Any]]) -> "FfmpegSettings":
+        cfg = cfg or {}
+        defaults = cls()
+        profiles = dict(DEFAULT_PROFILES)
+        for name, profile_cfg in (cfg.get("profiles") or {}).items():
+            profiles[str(name)] = EncodeProfile.from_config(profile_cfg)
+        default_profile = str(cfg.get("default_profile", defaults.default_profile))
+        long_video_profile = str(cfg.get("long_video_profile", defaults.long_video_profile))
+        return cls(
+            max_jobs=max(0, int(cfg.get("max_jobs", defaults.max_jobs))),
+            timeout_seconds=float(cfg.get("timeout_seconds", defaults.timeout_seconds)),
+            history=max(1, int(cfg.get("history", defaults.history))),
+            brand_videos=bool(cfg.get("brand_videos", defaults.brand_videos)),
+            default_profile=default_profile if default_profile in profiles else defaults.default_profile,
+            long_video_profile=long_video_profile if long_video_profile in profiles else defaults.long_video_profile,
+            long_video_seconds=float(cfg.get("long_video_seconds", defaults.long_video_seconds)),
+            long_video_bytes=int(float(cfg.get("long_video_mb", defaults.long_video_bytes / 1024 / 1024)) * 1024 * 1024),
+            profiles=profiles,
+        )
+
+    @property
+    def jobs(self) -> int:
+        return self.max_jobs or max(1, (os.cpu_count() or 2) // 2)
+
+    def profile(self, name: Optional[str] = None) -> EncodeProfile:
+        """Профиль по имени; неизвестное имя — профиль по умолчанию."""
+        return self.profiles.get(name or self.default_profile) or self.profiles[self.default_profile]
+
+    def profile_for(self, duration: Optional[float], size: Optional[int]) -> str:
+        """Профиль задачи: длинные или крупные ролики — long_video_profile, остальные — default_profile."""
+        if self.long_video_seconds and duration and duration >= self.long_video_seconds:
+            return self.long_video_profile
+        if self.long_video_bytes and size and size >= self.long_video_bytes:
+            return self.long_video_profile
+        return self.default_profile
+
+
+def remux_args(src: str, out: str) -> List[str]:
+    """Перепаковка без перекодирования (потоки копируются) с faststart."""
+    return ["-i", src, "-c", "copy"] + FASTSTART + [out]
+
+
+def poster_args(src: str, out: str, at_seconds: float, max_side: int) -> List[str]:
+    """Один кадр видео (постер) с уменьшением до max_side по большей стороне; -ss до -i — быстрый seek."""
+    scale = (f"scale='if(gt(iw,ih),min({max_side},iw),-2)':'if(gt(iw,ih),-2,min({max_side},ih))'")
+    return ["-ss", f"{max(0.0, at_seconds):.2f}", "-i", src, "-frames:v", "1", "-vf", scale, "-q:v", "4", out]
+
+
+class FfmpegError(RuntimeError):
+    """ffmpeg завершился с ненулевым кодом."""
+
+
+@dataclass
+class FfmpegJob:
+    """Задача ffmpeg: состояние, прогресс и время в очереди/работе."""
+    name: str
+    output: str
+    duration: Optional[float] = None    # длительность входа, если известна — для процента
+    status: str = "queued"              # queued / running / done / failed / timeout / cancelled
+    queued_at: float = 0.0
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    out_time: float = 0.0               # обработано секунд видео
+    speed: Optional[float] = None       # скорость относительно реального времени (1.0 = realtime)
+
+    @property
+    def wait_seconds(self) -> float:
+        return (self.started_at or time.time()) - self.queued_at
+
+    @property
+    def run_seconds(self) -> float:
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+    @property
+    def percent(self) -> Optional[float]:
+        if not self.duration:
+            return None
+        return min(100.0, 100.0 * self.out_time / self.duration)
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = asdict(self)
+        data.update(wait_seconds=round(self.wait_seconds, 2), run_seconds=round(self.run_seconds, 2),
+                    percent=self.percent)
+        return data
+
+
+class FfmpegRunner:
+    """Очередь задач ffmpeg с ограничением параллельности."""
+
+    def __init__(self, settings: FfmpegSettings):
+        self.settings = settings
+        self._sem = asyncio.Semaphore(settings.jobs)
+        self._active: Dict[int, FfmpegJob] = {}
+        self._history: Deque[FfmpegJob] = deque(maxlen=settings.history)
+
+    async def run(self, args: List[str], output: str, *, name: str = "",
+                  duration: Optional[float] = None, timeout: Optional[float] = None) -> FfmpegJob:
+        """
+        Запускает `ffmpeg -y <args>` (output — последний аргумент, он же удаляется при сбое).
+        Бросает FfmpegError, asyncio.TimeoutError или CancelledError; недописанный output удаляется.
+        """
+        job = FfmpegJob(name=name or pathlib.Path(output).name, output=output, duration=duration,
+                        queued_at=time.time())
+        self._active[id(job)] = job
+        try:
+            async with self._sem:
+                job.status = "running"
+                job.started_at = time.time()
+                await asyncio.wait_for(self._exec(job, args), timeout or self.settings.timeout_seconds)
+                job.status = "done"
+                return job
+        except asyncio.TimeoutError:
+            job.status = "timeout"
+            raise
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+            raise
+        except BaseException:
+            job.status = "failed"
+            raise
+        finally:
+            job.finished_at = time.time()
+            self._active.pop(id(job), None)
+            self._history.append(job)
+            if job.status != "done":
+                pathlib.Path(output).unlink(missing_ok=True)
+            elif job.started_at:
+                print(f"ffmpeg {job.name}: {job.run_seconds:.1f}s (queued {job.wait_seconds:.1f}s"
+                      + (f", {job.speed:.2f}x" if job.speed else "") + ")")
+
+    async def _exec(self, job: FfmpegJob, args: List[str]) -> None:
+        proc = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-y", "-nostats", "-progress", "pipe:1", *args,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stderr_tail: Deque[str] = deque(maxlen=20)
+
+        async def read_progress():
+            async for raw in proc.stdout:
+                key, _, value = raw.decode(errors="replace").strip().partition("=")
+                if key == "out_time_us" and value.isdigit():
+                    job.out_time = int(value) / 1_000_000
+                elif key == "speed" and value.endswith("x"):
+                    try: job.speed = float(value[:-1])
+                    except ValueError: pass
+
+        async def read_stderr():
+            async for raw in proc.stderr:
+                stderr_tail.append(raw.decode(errors="replace").rstrip())
+
+        readers = [asyncio.create_task(read_progress()), asyncio.create_task(read_stderr())]
+        try:
+            code = await proc.wait()
+            await asyncio.gather(*readers)
+        except BaseException:
+            # Таймаут или отмена: ffmpeg не должен пережить задачу
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            for t in readers:
+                t.cancel()
+            await asyncio.gather(*readers, return_exceptions=True)
+            raise
+        if code != 0:
+            raise FfmpegError(f"ffmpeg exited with code {code}: " + " | ".join(list(stderr_tail)[-3:]))
+
+    def status(self) -> Dict[str, Any]:
+        done = [j for j in self._history if j.status == "done"]
+        return {
+            "max_jobs": self.settings.jobs,
+            "running": [j.to_dict() for j in self._active.values() if j.status == "running"],
+            "queued": sum(1 for j in self._active.values() if j.status == "queued"),
+            "completed": len(done),
+            "avg_run_seconds": round(sum(j.run_seconds for j in done) / len(done), 2) if done else None,
+            "recent": [j.to_dict() for j in list(self._history)[-10:]],
+        }
@@ -0,0 +1,359 @@
+# image_branding.py
+# Брендирование изображений в отдельных процессах: декодирование, наложение логотипа
+# и кодирование PIL держат GIL и блокировали бы цикл событий (а с ним /status и /posts).
+# Модуль нарочно лёгкий (только PIL): его импортируют рабочие процессы пула.
+
+import asyncio
+import os
+import pathlib
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image, ImageOps, features
+
+
+# Ширина логотипа относительно ширины кадра (изображения и видео)
+LOGO_WIDTH_RATIO = 0.15
+
+
+# Формат вывода → (формат PIL, расширение)
+OUTPUT_FORMATS = {
+    "jpeg": ("JPEG", ".jpg"),
+    "png": ("PNG", ".png"),
+    "webp": ("WEBP", ".webp"),
+    "avif": ("AVIF", ".avif"),
+}
+
+
+@dataclass(frozen=True)
+class ImageEncoding:
+    """
+    Кодирование брендированного изображения (передаётся в рабочий процесс).
+    output_format: keep — формат исходника (JPEG остаётся JPEG, WebP — WebP, PNG — PNG),
+    либо jpeg / webp / avif / png для всех изображений.
+    """
+    output_format: str = "keep"
+    jpeg_quality: int = 85
+    webp_quality: int = 80
+    avif_quality: int = 60
+    strip_metadata: bool = True
+
+
+@dataclass(frozen=True)
+class ThumbnailSpec:
+    """Превью для ленты постов (передаётся в рабочий процесс)."""
+    max_side: int = 480
+    quality: int = 70
+
+
+@dataclass
+class BrandingSettings:
+    """Параметры брендирования изображений (секция `branding` в config.yaml)."""
+    image_workers: int = 0      # 0 — по числу ядер
+    batch_size: int = 4         # изображений в одной задаче процесса
+    encoding: ImageEncoding = ImageEncoding()
+    thumbnail: Optional[ThumbnailSpec] = ThumbnailSpec()   # None — превью не делаются
+    poster_at_seconds: float = 1.0                          # кадр видео для постера
+
+    @classmethod
+    def from_config(cls, cfg: Optional[Dict[str, Any]]) -> "BrandingSettings":
+        cfg = cfg or {}
+        defaults = cls()
+        enc = defaults.encoding
+        output_format = str(cfg.get("output_format", enc.output_format)).lower()
+        if output_format != "keep" and output_format not in OUTPUT_FORMATS:
+            output_format = enc.output_format
+        return cls(
+            image_workers=max(0, int(cfg.get("image_workers", defaults.image_workers))),
+            batch_size=max(1, int(cfg.get("batch_size", defaults.batch_size))),
+            encoding=ImageEncoding(
+                output_format=output_format,
+                jpeg_quality=int(cfg.get("jpeg_quality", enc.jpeg_quality)),
+                webp_quality=int(cfg.get("webp_quality", enc.webp_quality)),
+                avif_quality=int(cfg.get("avif_quality", enc.avif_quality)),
+                strip_metadata=bool(cfg.get("strip_metadata", enc.strip_metadata)),
+            ),
+            thumbnail=ThumbnailSpec(
+                max_side=max(32, int(cfg.get("thumb_max_side", defaults.thumbnail.max_side))),
+                quality=int(cfg.get("thumb_quality", defaults.thumbnail.quality)),
+            ) if cfg.get("thumbnails", True) else None,
+            poster_at_seconds=max(0.0, float(cfg.get("poster_at_seconds", defaults.poster_at_seconds))),
+        )
+
+    @property
+    def workers(self) -> int:
+        return self.image_workers or os.cpu_count() or 1
+
+
+@dataclass(frozen=True)
+class LogoSpec:
+    """Логотип и его размещение — передаётся в рабочий процесс."""
+    path: str
+    position: str = "bottom-right"
+    margin: int = 24
+
+
+class LogoCache:
+    """
+    Логотип, декодированный один раз, и LRU масштабированных RGBA-вариантов по ширине.
+    Для ffmpeg — готовые PNG под разрешение видео. Всё сбрасывается, когда меняется
+    mtime файла логотипа. У каждого рабочего процесса свой экземпляр.
+    """
+
+    def __init__(self, max_variants: int = 32):
+        self.max_variants = max_variants
+        self._lock = threading.Lock()
+        self._path: Optional[str] = None
+        self._mtime_ns: Optional[int] = None
+        self._base: Optional[Image.Image] = None
+        self._variants: "OrderedDict[Tuple[int, int], Image.Image]" = OrderedDict()
+        self._overlays: "OrderedDict[Tuple[int, int], str]" = OrderedDict()
+
+    def _load(self, path: str) -> Optional[Image.Image]:
+        # Под self._lock
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            self._path, self._mtime_ns, self._base = path, None, None
+            self._variants.clear()
+            self._overlays.clear()
+            return None
+        if path != self._path or mtime_ns != self._mtime_ns:
+            with Image.open(path) as src:
+                self._base = src.convert("RGBA")
+            self._path, self._mtime_ns = path, mtime_ns
+            self._variants.clear()
+            # PNG старого логотипа больше не нужны
+            for overlay in self._overlays.values():
+                pathlib.Path(overlay).unlink(missing_ok=True)
+            self._overlays.clear()
+        return self._base
+
+    def _scaled(self, frame_width: int) -> Image.Image:
+        # Под self._lock, после _load
+        base = self._base
+        scale = frame_width * LOGO_WIDTH_RATIO / max(1, base.width)
+        size = (int(base.width*scale), int(base.height*scale))
+        variant = self._variants.get(size)
+        if variant is None:
+            variant = base.resize(size)
+            self._variants[size] = variant
+            while len(self._variants) > self.max_variants:
+                self._variants.popitem(last=False)
+        else:
+            self._variants.move_to_end(size)
+        return variant
+
+    def for_image(self, path: str, frame_width: int) -> Optional[Image.Image]:
+        """Логотип под ширину изображения (None — файла логотипа нет)."""
+        with self._lock:
+            if self._load(path) is None:
+                return None
+            return self._scaled(frame_width)
+
+    def for_video(self, path: str, width: int, height: int, out_dir: str) -> Optional[str]:
+        """Путь к PNG логотипа под разрешение видео (None — файла логотипа нет)."""
+        with self._lock:
+            if self._load(path) is None:
+                return None
+            key = (width, height)
+            overlay = self._overlays.get(key)
+            if overlay and pathlib.Path(overlay).exists():
+                self._overlays.move_to_end(key)
+                return overlay
+            folder = pathlib.Path(out_dir) / "logo_cache"
+            folder.mkdir(parents=True, exist_ok=True)
+            overlay = str(folder / f"logo_{self._mtime_ns}_{width}x{height}.png")
+            if not pathlib.Path(overlay).exists():
+                tmp = f"{overlay}.{os.getpid()}.tmp.png"
+                self._scaled(width).save(tmp)
+                os.replace(tmp, overlay)
+            self._overlays[key] = overlay
+            while len(self._overlays) > self.max_variants:
+                self._overlays.popitem(last=False)
+            return overlay
+
+
+LOGO_CACHE = LogoCache()
+
+
+def _target_format(source_format: Optional[str], has_alpha: bool, encoding: ImageEncoding) -> str:
+    if encoding.output_format != "keep":
+        target = encoding.output_format
+    elif source_format in ("JPEG", "MPO"):
+        target = "jpeg"
+    elif source_format == "WEBP":
+        target = "webp"
+    elif source_format == "AVIF":
+        target = "avif"
+    else:
+        # PNG остаётся PNG; BMP/TIFF без прозрачности — фото, их незачем хранить без потерь
+        target = "png" if has_alpha or source_format == "PNG" else "jpeg"
+    if target == "avif" and not features.check("avif"):
+        target = "webp"
+    if target == "jpeg" and has_alpha:
+        target = "png" if encoding.output_format == "keep" else "webp"
+    return target
+
+
+def _has_alpha(img: Image.Image) -> bool:
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        return img.convert("RGBA").getchannel("A").getextrema()[0] < 255
+    return False
+
+
+def encode_image(img: Image.Image, source: Image.Image, out_base: pathlib.Path, encoding: ImageEncoding) -> str:
+    """
+    Сохраняет img в формате по encoding (с учётом формата исходника source). Возвращает путь.
+    При strip_metadata EXIF/XMP не переносятся; ICC-профиль сохраняется ради цветов.
+    """
+    target = _target_format(source.format, _has_alpha(img), encoding)
+    pil_format, ext = OUTPUT_FORMATS[target]
+    out = out_base.with_suffix(ext)
+    params: Dict[str, Any] = {}
+    icc = source.info.get("icc_profile")
+    if icc:
+        params["icc_profile"] = icc
+    if not encoding.strip_metadata and source.info.get("exif"):
+        # Кадр уже повёрнут exif_transpose — Orientation сбрасываем, иначе просмотрщик повернёт ещё раз
+        exif = source.getexif()
+        if exif.get(0x0112, 1) != 1:
+            exif[0x0112] = 1
+        params["exif"] = exif.tobytes()
+    if target == "jpeg":
+        img = img.convert("RGB")
+        params.update(quality=encoding.jpeg_quality, optimize=True, progressive=True)
+    elif target == "webp":
+        params.update(quality=encoding.webp_quality, method=4)
+    elif target == "avif":
+        params.update(quality=encoding.avif_quality)
+    else:
+        params.update(optimize=True)
+    img.save(out, pil_format, **params)
+    return str(out)
+
+
+def brand_image_file(img_path: str, logo: LogoSpec, out_dir: str, encoding: ImageEncoding = ImageEncoding()) -> str:
+    """Кладём логотип (если есть) и сохраняем в out_dir. Возвращаем путь; при ошибке — копия оригинала."""
+    try:
+        src = pathlib.Path(img_path)
+        out_base = pathlib.Path(out_dir) / (src.stem + "_branded")
+        source = Image.open(img_path)
+        # Поворот из EXIF применяем сразу — после удаления метаданных его уже не будет
+        img = ImageOps.exif_transpose(source)
+        mark = LOGO_CACHE.for_image(logo.path, img.width)
+        if mark is None:
+            return encode_image(img, source, out_base, encoding)
+        img = img.convert("RGBA")
+        x = logo.margin if "left" in logo.position else img.width - mark.width - logo.margin
+        y = logo.margin if "top" in logo.position else img.height - mark.height - logo.margin
+        img.alpha_composite(mark, dest=(x, y))
+        return encode_image(img, source, out_base, encoding)
+    except Exception as e:
+        print("Image branding error:", e)
+        dst = pathlib.Path(out_dir) / pathlib.Path(img_path).name
+        if pathlib.Path(img_path).resolve() != dst.resolve(): shutil.copy(img_path, dst)
+        return str(dst)
+
+
+def _brand_batch(paths: List[str], logo: LogoSpec, out_dir: Optional[str], encoding: ImageEncoding) -> List[str]:
+    # Без out_dir результат ложится рядом с исходником (каталог поста в спуле)
+    return [brand_image_file(p, logo, out_dir or os.path.dirname(p), encoding) for p in paths]
+
+
+def make_thumbnail(img_path: str, spec: Optional[ThumbnailSpec]) -> Dict[str, Any]:
+    """
+    Размеры изображения и WebP-превью рядом с ним (<stem>_thumb.webp).
+    Возвращает {"width", "height", "thumb_path"}; thumb_path=None, если превью отключены или не удались.
+    """
+    result: Dict[str, Any] = {"width": None, "height": None, "thumb_path": None}
+    try:
+        with Image.open(img_path) as src:
+            width, height = src.size
+            if src.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+                width, height = height, width
+            result.update(width=width, height=height)
+            if spec is None:
+                return result
+            # draft — декодирование JPEG сразу в уменьшенном масштабе; для GIF берётся первый кадр
+            src.draft("RGB", (spec.max_side, spec.max_side))
+            img = ImageOps.exif_transpose(src)
+            thumb = img.convert("RGBA" if _has_alpha(img) else "RGB")
+            thumb.thumbnail((spec.max_side, spec.max_side))
+            out = pathlib.Path(img_path).with_name(pathlib.Path(img_path).stem + "_thumb.webp")
+            thumb.save(out, "WEBP", quality=spec.quality, method=4)
+            result["thumb_path"] = str(out)
+    except Exception as e:
+        print("Thumbnail error:", e)
+    return result
+
+
+def _thumbnail_batch(paths: List[str], spec: Optional[ThumbnailSpec]) -> List[Dict[str, Any]]:
+    return [make_thumbnail(p, spec) for p in paths]
+
+
+class ImageBrandingPool:
+    """
+    Пул процессов для брендирования изображений. brand() режет список на пачки
+    по batch_size (меньше накладных расходов на передачу задач) и возвращает пути
+    в исходном порядке. Если пул сломался (процесс убит), пачка выполняется
+    в потоке, а пул пересоздаётся при следующем вызове.
+    """
+
+    def __init__(self, settings: BrandingSettings, logo: LogoSpec, out_dir: Optional[str] = None):
+        self.settings = settings
+        self.logo = logo
+        self.out_dir = out_dir
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.settings.workers)
+        return self._pool
+
+    async def _run_batch(self, batch: List[str]) -> List[str]:
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._executor(), _brand_batch, batch, self.logo, self.out_dir,
+                                              self.settings.encoding)
+        except BrokenProcessPool as e:
+            print(f"Image branding pool failed ({e}); branding {len(batch)} image(s) in a thread.")
+            self.shutdown(wait=False)
+            return await asyncio.to_thread(_brand_batch, batch, self.logo, self.out_dir, self.settings.encoding)
+
+    async def _run_thumbnails(self, batch: List[str], spec: Optional[ThumbnailSpec]) -> List[Dict[str, Any]]:
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._executor(), _thumbnail_batch, batch, spec)
+        except BrokenProcessPool as e:
+            print(f"Image branding pool failed ({e}); making {len(batch)} thumbnail(s) in a thread.")
+            self.shutdown(wait=False)
+            return await asyncio.to_thread(_thumbnail_batch, batch, spec)
+
+    async def thumbnails(self, paths: List[str], spec: Optional[ThumbnailSpec]) -> List[Dict[str, Any]]:
+        """Размеры и превью брендированных изображений (тем же пулом процессов), в порядке paths."""
+        if not paths:
+            return []
+        size = self.settings.batch_size
+        batches = [paths[i:i + size] for i in range(0, len(paths), size)]
+        results = await asyncio.gather(*(self._run_thumbnails(b, spec) for b in batches))
+        return [r for batch in results for r in batch]
+
+    async def brand(self, paths: List[str]) -> List[str]:
+        """Брендирует изображения параллельно по процессам; результат — пути в порядке paths."""
+        if not paths:
+            return []
+        size = self.settings.batch_size
+        batches = [paths[i:i + size] for i in range(0, len(paths), size)]
+        results = await asyncio.gather(*(self._run_batch(b) for b in batches))
+        return [p for batch in results for p in batch]
+
+    def shutdown(self, wait: bool = True) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait, cancel_futures=True)
+            self._pool = None
@@ -1,15 +1,36 @@
 # main.py — ТЕКСТ + МЕДИА одним постом (альбомом), бережная склейка соседних сообщений
-import os, asyncio, yaml, pathlib, shutil, subprocess
+import os, asyncio, yaml, pathlib, shutil, time, hashlib
+from dataclasses import dataclass, field
+from typing import Callable
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from telethon import TelegramClient
+from telethon import TelegramClient, utils
 from telethon.errors import (
     FloodWaitError,
 )
-from telethon.sessions import StringSession
-from PIL import Image
-from app.state_manager import increment_processed, set_total, get_last_id, set_last_id
-from app.supabase_manager import save_post, upload_media_files, save_post_media, update_post, initialize_supabase
+from app.state_manager import increment_processed, set_total, add_total, get_last_id, set_last_id
+from app.supabase_manager import (
+    save_post, save_posts_bulk, save_media_rows, save_post_media, update_post, initialize_supabase,
+    create_oversized_media_placeholders, create_deferred_media_placeholders,
+    find_media_objects, find_media_object_by_hash, register_media_object, get_global_telegram_credentials,
+    media_object_path, media_object_metadata, media_stream_path, media_thumbnail_path, media_public_url, list_ingest_telegram_credentials,
+)
+from app.pipeline import ByteBudget, PipelineSettings, PipelineStats, Stage, StagedPipeline
+from app.top_selection import TopPostSelector
+from app.scheduler import ChannelScheduler, SchedulerSettings
+from app.telegram_governor import governor_for
+from app.entity_cache import ResolvedChannel, resolve_channel, invalidate_on_error
+from app.account_pool import SESSION_ERRORS, AccountPool, AccountPoolSettings, ChannelProgress
+from app.chunked_download import (
+    DownloadSettings, download_document, download_document_sequential, iter_document, supports_chunked,
+)
+from app.post_units import iter_post_units
+from app.ffmpeg_runner import FASTSTART, FfmpegRunner, FfmpegSettings, poster_args, remux_args
+from app.media_dedup import branding_key, file_sha256, telegram_media_key
+from app.media_probe import MediaProbe, probe_message
+from app.spool import Spool, SpoolSettings
+from app.storage_uploader import StorageUploader, StorageUploadError, StorageUploadSettings
+from app.image_branding import LOGO_CACHE, BrandingSettings, ImageBrandingPool, LogoSpec
 # Убираем импорт, так как перевод здесь больше не нужен
 # from app.translation import translate_text
 
@@ -24,148 +45,257 @@ with open(config_path, "r", encoding="utf-8") as f:
 # Целевой канал и доставка больше не нужны
 # DEBUG_CFG = CFG.get("debug", {}) or {}
 # MIRROR_TO_ME = bool(DEBUG_CFG.get("mirror_to_me", False))
-OUT = pathlib.Path.home() / "Library" / "Caches" / "tg_pipeline"   # кэш, чтобы не засорять проект
-OUT.mkdir(exist_ok=True, parents=True)
+# Временные файлы — в управляемом спуле: каталог на пост, квота, чистка после падений
+SPOOL = Spool(SpoolSettings.from_config(CFG.get("spool")))
 
 # Логика работы с state.json полностью заменена на Supabase через state_manager.py
 
+DOWNLOAD_SETTINGS = DownloadSettings.from_config(CFG.get("download"))
+# Видео кодируются асинхронными процессами ffmpeg с лимитом параллельности
+FFMPEG = FfmpegRunner(FfmpegSettings.from_config(CFG.get("ffmpeg")))
+# Выгрузка в Storage — асинхронный HTTP с пулом соединений и повторами
+STORAGE_UPLOADER = StorageUploader(StorageUploadSettings.from_config(CFG.get("storage_upload")))
+# Изображения брендируются в пуле процессов — PIL не держит цикл событий
+IMAGE_BRANDING = ImageBrandingPool(
+    BrandingSettings.from_config(CFG.get("branding")),
+    LogoSpec(CFG["logo"]["path"], CFG["logo"]["position"], CFG["logo"]["margin"]),
+)
+
+def telegram_governor(client):
+    """Регулятор запросов (FloodWait, лимиты) для клиента — через него идут все вызовы Telethon."""
+    return governor_for(client, CFG.get("telegram_governor"))
+
 # === 1. Помощники для медиа ===
 def ffmpeg_exists() -> bool:
     return shutil.which("ffmpeg") is not None
 
-def add_logo_image(img_path: str, logo_path: str, pos: str="bottom-right", margin: int=24) -> str:
-    """Кладём логотип (если есть) и сохраняем в OUT. Возвращаем путь."""
+def _brand_video_args(video_path: str, logo_path: str, width: int | None, height: int | None, out: pathlib.Path,
+                      profile: str | None = None) -> list:
+    # При известном разрешении логотип масштабируется под кадр (PNG из кэша логотипа)
+    overlay = LOGO_CACHE.for_video(logo_path, width, height, str(SPOOL.cache_dir)) if width and height else None
+    return (["-i", str(video_path), "-i", overlay or logo_path,
+             "-filter_complex","overlay=W-w-24:H-h-24"]
+            + FFMPEG.settings.profile(profile).args()
+            + ["-codec:a","copy"] + FASTSTART + [str(out)])
+
+async def _remux_faststart(src: pathlib.Path, duration: float | None) -> str:
+    """Без логотипа: перепаковка в mp4 с faststart без перекодирования; при ошибке — оригинал."""
+    out = src.with_name(src.stem + "_faststart.mp4")
     try:
-        src = pathlib.Path(img_path)
-        out = OUT / (src.stem + "_branded.png")
-        if not pathlib.Path(logo_path).exists():
-            Image.open(img_path).save(out); return str(out)
-        img = Image.open(img_path).convert("RGBA")
-        logo = Image.open(logo_path).convert("RGBA")
-        scale = img.width * 0.15 / max(1, logo.width)
-        logo = logo.resize((int(logo.width*scale), int(logo.height*scale)))
-        x = margin if "left" in pos else img.width - logo.width - margin
-        y = margin if "top" in pos else img.height - logo.height - margin
-        img.alpha_composite(logo, dest=(x, y))
-        img.save(out); return str(out)
+        await FFMPEG.run(remux_args(str(src), str(out)), str(out), name=f"remux {src.name}", duration=duration)
+        src.unlink(missing_ok=True)
+        return str(out)
+    except asyncio.TimeoutError:
+        print(f"TIMEOUT: Remux exceeded {FFMPEG.settings.timeout_seconds:.0f}s for {src}. Using original video.")
     except Exception as e:
-        print("Image branding error:", e)
-        dst = OUT / pathlib.Path(img_path).name
-        shutil.copy(img_path, dst); return str(dst)
+        print("Video remux error:", e)
+    return str(src)
 
-def brand_video(video_path: str, logo_path: str) -> str:
-    """Логотип на видео через ffmpeg (если есть), иначе просто переложим в OUT."""
+async def brand_video_async(video_path: str, logo_path: str, width: int | None = None, height: int | None = None,
+                            duration: float | None = None, profile: str | None = None, streamable: bool = False) -> str:
+    """
+    Логотип на видео; ffmpeg идёт через FFMPEG (очередь, лимит по ядрам, отмена), цикл событий не блокируется.
+    profile — имя профиля кодирования из ffmpeg.profiles (конвейер выбирает его по длительности и размеру
+    ролика через FfmpegSettings.profile_for; без него — ffmpeg.default_profile).
+    Без логотипа (или при ffmpeg.brand_videos: false) файл только перепаковывается с faststart,
+    а если Telegram отметил его supports_streaming (moov уже в начале) — остаётся как есть.
+    Таймаут или ошибка — оригинал; отмена убивает ffmpeg и пробрасывается дальше.
+    """
     src = pathlib.Path(video_path)
-    out = OUT / (src.stem + "_branded.mp4")
-    if not ffmpeg_exists() or not pathlib.Path(logo_path).exists():
-        dst = OUT / src.name
-        if src.resolve() != dst.resolve(): shutil.move(str(src), str(dst))
-        return str(dst)
+    out = src.with_name(src.stem + "_branded.mp4")
+    # Файл уже лежит в каталоге поста — оригинал отдаётся как есть
+    if not ffmpeg_exists():
+        return str(src)
+    if not pathlib.Path(logo_path).exists() or not FFMPEG.settings.brand_videos:
+        if streamable:
+            return str(src)
+        return await _remux_faststart(src, duration)
     try:
-        cmd = ["ffmpeg","-y","-i", str(video_path), "-i", logo_path,
-               "-filter_complex","overlay=W-w-24:H-h-24","-codec:a","copy", str(out)]
-        # Добавляем таймаут 10 минут для обработки видео
-        subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=600)
+        args = await asyncio.to_thread(_brand_video_args, video_path, logo_path, width, height, out, profile)
+        await FFMPEG.run(args, str(out), name=src.name, duration=duration)
         return str(out)
-    except subprocess.TimeoutExpired:
-        print(f"TIMEOUT: Video branding exceeded 10 minutes for {video_path}. Using original video.")
-        dst = OUT / src.name
-        if src.resolve() != dst.resolve(): shutil.move(str(src), str(dst))
-        return str(dst)
+    except asyncio.TimeoutError:
+        print(f"TIMEOUT: Video branding exceeded {FFMPEG.settings.timeout_seconds:.0f}s for {video_path}. Using original video.")
+        return str(src)
     except Exception as e:
         print("Video branding error:", e)
-        dst = OUT / src.name
-        if src.resolve() != dst.resolve(): shutil.move(str(src), str(dst))
-        return str(dst)
+        return str(src)
 
-async def get_media_size(message) -> int:
-    """Получить размер медиа файла в байтах без загрузки."""
-    try:
-        if hasattr(message.media, 'photo'):
-            # Для фото берем самый большой размер
-            sizes = getattr(message.media.photo, 'sizes', [])
-            if sizes:
-                return max(getattr(s, 'size', 0) for s in sizes if hasattr(s, 'size'))
-        elif hasattr(message.media, 'document'):
-            doc = message.media.document
-            if doc:
-                return getattr(doc, 'size', 0)
-    except Exception as e:
-        print(f"Error getting media size for message {message.id}: {e}")
-    return 0
-
-async def download_and_brand(client, message):
-    """Скачать медиа из сообщения и вернуть список путей к обработанным файлам."""
-    paths = []
-    if not message.media:
-        return paths
-    
-    # Проверяем размер файла перед загрузкой (лимит 200MB)
-    MAX_SIZE_BYTES = 200 * 1024 * 1024  # 200 МБ
-    file_size = await get_media_size(message)
-    
-    if file_size > MAX_SIZE_BYTES:
-        print(f"SKIP: Media file from message {message.id} is too large ({file_size / 1024 / 1024:.2f} MB > 200 MB). Creating placeholder.")
+async def download_media_raw(client, message, max_size: int | None = None, dest_dir: pathlib.Path | None = None):
+    """
+    Скачивает медиа сообщения без обработки в dest_dir (каталог поста в спуле).
+    Возвращает путь к файлу, заглушку для слишком большого файла (dict) или None.
+    max_size — политика размера (по умолчанию download.max_file_mb); 0 — без ограничения.
+    Большие документы качаются параллельными сегментами с докачкой после сбоя (недокачка
+    остаётся в spool/partial). Пока квота спула занята, загрузка ждёт.
+    """
+    # Без фото/документа (опрос, геоточка, превью ссылки) качать нечего
+    probe = probe_message(message)
+    if probe is None:
+        return None
+
+    # Проверяем размер файла перед загрузкой (политика из конфига)
+    max_size = DOWNLOAD_SETTINGS.max_file_bytes if max_size is None else max_size
+    file_size = probe.size
+
+    if max_size and file_size > max_size:
+        print(f"SKIP: Media file from message {message.id} is too large ({file_size / 1024 / 1024:.2f} MB > {max_size / 1024 / 1024:.0f} MB). Creating placeholder.")
         # Возвращаем специальный маркер вместо пути к файлу
-        return [{
-            'type': 'oversized',
-            'size': file_size,
-            'message_id': message.id,
-            'media_type': 'video' if hasattr(message.media, 'document') and 
-                          getattr(message.media.document, 'mime_type', '').startswith('video/') else 'image'
-        }]
-    
+        return {'type': 'oversized', **_placeholder_info(message, probe)}
+
     try:
         print(f"Downloading media from message {message.id}, media type: {type(message.media).__name__}, size: {file_size / 1024 / 1024:.2f} MB")
-        # Добавляем таймаут 5 минут для загрузки медиа
-        raw = await asyncio.wait_for(client.download_media(message), timeout=300)
+        dest_dir = pathlib.Path(dest_dir) if dest_dir else SPOOL.run_dir
+        name = f"tg_{abs(message.chat_id or 0)}_{message.id}"
+        async with SPOOL.download_slot(file_size, owner=dest_dir):
+            if supports_chunked(message, DOWNLOAD_SETTINGS):
+                # Имя недокачки постоянное — повторная попытка продолжит с того же места
+                with SPOOL.partial(name) as partial_target:
+                    raw = await download_document(client, message, str(partial_target), DOWNLOAD_SETTINGS,
+                                                  telegram_governor(client))
+                raw = shutil.move(raw, str(dest_dir / pathlib.Path(raw).name))
+            elif getattr(message.media, "document", None) is not None:
+                # Небольшие документы — одним потоком; регулятор видит каждый блок, FloodWait продолжает с места
+                raw = await asyncio.wait_for(
+                    download_document_sequential(client, message, str(dest_dir / name), DOWNLOAD_SETTINGS,
+                                                 telegram_governor(client)), timeout=300)
+            else:
+                # Фото — несколько сотен КБ, один токен на весь файл, с таймаутом 5 минут
+                target = dest_dir / name
+                raw = await telegram_governor(client).call(
+                    "download", lambda: asyncio.wait_for(client.download_media(message, file=str(target)), timeout=300))
         if raw:
             print(f"Downloaded file: {raw}")
-            low = raw.lower()
-            
-            # Определяем тип медиа по атрибутам сообщения Telegram
-            media_type = None
-            if hasattr(message.media, 'photo'):
-                media_type = 'image'
-            elif hasattr(message.media, 'document'):
-                doc = message.media.document
-                if doc and hasattr(doc, 'mime_type'):
-                    mime = doc.mime_type or ""
-                    print(f"Document MIME type: {mime}")
-                    if mime.startswith('video/'):
-                        media_type = 'video'
-                    elif mime.startswith('image/'):
-                        media_type = 'image'
-            
-            # Обработка изображений
-            if low.endswith((".jpg",".jpeg",".png",".webp",".bmp",".tiff")) or media_type == 'image':
-                print(f"Processing as image: {raw}")
-                paths.append(add_logo_image(raw, CFG["logo"]["path"],
-                                            CFG["logo"]["position"], CFG["logo"]["margin"]))
-                try: os.remove(raw)
-                except: pass
-            # Обработка видео
-            elif low.endswith((".mp4",".mov",".mkv",".webm",".m4v")) or media_type == 'video':
-                print(f"Processing as video: {raw}")
-                branded_path = brand_video(raw, CFG["logo"]["path"])
-                print(f"Video processed, path: {branded_path}")
-                paths.append(branded_path)
-            else:
-                print(f"Processing as other media type: {raw}")
-                dst = OUT / pathlib.Path(raw).name
-                shutil.move(raw, dst)
-                paths.append(str(dst))
-            
-            print(f"Media paths collected: {paths}")
+        return raw
+    except SESSION_ERRORS:
+        # Сессия отозвана — пусть конвейер переключит аккаунт, а не сохранит пост без медиа
+        raise
     except asyncio.TimeoutError:
-        print(f"TIMEOUT: Media download exceeded 5 minutes for message {message.id}. Skipping this media.")
+        print(f"TIMEOUT: Media download timed out for message {message.id}. Skipping this media (partial download is kept for resume).")
         import traceback
         traceback.print_exc()
     except Exception as e:
         print(f"Media download error for message {message.id}: {e}")
         import traceback
         traceback.print_exc()
-    return paths
+    return None
+
+def _placeholder_info(message, probe: MediaProbe) -> dict:
+    """Данные заглушки медиа (размер, тип, размеры кадра) — без загрузки файла."""
+    return {
+        'size': probe.size,
+        'message_id': message.id,
+        'media_type': probe.media_type,
+        'mime_type': probe.mime_type,
+        'width': probe.width,
+        'height': probe.height,
+        'duration': probe.duration,
+    }
+
+def _video_dimensions(message) -> tuple[int | None, int | None]:
+    """Разрешение видео из атрибутов документа Telegram (без ffprobe)."""
+    probe = probe_message(message)
+    return (probe.width, probe.height) if probe and probe.kind == 'video' else (None, None)
+
+def _video_duration(message) -> float | None:
+    probe = probe_message(message)
+    return probe.duration if probe and probe.kind == 'video' else None
+
+def _media_kind(raw: str, message) -> str:
+    """'image' / 'video' / 'other' по атрибутам сообщения; расширение файла — только если их нет."""
+    probe = probe_message(message)
+    if probe is not None and probe.kind != 'other':
+        return probe.kind
+    low = raw.lower()
+    if low.endswith((".jpg",".jpeg",".png",".webp",".bmp",".tiff")):
+        return 'image'
+    if low.endswith((".mp4",".mov",".mkv",".webm",".m4v")):
+        return 'video'
+    return 'other'
+
+def _finish_branded_image(raw: str, branded: str) -> str:
+    if pathlib.Path(branded).resolve() != pathlib.Path(raw).resolve():
+        try: os.remove(raw)
+        except: pass
+    return branded
+
+async def brand_media_items(items: list) -> list:
+    """
+    Брендирует пары (message, raw_path) без блокировки цикла событий.
+    Изображения уходят пачкой в пул процессов, видео — в очередь ffmpeg, прочее остаётся как есть.
+    Возвращает пути в порядке items (None — если файл обработать не удалось).
+    """
+    results: list = [None] * len(items)
+    images = [(i, raw) for i, (gm, raw) in enumerate(items) if _media_kind(raw, gm) == 'image']
+    if images:
+        print(f"Processing {len(images)} image(s) in branding pool")
+        try:
+            branded = await IMAGE_BRANDING.brand([raw for _, raw in images])
+            for (i, raw), path in zip(images, branded):
+                results[i] = _finish_branded_image(raw, path)
+        except Exception as e:
+            print(f"Image branding pool error: {e}")
+    image_idx = {i for i, _ in images}
+    for i, (gm, raw) in enumerate(items):
+        if i in image_idx:
+            continue
+        if _media_kind(raw, gm) == 'video':
+            print(f"Processing as video: {raw}")
+            probe = probe_message(gm)
+            duration = _video_duration(gm)
+            results[i] = await brand_video_async(raw, CFG["logo"]["path"], *_video_dimensions(gm),
+                                                 duration=duration,
+                                                 profile=FFMPEG.settings.profile_for(duration, probe.size if probe else None),
+                                                 streamable=bool(probe and probe.supports_streaming))
+        else:
+            # Прочие документы не брендируются
+            results[i] = raw
+    return results
+
+async def _video_poster(path: str, message) -> str | None:
+    """Постер видео — кадр на branding.poster_at_seconds (не дальше середины ролика), JPEG рядом с файлом."""
+    settings = IMAGE_BRANDING.settings
+    if settings.thumbnail is None or not ffmpeg_exists():
+        return None
+    src = pathlib.Path(path)
+    out = src.with_name(src.stem + "_thumb.jpg")
+    duration = _video_duration(message)
+    at = min(settings.poster_at_seconds, duration / 2) if duration else settings.poster_at_seconds
+    try:
+        await FFMPEG.run(poster_args(path, str(out), at, settings.thumbnail.max_side), str(out),
+                         name=f"poster {src.name}", timeout=60)
+        return str(out)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print("Video poster error:", e)
+        return None
+
+async def derive_media_items(items: list) -> list:
+    """
+    Размеры и превью для пар (message, branded_path): WebP-миниатюры изображений — в пуле
+    процессов брендирования, постеры видео — кадр через ffmpeg, размеры видео — из атрибутов Telegram.
+    Возвращает словари {"width", "height", "duration", "thumb_path"} в порядке items.
+    """
+    # Размеры из атрибутов Telegram — значение по умолчанию, если файл прочитать не удалось
+    results = []
+    for gm, _ in items:
+        probe = probe_message(gm)
+        results.append({"width": probe.width if probe else None, "height": probe.height if probe else None,
+                        "duration": probe.duration if probe else None, "thumb_path": None})
+    images = [(i, path) for i, (gm, path) in enumerate(items) if _media_kind(path, gm) == 'image']
+    if images:
+        try:
+            derived = await IMAGE_BRANDING.thumbnails([path for _, path in images], IMAGE_BRANDING.settings.thumbnail)
+            for (i, _), info in zip(images, derived):
+                results[i].update({k: v for k, v in info.items() if v is not None})
+        except Exception as e:
+            print(f"Thumbnail pool error: {e}")
+    videos = [(i, gm, path) for i, (gm, path) in enumerate(items) if _media_kind(path, gm) == 'video']
+    posters = await asyncio.gather(*(_video_poster(path, gm) for _, gm, path in videos))
+    for (i, _, _), poster in zip(videos, posters):
+        results[i]["thumb_path"] = poster
+    return results
 
 def group_messages_into_post_units(messages):
     """
@@ -270,31 +400,517 @@ def _merge_group_metrics(items):
     return max_views, max_comments, max_likes, breakdown
 
 # === Получение информации о канале ===
+async def resolve_channel_cached(client: TelegramClient, ch: str) -> ResolvedChannel:
+    """Разрешает канал через постоянный кэш (без ResolveUsername, пока запись свежая)."""
+    ttl_hours = float((CFG.get("entity_cache") or {}).get("ttl_hours", 168))
+    return await resolve_channel(client, ch, governor=telegram_governor(client), ttl_seconds=ttl_hours * 3600)
+
 async def get_channel_info(client: TelegramClient, ch: str) -> tuple[str, str]:
     """
-    Получает информацию о канале из Telegram API.
+    Получает информацию о канале (из кэша или Telegram API).
     Возвращает (channel_title, channel_username).
     """
-    entity = await client.get_entity(ch)
-    channel_title = getattr(entity, "title", ch)
-    channel_username = getattr(entity, "username", None)
-    if not channel_username:
-        # Если username нет, пытаемся извлечь из переданного ch
-        channel_username = ch.lstrip("@").replace("t.me/", "")
-    return channel_title, channel_username
+    channel = await resolve_channel_cached(client, ch)
+    return channel.title, channel.username
+
+# === Конвейер сохранения постов: download → brand → upload → persist ===
+PIPELINE_SETTINGS = PipelineSettings.from_config(CFG.get("pipeline"))
+
+@dataclass
+class PostJob:
+    """Единица поста (одно сообщение или альбом), проходящая через стадии конвейера."""
+    group: list
+    raw_items: list = field(default_factory=list)        # (message, raw_path)
+    media_paths: list = field(default_factory=list)      # пути брендированных файлов
+    oversized_items: list = field(default_factory=list)  # заглушки для больших файлов
+    deferred_items: list = field(default_factory=list)   # медиа без загрузки (media_mode=lazy)
+    branded: list = field(default_factory=list)          # (message, branded_path)
+    derived: dict = field(default_factory=dict)          # message.id -> размеры и локальное превью
+    reused: dict = field(default_factory=dict)           # message.id -> уже выгруженный объект (media_objects)
+    uploaded: dict = field(default_factory=dict)         # message.id -> выгруженный сейчас объект
+    media_items: list = field(default_factory=list)      # метаданные загруженных файлов
+    spool_dir: pathlib.Path | None = None                # каталог временных файлов поста в спуле
+
+    @property
+    def root(self):
+        return self.group[0]
+
+def _unit_key(unit) -> int:
+    """Ключ единицы поста — младший id сообщения (совпадает с root после сортировки)."""
+    return min(m.id for m in unit)
+
+def _track_units(user_id: str, units: list, progress: ChannelProgress | None) -> list:
+    """
+    Убирает посты, уже обработанные в прошлой попытке канала, и добавляет в total
+    только ещё не учтённые — при переезде канала на другой аккаунт прогресс не двоится.
+    """
+    if progress is None:
+        add_total(user_id, len(units))
+        return units
+    units = [u for u in units if _unit_key(u) not in progress.done]
+    new_keys = [_unit_key(u) for u in units if _unit_key(u) not in progress.counted]
+    progress.counted.update(new_keys)
+    add_total(user_id, len(new_keys))
+    return units
+
+def _cleanup_job_files(job: PostJob) -> None:
+    """Удаляет временные файлы поста (сырые, обработанные, превью) вместе с его каталогом в спуле."""
+    SPOOL.release_job_dir(job.spool_dir)
+    job.spool_dir = None
+
+async def ingest_post_units(
+    client: TelegramClient,
+    ch: str,
+    units: list,
+    *,
+    user_id: str,
+    is_top_post: bool,
+    channel_title: str,
+    channel_username: str,
+    settings: PipelineSettings | None = None,
+    on_saved: Callable[[PostJob, bool], None] | None = None,
+    scheduler: ChannelScheduler | None = None,
+    progress: ChannelProgress | None = None,
+    track_progress: bool = True,
+    media_mode: str = "full",
+):
+    """
+    Прогоняет единицы постов через поэтапный конвейер.
+    Загрузка, брендирование и выгрузка идут параллельно для разных постов,
+    сохранение в Supabase и счётчик прогресса — строго в порядке units.
+    on_saved(job, saved) вызывается после каждого поста в том же порядке.
+    При запуске из ChannelScheduler слоты сети и бюджет байтов общие для всех каналов.
+    Ошибка сессии аккаунта останавливает конвейер целиком (канал переедет на другой аккаунт).
+    track_progress=False — не трогать счётчик processed (режим наблюдения вне запуска).
+    media_mode="lazy" — медиа не качаются: сохраняются заглушки is_loaded=false,
+    которые догружаются по запросу или фоновым заполнителем.
+    """
+    settings = settings or PIPELINE_SETTINGS
+    lazy = media_mode == "lazy"
+    download_slot = scheduler.download_limiter.slot if scheduler else None
+    upload_slot = scheduler.upload_limiter.slot if scheduler else None
+
+    async def estimate(job: PostJob) -> int:
+        # Сырой файл + брендированная копия на диске
+        total = 0
+        for gm in job.group:
+            probe = probe_message(gm)
+            if probe and (not DOWNLOAD_SETTINGS.max_file_bytes or probe.size <= DOWNLOAD_SETTINGS.max_file_bytes):
+                total += probe.size * 2
+        return total
+
+    if lazy:
+        # Без загрузки медиа конвейер не нужен: посты и заглушки пишутся пачками
+        return await _ingest_lazy(ch, units, user_id=user_id, is_top_post=is_top_post,
+                                  channel_title=channel_title, channel_username=channel_username,
+                                  on_saved=on_saved, progress=progress, track_progress=track_progress)
+
+    async def download(job: PostJob):
+        # Файлы, уже выгруженные с теми же настройками брендирования, не качаем вовсе
+        keys = {gm.id: telegram_media_key(gm) for gm in job.group if gm.media}
+        known = {}
+        if any(keys.values()):
+            known = await asyncio.to_thread(find_media_objects, [k for k in keys.values() if k], current_branding_key())
+        print(f"Processing post {job.root.id}: downloading media from {len(job.group)} message(s)"
+              + (f", {len(known)} already in storage" if known else "") + "...")
+        for gm in job.group:
+            if keys.get(gm.id) in known:
+                job.reused[gm.id] = known[keys[gm.id]]
+                continue
+            if job.spool_dir is None:
+                job.spool_dir = SPOOL.new_job_dir(f"post{job.root.id}")
+            if download_slot is not None:
+                async with download_slot(ch):
+                    raw = await download_media_raw(client, gm, dest_dir=job.spool_dir)
+            else:
+                raw = await download_media_raw(client, gm, dest_dir=job.spool_dir)
+            if isinstance(raw, dict) and raw.get('type') == 'oversized':
+                job.oversized_items.append(raw)
+            elif raw:
+                job.raw_items.append((gm, raw))
+
+    async def brand(job: PostJob):
+        # PIL/ffmpeg блокируют поток — уводим их с цикла событий
+        paths = await brand_media_items(job.raw_items)
+        for (gm, _), path in zip(job.raw_items, paths):
+            if path:
+                job.branded.append((gm, path))
+                job.media_paths.append(path)
+        # Размеры и превью для ленты (WebP / постер видео) — пока файлы на диске
+        derived = await derive_media_items(job.branded)
+        for (gm, _), info in zip(job.branded, derived):
+            job.derived[gm.id] = info
+        print(f"Post {job.root.id}: collected {len(job.media_paths)} media file(s), {len(job.reused)} reused, "
+              f"{len(job.oversized_items)} oversized placeholder(s)")
+
+    async def upload(job: PostJob):
+        if not job.branded:
+            _cleanup_job_files(job)
+            return
+        bkey = current_branding_key()
+
+        async def store():
+            # Файлы альбома выгружаются параллельно (общий лимит — storage_upload.max_parallel)
+            items = await asyncio.gather(*(store_media_file(gm, path, bkey, job.derived.get(gm.id))
+                                           for gm, path in job.branded))
+            for (gm, _), item in zip(job.branded, items):
+                if item:
+                    job.uploaded[gm.id] = item
+
+        try:
+            if upload_slot is not None:
+                async with upload_slot(ch):
+                    await store()
+            else:
+                await store()
+        finally:
+            # Файлы поста больше не нужны: спул освобождается сразу, а не при сохранении —
+            # посты сохраняются по порядку, и ждущая квоту загрузка более раннего поста
+            # иначе ждала бы каталоги более поздних вечно
+            _cleanup_job_files(job)
+
+    async def persist(job: PostJob, error: BaseException | None):
+        saved = False
+        try:
+            if error is not None:
+                print(f"ERROR processing post (original_id={job.root.id}): {error}")
+                return
+            post_id = await asyncio.to_thread(_persist_post_job, job, ch, user_id, is_top_post, channel_title, channel_username)
+            saved = bool(post_id)
+        finally:
+            if on_saved is not None:
+                on_saved(job, saved)
+            _cleanup_job_files(job)
+            # Увеличиваем счетчик ВСЕГДА, даже если была ошибка
+            # Иначе прогресс не синхронизируется с UI
+            if track_progress:
+                increment_processed(user_id)
+            if progress is not None:
+                progress.done.add(_unit_key(job.group))
+
+    if scheduler is not None:
+        budget = scheduler.budget
+    else:
+        budget = ByteBudget(settings.max_inflight_bytes, settings.min_free_disk_bytes, disk_path=str(SPOOL.root))
+    pipeline = StagedPipeline(
+        [
+            Stage("download", download, settings.download_workers),
+            Stage("brand", brand, settings.brand_workers),
+            Stage("upload", upload, settings.upload_workers),
+        ],
+        persist,
+        queue_size=settings.queue_size,
+        budget=budget,
+        estimate=estimate,
+        cleanup=_cleanup_job_files,
+        fatal=SESSION_ERRORS,
+    )
+    jobs = (PostJob(group=sorted(group, key=lambda x: (x.date, x.id))) for group in units)
+    stats = await pipeline.run(jobs)
+    busy = ", ".join(f"{name}={sec:.1f}s" for name, sec in stats.stage_seconds.items())
+    print(f"Pipeline for {ch}: {stats.succeeded}/{stats.total} posts in {stats.wall_seconds:.1f}s ({busy})")
+    return stats
+
+def _group_edit_date(group):
+    """Дата последней правки среди сообщений единицы (None, если не правились)."""
+    dates = [gm.edit_date for gm in group if getattr(gm, "edit_date", None)]
+    return max(dates) if dates else None
+
+def _group_caption(group) -> str:
+    """Подпись — первая непустая среди группы (обычно у первого элемента альбома)."""
+    for gm in group:
+        t = (gm.message or "").strip()
+        if t:
+            return t
+    return ""
+
+def current_branding_key() -> str:
+    """Отпечаток текущих настроек брендирования для индекса media_objects."""
+    settings = IMAGE_BRANDING.settings
+    return branding_key(IMAGE_BRANDING.logo, settings.encoding, FFMPEG.settings,
+                        settings.thumbnail, settings.poster_at_seconds)
+
+async def _upload_immutable(local_path: str, dest_path: str) -> bool:
+    """Выгрузка по неизменяемому адресу (без upsert; «уже существует» — успех). False — не удалось."""
+    try:
+        return await STORAGE_UPLOADER.upload(local_path, dest_path, upsert=False, cache_control="31536000")
+    except StorageUploadError as e:
+        print(e)
+        return False
+
+async def store_media_file(message, path: str, bkey: str, derived: dict | None = None) -> dict | None:
+    """
+    Выгружает брендированный файл как общий объект Storage (адрес по sha256) и заносит его
+    в индекс media_objects. Если такие же байты уже выгружены — переиспользует их.
+    derived — результат derive_media_items: размеры и превью (выгружается рядом с оригиналом).
+    Возвращает метаданные для post_media или None.
+    """
+    content_hash = await asyncio.to_thread(file_sha256, path)
+    item = await asyncio.to_thread(find_media_object_by_hash, content_hash)
+    if not item:
+        dest_path = media_object_path(path, content_hash)
+        if not await _upload_immutable(path, dest_path):
+            return None
+        item = await asyncio.to_thread(media_object_metadata, path, dest_path)
+    derived = derived or {}
+    for column in ("width", "height", "duration"):
+        if item.get(column) is None and derived.get(column) is not None:
+            item[column] = derived[column]
+    if not item.get("thumbnail_url") and derived.get("thumb_path"):
+        thumb_path = media_thumbnail_path(derived["thumb_path"], item["storage_path"])
+        if await _upload_immutable(derived["thumb_path"], thumb_path):
+            item["thumbnail_path"] = thumb_path
+            item["thumbnail_url"] = await asyncio.to_thread(media_public_url, thumb_path)
+    key = telegram_media_key(message)
+    if key:
+        await asyncio.to_thread(register_media_object, key, bkey, content_hash, item)
+    return item
+
+def passes_through_branding(probe: MediaProbe) -> bool:
+    """Выгружается ли файл как есть: brand_media_items не изменил бы его байты."""
+    if probe.kind == 'other':
+        return True
+    if probe.kind != 'video':
+        return False
+    if not ffmpeg_exists():
+        return True
+    branded = pathlib.Path(CFG["logo"]["path"]).exists() and FFMPEG.settings.brand_videos
+    return not branded and probe.supports_streaming
+
+def should_stream_media(message) -> bool:
+    """Большой документ без обработки — в Storage потоком из Telegram, минуя спул."""
+    probe = probe_message(message)
+    return (probe is not None and getattr(message.media, "document", None) is not None
+            and probe.size >= STORAGE_UPLOADER.settings.resumable_threshold_bytes
+            and passes_through_branding(probe))
+
+async def stream_media_file(client, message, bkey: str) -> dict | None:
+    """
+    Выгружает документ сообщения в Storage по TUS прямо из iter_document — без временного файла.
+    Прерванная выгрузка (сбой сети, Telegram, перезапуск) продолжается с последнего подтверждённого
+    смещения: адрес выгрузки лежит в spool/partial. sha256 считается по ходу передачи; если часть
+    байтов ушла в прошлом процессе, в индекс пишется ключ Telegram вместо хэша.
+    Возвращает метаданные для post_media или None.
+    """
+    probe = probe_message(message)
+    key = telegram_media_key(message)
+    dest_path = media_stream_path(key, utils.get_extension(message.media) or "")
+    governor = telegram_governor(client)
+    digest = hashlib.sha256()
+    hashed = 0
+
+    async def open_stream(offset: int):
+        nonlocal digest, hashed
+        if offset > hashed:
+            digest = None
+        position = offset
+        async for chunk in iter_document(client, message, offset, DOWNLOAD_SETTINGS, governor):
+            # После сбоя те же байты приходят снова — в хэш идёт только ещё не учтённый хвост
+            if digest is not None and position + len(chunk) > hashed:
+                digest.update(chunk[hashed - position:] if hashed > position else chunk)
+                hashed = position + len(chunk)
+            position += len(chunk)
+            yield chunk
+
+    print(f"Streaming media from message {message.id} to storage ({probe.size / 1024 / 1024:.1f} MB, no temp file)")
+    started = time.monotonic()
+    name = f"tus_{key.replace(':', '_')}"
+    try:
+        with SPOOL.partial(name) as state_path:
+            await STORAGE_UPLOADER.upload_resumable(dest_path, probe.size, open_stream, probe.mime_type,
+                                                    state_path=state_path.with_suffix(".json"),
+                                                    cache_control="31536000", fatal=SESSION_ERRORS)
+    except StorageUploadError as e:
+        print(e)
+        return None
+    elapsed = max(time.monotonic() - started, 1e-6)
+    print(f"Streamed {probe.size / 1024 / 1024:.1f} MB for message {message.id} in {elapsed:.1f}s")
+    content_hash = digest.hexdigest() if digest is not None and hashed == probe.size else key
+    item = {
+        "media_type": probe.media_type,
+        "mime_type": probe.mime_type,
+        "url": await asyncio.to_thread(media_public_url, dest_path),
+        "storage_path": dest_path,
+        "width": probe.width,
+        "height": probe.height,
+        "duration": probe.duration,
+        "thumbnail_url": None,
+        "thumbnail_path": None,
+        "order_index": 0,
+        "file_size_bytes": probe.size,
+    }
+    await asyncio.to_thread(register_media_object, key, bkey, content_hash, item)
+    return item
+
+def _ordered_media_items(job: PostJob) -> list:
+    """Медиа поста в порядке сообщений альбома: переиспользованные и только что выгруженные."""
+    items = []
+    for gm in job.group:
+        item = job.reused.get(gm.id) or job.uploaded.get(gm.id)
+        if item:
+            items.append({**item, "order_index": len(items)})
+    return items
+
+def _build_post_payload(job: PostJob, ch: str, is_top_post: bool,
+                        channel_title: str, channel_username: str) -> dict:
+    """Собирает строку поста из единицы (подпись, ID альбома, сведённые метрики)."""
+    group = job.group
+    root_msg = job.root
+    root_id = root_msg.id
+    original_ids = [gm.id for gm in group]
+
+    caption = _group_caption(group)
+
+    # Для метрик возьмем максимум по группе (обычно одинаковы)
+    metrics_to_merge = []
+    for gm in group:
+        v, c, l, rmap = _extract_message_metrics(gm)
+        metrics_to_merge.append({"views": v, "comments": c, "likes": l, "reactions": rmap})
+    grouped_views, grouped_comments, grouped_likes, grouped_reactions = _merge_group_metrics(metrics_to_merge)
+
+    post_to_save = {
+        "source_channel": ch,
+        "channel_title": channel_title,
+        "channel_username": channel_username,
+        "original_message_id": root_id,
+        "original_ids": original_ids, # один или несколько ID альбома
+        "original_date": root_msg.date,
+        "content": caption,
+        "translated_content": None, # Будет заполнено позже
+        "target_lang": None,      # Будет заполнено позже
+        "has_media": bool(job.media_items),
+        "media_count": len(job.media_items),
+        "is_merged": len(group) > 1,
+        "is_top_post": is_top_post,
+        "original_views": grouped_views,
+        "original_likes": grouped_likes,
+        "original_comments": grouped_comments,
+        "original_reactions": grouped_reactions,
+        "original_edit_date": _group_edit_date(group),
+    }
+    return post_to_save
+
+# Постов в одном insert при media_mode=lazy
+LAZY_BATCH_SIZE = 100
+
+async def _ingest_lazy(ch: str, units: list, *, user_id: str, is_top_post: bool,
+                       channel_title: str, channel_username: str,
+                       on_saved: Callable[[PostJob, bool], None] | None,
+                       progress: ChannelProgress | None, track_progress: bool) -> PipelineStats:
+    """
+    media_mode=lazy: посты и заглушки медиа (is_loaded=false) сохраняются пачками
+    по LAZY_BATCH_SIZE без обращений к Telegram. Порядок on_saved/прогресса — как у конвейера.
+    """
+    stats = PipelineStats()
+    started = time.monotonic()
+    jobs = [PostJob(group=sorted(group, key=lambda x: (x.date, x.id))) for group in units]
+    for job in jobs:
+        for gm in job.group:
+            probe = probe_message(gm)
+            if probe is None:
+                continue
+            # Больше политики download.max_file_mb — сразу oversized: заполнитель такие не трогает
+            if DOWNLOAD_SETTINGS.max_file_bytes and probe.size > DOWNLOAD_SETTINGS.max_file_bytes:
+                job.oversized_items.append(_placeholder_info(gm, probe))
+            else:
+                job.deferred_items.append(_placeholder_info(gm, probe))
+    for i in range(0, len(jobs), LAZY_BATCH_SIZE):
+        batch = jobs[i:i + LAZY_BATCH_SIZE]
+        post_ids = await asyncio.to_thread(_persist_lazy_batch, batch, ch, user_id, is_top_post,
+                                           channel_title, channel_username)
+        for job, post_id in zip(batch, post_ids):
+            stats.total += 1
+            if post_id:
+                stats.succeeded += 1
+            else:
+                stats.failed += 1
+            if on_saved is not None:
+                on_saved(job, bool(post_id))
+            if progress is not None:
+                progress.done.add(_unit_key(job.group))
+        if track_progress:
+            increment_processed(user_id, len(batch))
+    stats.wall_seconds = time.monotonic() - started
+    print(f"Lazy ingest for {ch}: {stats.succeeded}/{stats.total} posts in {stats.wall_seconds:.1f}s "
+          f"({sum(len(j.deferred_items) for j in jobs)} deferred, "
+          f"{sum(len(j.oversized_items) for j in jobs)} oversized media)")
+    return stats
+
+def _persist_lazy_batch(jobs: list, ch: str, user_id: str, is_top_post: bool,
+                        channel_title: str, channel_username: str) -> list:
+    """Сохраняет пачку постов одним insert и их заглушки медиа вторым. Возвращает post_id по порядку."""
+    posts = []
+    for job in jobs:
+        post = _build_post_payload(job, ch, is_top_post, channel_title, channel_username)
+        post["has_media"] = bool(job.deferred_items or job.oversized_items)
+        post["media_count"] = len(job.deferred_items) + len(job.oversized_items)
+        posts.append(post)
+    post_ids = save_posts_bulk(posts, user_id)
+    media_rows = []
+    for job, post_id in zip(jobs, post_ids):
+        if not post_id:
+            print(f"ERROR: Failed to save post (original_id={job.root.id}) to Supabase")
+            continue
+        items = create_deferred_media_placeholders(job.deferred_items, ch)
+        items += create_oversized_media_placeholders(job.oversized_items, ch, len(items))
+        for item in items:
+            item["post_id"] = post_id
+            media_rows.append(item)
+    save_media_rows(media_rows)
+    return post_ids
+
+def _persist_post_job(job: PostJob, ch: str, user_id: str, is_top_post: bool,
+                      channel_title: str, channel_username: str) -> str | None:
+    """Сохраняет пост и его медиа в Supabase (синхронно, вызывается из потока). Возвращает post_id."""
+    root_id = job.root.id
+    job.media_items = _ordered_media_items(job)
+    post_to_save = _build_post_payload(job, ch, is_top_post, channel_title, channel_username)
+
+    # --- Сохраняем пост и медиа ---
+    post_id = save_post(post_to_save, user_id)
+    if not post_id:
+        print(f"ERROR: Failed to save post (original_id={root_id}) to Supabase")
+        return None
+
+    all_media_items = list(job.media_items)
+
+    # Добавляем заглушки для больших файлов
+    if job.oversized_items:
+        oversized_media = create_oversized_media_placeholders(job.oversized_items, ch, len(all_media_items))
+        all_media_items.extend(oversized_media)
+
+    # Сохраняем все медиа
+    if all_media_items:
+        save_post_media(post_id, all_media_items)
+        # Обновляем фактические флаги/счетчики медиа у поста
+        try:
+            update_post(post_id, {
+                "has_media": bool(all_media_items),
+                "media_count": len(all_media_items),
+            })
+        except Exception:
+            pass
+
+    # --- ОТПРАВКА В TELEGRAM ОТКЛЮЧЕНА ---
+    print(f"Post (original_id={root_id}) saved to Supabase (post_id={post_id}).")
+    return post_id
 
 # === 2a. Выбор топ-постов за период по метрикам ===
-async def process_top_posts(client: TelegramClient, ch: str, period_days: float, top_counts: dict, desired_total: int | None = None, user_id: str | None = None):
+async def process_top_posts(client: TelegramClient, ch: str, period_days: float, top_counts: dict, desired_total: int | None = None, user_id: str | None = None, scheduler: ChannelScheduler | None = None,
+                            progress: ChannelProgress | None = None, media_mode: str = "full"):
     print(f"== Top posts mode: channel {ch}, period_days={period_days}, counts={top_counts}")
-    entity = await client.get_entity(ch)
-    channel_title, channel_username = await get_channel_info(client, ch)
+    governor = telegram_governor(client)
+    channel = await resolve_channel_cached(client, ch)
+    entity = channel.entity
+    channel_title, channel_username = channel.title, channel.username
     # Поддерживаем дробные дни (например, 0.5 дня = 12 часов)
     days_span = max(0.001, float(period_days))
     since_dt = datetime.utcnow() - timedelta(days=days_span)
 
-    # Собираем сообщения за период
-    collected = []
-    async for m in client.iter_messages(entity, limit=2000):
+    # Сканируем период потоково: храним только компактные метрики, кучи по квотам и индекс альбомов
+    selector = TopPostSelector(top_counts, desired_total)
+    scan_limit = int((CFG.get("top_posts") or {}).get("max_scan_messages", 2000) or 2000)
+    async for m in governor.iter_messages(client, entity, limit=scan_limit):
         if m.date.tzinfo:
             msg_dt = m.date.replace(tzinfo=None)
         else:
@@ -302,216 +918,48 @@ async def process_top_posts(client: TelegramClient, ch: str, period_days: float,
         if msg_dt < since_dt:
             break
 
-        # Считываем просмотры, комментарии, лайки (сумма реакций) и разбивку по эмодзи
-        views, comments, likes, reactions_breakdown = _extract_message_metrics(m)
-
-        collected.append({
-            'message': m,
-            'likes': likes,
-            'comments': comments,
-            'views': views,
-            'reactions': reactions_breakdown,
-        })
+        # Считываем просмотры, комментарии и лайки (сумма реакций)
+        views, comments, likes, _ = _extract_message_metrics(m)
+        selector.add(m.id, getattr(m, "grouped_id", None), views, comments, likes)
 
-    print(f"Collected {len(collected)} messages in period for {ch}")
+    print(f"Scanned {selector.scanned} messages in period for {ch}")
 
-    # Сортировки и выбор топов с гарантией квот и без дублей
-    def sorted_by(key: str):
-        sorted_all = sorted(collected, key=lambda x: x.get(key, 0), reverse=True)
-        positives = [x for x in sorted_all if x.get(key, 0) > 0]
-        return positives if positives else sorted_all
+    selected_ids = selector.select()
+    print(f"Selected unique messages after quotas: {len(selected_ids)}")
 
-    unique_ids = set()
-    unique_msgs = []
+    # Полные сообщения загружаем только для победителей и участников их альбомов
+    unit_ids = selector.units(selected_ids)
+    wanted_ids = [mid for ids in unit_ids for mid in ids]
+    by_id = {}
+    for i in range(0, len(wanted_ids), 100):
+        chunk = wanted_ids[i:i + 100]
+        for msg in await governor.call("messages", lambda: client.get_messages(entity, ids=chunk)):
+            if msg is not None:
+                by_id[msg.id] = msg
+    units = [[by_id[mid] for mid in ids if mid in by_id] for ids in unit_ids]
+    units = [u for u in units if u]
 
-    for key in ['likes', 'comments', 'views']:
-        quota = int(top_counts.get(key, 0) or 0)
-        if quota <= 0:
-            continue
-        count_added = 0
-        for item in sorted_by(key):
-            if count_added >= quota:
-                break
-            mid = item['message'].id
-            if mid in unique_ids:
-                continue
-            unique_ids.add(mid)
-            unique_msgs.append(item)
-            count_added += 1
-
-    print(f"Selected unique messages after quotas: {len(unique_msgs)}")
-
-    # При наличии явного лимита с фронта — ограничим выдачу
-    if isinstance(desired_total, int) and desired_total > 0:
-        unique_msgs = unique_msgs[:desired_total]
-
-    # Фолбэк: если ничего не набрали по метрикам, добираем просто свежие посты
-    if not unique_msgs:
-        print("Top selection produced 0 messages, applying fallback by date...")
-        # сортируем по дате у исходных сообщений
-        collected_sorted = sorted(collected, key=lambda x: x['message'].date, reverse=True)
-        for item in collected_sorted:
-            unique_msgs.append(item)
-            if isinstance(desired_total, int) and desired_total > 0 and len(unique_msgs) >= desired_total:
-                break
-
-    # Второй фолбэк: если и после добора по периоду пусто, берём последние текстовые посты без ограничения периода
-    if not unique_msgs:
+    # Второй фолбэк: если и после добора по периоду пусто, берём последние посты без ограничения периода
+    if not units:
         print("Fallback by date yielded 0 messages, expanding search window (ignore period)...")
-        async for m2 in client.iter_messages(entity, limit=500):
-            # Оборачиваем в совместимую структуру
-            unique_msgs.append({
-                'message': m2,
-                'likes': 0,
-                'comments': int(getattr(m2, 'replies', None).replies if getattr(m2, 'replies', None) else 0),
-                'views': int(getattr(m2, 'views', 0) or 0),
-            })
-
-            if isinstance(desired_total, int) and desired_total > 0 and len(unique_msgs) >= desired_total:
-                break
-        
-    print(f"Final messages to send: {len(unique_msgs)}")
-
-    # Проставим total для прогресса (учитываем альбомы как один пост)
-    counted = set()
-    total_units = 0
-    for item in unique_msgs:
-        m = item['message']
-        gid = getattr(m, 'grouped_id', None)
-        key = ("gid", gid) if gid else ("mid", m.id)
-        if key in counted:
-            continue
-        counted.add(key)
-        total_units += 1
-    set_total(user_id, total_units)
-
-    # Отправляем в целевой канал, соблюдая текущие правила склейки/медиа
-    # Здесь без склейки; отправляем как есть
-    used_album_keys = set()
-    for item in unique_msgs:
-        m = item['message']
-        gid = getattr(m, 'grouped_id', None)
-        album_key = ("gid", gid) if gid else ("mid", m.id)
-        if album_key in used_album_keys:
-            continue
-        used_album_keys.add(album_key)
+        units_limit = desired_total if isinstance(desired_total, int) and desired_total > 0 else None
+        units = [u async for u in iter_post_units(client, entity, governor, units_limit, max_messages=500)]
 
-        # Собираем участников альбома из уже собранного пула за период
-        if gid:
-            group_members = [x['message'] for x in collected if getattr(x['message'], 'grouped_id', None) == gid]
-        else:
-            group_members = [m]
-        # Порядок внутри группы — по дате/ID
-        group_members = sorted(group_members, key=lambda x: (x.date, x.id))
-
-        # Подпись — первая непустая среди группы (обычно у первого элемента альбома)
-        caption = ""
-        for gm in group_members:
-            t = (gm.message or "").strip()
-            if t:
-                caption = t
-                break
-
-        # Скачиваем и брендируем все медиа из альбома
-        media_results = []
-        print(f"Processing post {root_id}: downloading media from {len(group_members)} message(s)...")
-        for gm in group_members:
-            results = await download_and_brand(client, gm)
-            media_results.extend(results)
-        
-        # Разделяем обычные файлы и заглушки больших файлов
-        media_paths = []
-        oversized_items = []
-        for item in media_results:
-            if isinstance(item, dict) and item.get('type') == 'oversized':
-                oversized_items.append(item)
-            else:
-                media_paths.append(item)
-        
-        print(f"Post {root_id}: collected {len(media_paths)} media file(s), {len(oversized_items)} oversized placeholder(s)")
-
-        root_msg = group_members[0]
-        root_id = root_msg.id
-        original_ids = [gm.id for gm in group_members]
-
-        # Для метрик возьмем максимум по группе (обычно одинаковы)
-        ids_set = set(original_ids)
-        metrics_to_merge = []
-        for it in collected:
-            mid = it['message'].id
-            if mid in ids_set:
-                metrics_to_merge.append({
-                    "views": it.get("views", 0),
-                    "comments": it.get("comments", 0),
-                    "likes": it.get("likes", 0),
-                    "reactions": it.get("reactions", {}) or {},
-                })
-        grouped_views, grouped_comments, grouped_likes, grouped_reactions = _merge_group_metrics(metrics_to_merge)
-
-        # --- Собираем данные для сохранения в Supabase ---
-        post_to_save = {
-            "source_channel": ch,
-            "channel_title": channel_title,
-            "channel_username": channel_username,
-            "original_message_id": root_id,
-            "original_ids": original_ids,
-            "original_date": root_msg.date,
-            "content": caption,
-            "translated_content": None, # Будет заполнено позже
-            "target_lang": None,      # Будет заполнено позже
-            "has_media": bool(media_paths),
-            "media_count": len(media_paths),
-            "is_merged": len(group_members) > 1,
-            "is_top_post": True,
-            "original_views": grouped_views,
-            "original_likes": grouped_likes,
-            "original_comments": grouped_comments,
-            "original_reactions": grouped_reactions,
-        }
-        post_id = save_post(post_to_save, user_id)
-        if post_id:
-            # Пост успешно сохранен
-            all_media_items = []
-            
-            # Загружаем обычные файлы
-            if media_paths:
-                media_items = upload_media_files(media_paths, ch, root_id)
-                if media_items:
-                    all_media_items.extend(media_items)
-            
-            # Добавляем заглушки для больших файлов
-            if oversized_items:
-                from app.supabase_manager import create_oversized_media_placeholders
-                oversized_media = create_oversized_media_placeholders(oversized_items, ch, len(all_media_items))
-                all_media_items.extend(oversized_media)
-            
-            # Сохраняем все медиа
-            if all_media_items:
-                save_post_media(post_id, all_media_items)
-                # Обновляем фактические флаги/счетчики медиа у поста
-                try:
-                    update_post(post_id, {
-                        "has_media": bool(all_media_items),
-                        "media_count": len(all_media_items),
-                    })
-                except Exception:
-                    pass
+    print(f"Final posts to send: {len(units)}")
 
-            # --- ОТПРАВКА В TELEGRAM ОТКЛЮЧЕНА ---
-            print(f"Post album_key={album_key} saved to Supabase (post_id={post_id}). Skipping Telegram send.")
-            
-            # Увеличиваем счетчик только после успешного сохранения
-            increment_processed(user_id)
-        else:
-            print(f"ERROR: Failed to save post album_key={album_key} to Supabase")
+    # Добавим посты канала к общему total (альбом — один пост)
+    units = _track_units(user_id, units, progress)
 
-        # Чистим кэш после обработки
-        for p in media_paths:
-            try: pathlib.Path(p).unlink(missing_ok=True)
-            except Exception as e: print("Cleanup error:", e)
+    await ingest_post_units(client, ch, units, user_id=user_id, is_top_post=True,
+                            channel_title=channel_title, channel_username=channel_username,
+                            scheduler=scheduler, progress=progress, media_mode=media_mode)
 
 # === 2. Основная логика ===
-async def process_channel(client: TelegramClient, ch: str, limit: int, user_id: str):
+WATERMARK_FLUSH_SECONDS = 2.0
+
+async def process_channel(client: TelegramClient, ch: str, limit: int, user_id: str, incremental: bool = False,
+                          scheduler: ChannelScheduler | None = None, progress: ChannelProgress | None = None,
+                          media_mode: str = "full"):
     """
     Обрабатывает канал для конкретного пользователя.
     
@@ -520,147 +968,68 @@ async def process_channel(client: TelegramClient, ch: str, limit: int, user_id:
         ch: Канал для парсинга
         limit: Лимит постов
         user_id: UUID пользователя
+        incremental: Брать только сообщения новее водяного знака канала (min_id)
+        scheduler: Общий планировщик, если каналы обрабатываются параллельно
+        progress: Прогресс канала из прошлой попытки (при переезде на другой аккаунт)
+        media_mode: "full" — качать и брендировать медиа, "lazy" — только заглушки
     """
     print(f"== Channel: {ch} for user {user_id}")
-    entity = await client.get_entity(ch)
-    channel_title, channel_username = await get_channel_info(client, ch)
-    # last_id = get_last_id(user_id, ch) # Проверка на дубликаты отключена
-
-    # Запрашиваем последние сообщения без учета min_id
-    all_msgs = [m async for m in client.iter_messages(entity, limit=limit*4)]  # Берём больше, чтобы не резать альбом
-    if not all_msgs:
-        print(f"No messages found for {ch}")
-        set_total(user_id, 0)
+    governor = telegram_governor(client)
+    channel = await resolve_channel_cached(client, ch)
+    entity = channel.entity
+    channel_title, channel_username = channel.title, channel.username
+    last_id = get_last_id(user_id, ch) if incremental else 0
+
+    # Обходим историю постранично и останавливаемся на limit целых постов (альбом — один пост)
+    if last_id:
+        # Догоняем от водяного знака к новым: самые старые из новых идут первыми
+        print(f"Incremental sync for {ch}: fetching messages after id {last_id}")
+        selected_units = [u async for u in iter_post_units(client, entity, governor, limit, min_id=last_id, reverse=True)]
+    else:
+        selected_units = [u async for u in iter_post_units(client, entity, governor, limit)]
+        selected_units.reverse()  # от старых к новым
+    if not selected_units:
+        print(f"No new messages found for {ch}" if last_id else f"No messages found for {ch}")
         return
 
-    # Формируем единицы постов с учетом альбомов
-    units = group_messages_into_post_units(all_msgs)
-    selected_units = units[:limit]
-    set_total(user_id, len(selected_units))  # считаем посты (альбомы), а не сообщения
-    selected_units.reverse()  # от старых к новым
+    selected_units = _track_units(user_id, selected_units, progress)  # считаем посты (альбомы), а не сообщения
 
-    for group in selected_units:
-        # На каждой итерации даём возможность циклу событий обработать отмену
-        await asyncio.sleep(0)
-        
-        try:
-            # Стабильный порядок внутри группы
-            group = sorted(group, key=lambda x: (x.date, x.id))
-
-            # Определяем root_msg сразу
-            root_msg = group[0]
-            root_id = root_msg.id
-            original_ids = [gm.id for gm in group]
-
-            # Подпись — первая непустая среди группы
-            caption = ""
-            for gm in group:
-                t = (gm.message or "").strip()
-                if t:
-                    caption = t
-                    break
-
-            # Скачиваем и брендируем все медиа из группы
-            media_results = []
-            print(f"Processing post {root_msg.id}: downloading media from {len(group)} message(s)...")
-            for gm in group:
-                results = await download_and_brand(client, gm)
-                media_results.extend(results)
-            
-            # Разделяем обычные файлы и заглушки больших файлов
-            media_paths = []
-            oversized_items = []
-            for item in media_results:
-                if isinstance(item, dict) and item.get('type') == 'oversized':
-                    oversized_items.append(item)
-                else:
-                    media_paths.append(item)
-            
-            print(f"Post {root_msg.id}: collected {len(media_paths)} media file(s), {len(oversized_items)} oversized placeholder(s)")
-
-            # Собираем метрики по группе
-            metrics_to_merge = []
-            for gm in group:
-                v, c, l, rmap = _extract_message_metrics(gm)
-                metrics_to_merge.append({"views": v, "comments": c, "likes": l, "reactions": rmap})
-            grouped_views, grouped_comments, grouped_likes, grouped_reactions = _merge_group_metrics(metrics_to_merge)
-
-            post_to_save = {
-                "source_channel": ch,
-                "channel_title": channel_title,
-                "channel_username": channel_username,
-                "original_message_id": root_id,
-                "original_ids": original_ids, # один или несколько ID альбома
-                "original_date": root_msg.date,
-                "content": caption,
-                "translated_content": None, # Будет заполнено позже
-                "target_lang": None,      # Будет заполнено позже
-                "has_media": bool(media_paths),
-                "media_count": len(media_paths),
-                "is_merged": len(group) > 1,
-                "is_top_post": False,
-                "original_views": grouped_views,
-                "original_likes": grouped_likes,
-                "original_comments": grouped_comments,
-                "original_reactions": grouped_reactions,
-            }
-            
-            # --- Сохраняем пост и медиа ---
-            post_id = save_post(post_to_save, user_id)
-            if post_id:
-                # Пост успешно сохранен
-                all_media_items = []
-                
-                # Загружаем обычные файлы
-                if media_paths:
-                    media_items = upload_media_files(media_paths, ch, root_id)
-                    if media_items:
-                        all_media_items.extend(media_items)
-                
-                # Добавляем заглушки для больших файлов
-                if oversized_items:
-                    from app.supabase_manager import create_oversized_media_placeholders
-                    oversized_media = create_oversized_media_placeholders(oversized_items, ch, len(all_media_items))
-                    all_media_items.extend(oversized_media)
-                
-                # Сохраняем все медиа
-                if all_media_items:
-                    save_post_media(post_id, all_media_items)
-                    # Обновляем фактические флаги/счетчики медиа у поста
-                    try:
-                        update_post(post_id, {
-                            "has_media": bool(all_media_items),
-                            "media_count": len(all_media_items),
-                        })
-                    except Exception:
-                        pass
+    # Водяной знак двигаем только по непрерывному префиксу сохранённых постов,
+    # чтобы упавший пост не оказался «за» отметкой и не потерялся навсегда
+    # Запись в БД — не чаще раза в WATERMARK_FLUSH_SECONDS (в lazy-режиме посты идут сотнями в секунду)
+    watermark = {"blocked": False, "pending": 0, "flushed_at": time.monotonic()}
 
-                # --- ОТПРАВКА В TELEGRAM ОТКЛЮЧЕНА ---
-                print(f"Post (original_id={root_id}) saved to Supabase (post_id={post_id}).")
-            else:
-                print(f"ERROR: Failed to save post (original_id={root_id}) to Supabase")
+    def flush_watermark():
+        if watermark["pending"]:
+            set_last_id(user_id, ch, watermark["pending"])
+            watermark["pending"] = 0
+        watermark["flushed_at"] = time.monotonic()
 
-            # Чистим кэш после обработки
-            for p in media_paths:
-                try: pathlib.Path(p).unlink(missing_ok=True)
-                except Exception as e: print("Cleanup error:", e)
-        
-        except Exception as e:
-            print(f"ERROR processing post: {e}")
-            import traceback
-            traceback.print_exc()
-        
-        finally:
-            # Увеличиваем счетчик ВСЕГДА, даже если была ошибка
-            # Иначе прогресс не синхронизируется с UI
-            increment_processed(user_id)
+    def on_saved(job: PostJob, saved: bool):
+        if not incremental or watermark["blocked"]:
+            return
+        if not saved:
+            watermark["blocked"] = True
+            return
+        watermark["pending"] = max(watermark["pending"], max(gm.id for gm in job.group))
+        if time.monotonic() - watermark["flushed_at"] >= WATERMARK_FLUSH_SECONDS:
+            flush_watermark()
+
+    try:
+        await ingest_post_units(client, ch, selected_units, user_id=user_id, is_top_post=False,
+                                channel_title=channel_title, channel_username=channel_username,
+                                on_saved=on_saved, scheduler=scheduler, progress=progress, media_mode=media_mode)
+    finally:
+        flush_watermark()
 
 async def main(
     limit: int = 100, 
     period_hours: int | None = None, 
     channel_url: str | None = None, 
     is_top_posts: bool = False,
-    user_identifier: str | None = None
+    user_identifier: str | None = None,
+    incremental: bool = False,
+    media_mode: str | None = None,
 ):
     """
     Основная функция, теперь принимает лимит постов, канал, режим парсинга и user_identifier.
@@ -671,6 +1040,8 @@ async def main(
         channel_url: URL канала для парсинга
         is_top_posts: Флаг режима топ-постов
         user_identifier: Идентификатор пользователя для использования его credentials (опционально)
+        incremental: Инкрементальная синхронизация по водяному знаку канала
+        media_mode: "full" или "lazy" (только текст/метрики и заглушки медиа); по умолчанию из конфига
     """
     # Инициализируем Supabase перед началом работы
     try:
@@ -681,36 +1052,50 @@ async def main(
         print("Please check SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY environment variables.")
         raise
     
+    # Каталоги спула создаются здесь, а не при импорте модуля (в веб-процессе — в lifespan)
+    await asyncio.to_thread(SPOOL.open)
+
     # User identifier используется только для tracking, не для credentials
     if not user_identifier:
         user_identifier = "default"
+    media_mode = media_mode or (CFG.get("lazy_media") or {}).get("default_mode", "full")
     
-    print(f"🔑 Loading global Telegram credentials...")
-    from app.supabase_manager import get_global_telegram_credentials
-    from app.crypto_utils import decrypt_string
+    # В веб-процессе клиенты берутся из долгоживущего пула (уже подключены и авторизованы);
+    # при запуске из CLI создаём свой менеджер и отключаем клиентов в конце.
+    from app.client_pool import client_manager, TelegramClientManager
+    owns_manager = not client_manager.running
+    manager = TelegramClientManager() if owns_manager else client_manager
     
-    credentials = get_global_telegram_credentials()
-    if not credentials:
+    # Аккаунты для ингеста: глобальные credentials и помеченные in_ingest_pool
+    print(f"🔑 Loading Telegram credentials...")
+    pool_settings = AccountPoolSettings.from_config(CFG.get("account_pool"))
+    if pool_settings.enabled:
+        credentials_list = list_ingest_telegram_credentials()
+    else:
+        global_credentials = get_global_telegram_credentials()
+        credentials_list = [global_credentials] if global_credentials else []
+    if not credentials_list:
         raise RuntimeError(
             "Global Telegram credentials not found. "
             "Administrator must add credentials in settings."
         )
     
-    api_id = credentials["telegram_api_id"]
-    api_hash = credentials["telegram_api_hash"]
-    session_string = decrypt_string(credentials["telegram_string_session"])
-    print(f"✅ Using global Telegram credentials (API ID: {api_id})")
-    
-    # Создаем клиента с string session из БД
-    client = TelegramClient(StringSession(session_string), api_id, api_hash)
-    
+    pool = None
+    run_stats_start = {}
     try:
-        await client.start()
-        me = await client.get_me()
-        print(f"Started session as {me.username or me.first_name}.")
+        if owns_manager:
+            await manager.start(CFG.get("telegram_pool"))
+        pool = await AccountPool.connect(manager, credentials_list, telegram_governor, pool_settings)
+        run_stats_start = {a.name: a.governor.stats.copy() for a in pool.accounts}
         
         # Определяем список каналов
         channels = [channel_url] if channel_url else CFG["channels"]
+
+        # Каналы обрабатываются параллельно; лимиты Telegram — по аккаунту,
+        # поэтому число каналов и слотов загрузки растёт с числом аккаунтов
+        scheduler_settings = SchedulerSettings.from_config(CFG.get("scheduler")).scaled(len(pool.accounts))
+        scheduler = ChannelScheduler(scheduler_settings, PIPELINE_SETTINGS, disk_path=str(SPOOL.root))
+        set_total(user_identifier, 0)
         
         # Определяем режим парсинга (только по флагу с фронта)
         top_cfg = (CFG.get("top_posts") or {})
@@ -723,17 +1108,36 @@ async def main(
                 # переводим часы в дни с плавающей точкой
                 period_days = max(0.0417, float(period_hours) / 24.0)
             counts = top_cfg.get("top_by") or {"likes": 2, "comments": 2, "views": 2}
-            for ch in channels:
-                await process_top_posts(client, ch, period_days=period_days, top_counts=counts, desired_total=limit, user_id=user_identifier)
+            async def work(account, ch, progress):
+                await process_top_posts(account.client, ch, period_days=period_days, top_counts=counts,
+                                        desired_total=limit, user_id=user_identifier, scheduler=scheduler,
+                                        progress=progress, media_mode=media_mode)
         else:
-            for ch in channels:
-                await process_channel(client, ch, limit=limit, user_id=user_identifier)
+            async def work(account, ch, progress):
+                await process_channel(account.client, ch, limit=limit, user_id=user_identifier,
+                                      incremental=incremental, scheduler=scheduler, progress=progress,
+                                      media_mode=media_mode)
+
+        async def run_channel(ch):
+            async def on_account(account, progress):
+                async with invalidate_on_error(account.client, ch):
+                    await work(account, ch, progress)
+            await pool.run_channel(ch, on_account)
+
+        await scheduler.run(channels, run_channel)
     except asyncio.CancelledError:
         print("Main task was cancelled. Disconnecting...")
         # Это исключение возникнет при нажатии "Остановить"
     finally:
-        if client.is_connected():
-            await client.disconnect()
+        if pool is not None:
+            for account in pool.accounts:
+                run_stats = account.governor.stats.since(run_stats_start.get(account.name, account.governor.stats))
+                print(f"[{account.name}] channels: {account.assigned}, Telegram requests: {run_stats.calls}, "
+                      f"flood waits: {run_stats.flood_waits} ({run_stats.flood_wait_seconds:.1f}s total, "
+                      f"by class: {run_stats.by_class})")
+            pool.release()
+        if owns_manager:
+            await manager.stop()
         print("Done.")
 
 if __name__ == "__main__":
@@ -0,0 +1,56 @@
+# media_dedup.py
+# Ключи для индекса media_objects: один файл Telegram (photo.id / document.id) при
+# тех же настройках брендирования качается, брендируется и выгружается один раз.
+# Второй уровень — sha256 брендированного файла: одинаковые байты из разных
+# сообщений (перезалив того же файла) тоже ложатся в один объект Storage.
+
+import hashlib
+import json
+import os
+from dataclasses import asdict
+from typing import Optional
+
+from app.ffmpeg_runner import FfmpegSettings
+from app.image_branding import ImageEncoding, LogoSpec, ThumbnailSpec
+
+
+def telegram_media_key(message) -> Optional[str]:
+    """photo:<id> / document:<id> — id файла не меняется при репостах и повторных запусках."""
+    media = getattr(message, "media", None)
+    photo = getattr(media, "photo", None)
+    if photo is not None and getattr(photo, "id", None):
+        return f"photo:{photo.id}"
+    document = getattr(media, "document", None)
+    if document is not None and getattr(document, "id", None):
+        return f"document:{document.id}"
+    return None
+
+
+def branding_key(logo: LogoSpec, encoding: ImageEncoding, ffmpeg: FfmpegSettings,
+                 thumbnail: Optional[ThumbnailSpec] = None, poster_at_seconds: Optional[float] = None) -> str:
+    """
+    Отпечаток всего, от чего зависят брендированный файл и его превью: логотип (по mtime/размеру),
+    формат изображений, оба профиля видео с порогами выбора между ними, параметры превью и постера.
+    """
+    try:
+        stat = os.stat(logo.path)
+        logo_state = [stat.st_mtime_ns, stat.st_size]
+    except OSError:
+        logo_state = None
+    data = {
+        "logo": [logo.position, logo.margin, logo_state],
+        "encoding": asdict(encoding),
+        "video": [ffmpeg.brand_videos, asdict(ffmpeg.profile()),
+                  asdict(ffmpeg.profile(ffmpeg.long_video_profile)),
+                  ffmpeg.long_video_seconds, ffmpeg.long_video_bytes],
+        "thumbnail": [asdict(thumbnail) if thumbnail else None, poster_at_seconds],
+    }
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
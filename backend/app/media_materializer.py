@@ -0,0 +1,262 @@
+# media_materializer.py
+# Догрузка отложенных медиа (post_media с is_loaded=false): по запросу из UI
+# и фоновым заполнителем, который тратит не больше заданного бюджета байтов за окно.
+# Сообщение находится по telegram_channel / telegram_message_id, дальше обычный путь
+# download → brand → upload, и строка медиа обновляется на месте. Большие файлы,
+# которые брендирование не меняет, идут в Storage потоком из Telegram (TUS) без спула.
+
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+from app.client_pool import client_manager
+from app.main import (
+    CFG,
+    DOWNLOAD_SETTINGS,
+    SPOOL,
+    brand_media_items,
+    current_branding_key,
+    derive_media_items,
+    download_media_raw,
+    resolve_channel_cached,
+    should_stream_media,
+    store_media_file,
+    stream_media_file,
+    telegram_governor,
+)
+from app.media_dedup import telegram_media_key
+from app.media_probe import probe_message
+from app.supabase_manager import find_media_objects, list_unloaded_media, update_media_item
+
+
+@dataclass
+class LazyMediaSettings:
+    """Параметры отложенной загрузки медиа (секция `lazy_media` в config.yaml)."""
+    default_mode: str = "full"
+    filler_autostart: bool = False
+    byte_budget_bytes: int = 500 * 1024 * 1024
+    budget_window_seconds: float = 3600.0
+    concurrency: int = 2
+    batch: int = 20
+    idle_seconds: float = 60.0
+
+    @classmethod
+    def from_config(cls, cfg: Optional[Dict[str, Any]]) -> "LazyMediaSettings":
+        cfg = cfg or {}
+        defaults = cls()
+        mb = 1024 * 1024
+        mode = str(cfg.get("default_mode", defaults.default_mode))
+        return cls(
+            default_mode=mode if mode in ("full", "lazy") else defaults.default_mode,
+            filler_autostart=bool(cfg.get("filler_autostart", defaults.filler_autostart)),
+            byte_budget_bytes=int(float(cfg.get("byte_budget_mb", defaults.byte_budget_bytes / mb)) * mb),
+            budget_window_seconds=float(cfg.get("budget_window_seconds", defaults.budget_window_seconds)),
+            concurrency=max(1, int(cfg.get("concurrency", defaults.concurrency))),
+            batch=max(1, int(cfg.get("batch", defaults.batch))),
+            idle_seconds=float(cfg.get("idle_seconds", defaults.idle_seconds)),
+        )
+
+
+# Одна и та же заглушка не качается дважды (клик в UI во время работы заполнителя)
+_inflight: Dict[str, asyncio.Future] = {}
+
+
+async def resolve_media_message(client, media_item: Dict[str, Any]):
+    """Сообщение Telegram строки post_media (по telegram_channel / telegram_message_id)."""
+    channel = media_item.get("telegram_channel")
+    message_id = media_item.get("telegram_message_id")
+    if not channel or not message_id:
+        raise ValueError("Missing telegram info")
+
+    governor = telegram_governor(client)
+    entity = (await resolve_channel_cached(client, channel)).entity
+    message = await governor.call("messages", lambda: client.get_messages(entity, ids=int(message_id)))
+    if not message or not message.media:
+        raise LookupError("Message not found in Telegram")
+    return message
+
+
+async def _materialize(client, media_item: Dict[str, Any], max_size: int) -> Dict[str, Any]:
+    message = await resolve_media_message(client, media_item)
+
+    bkey = current_branding_key()
+    key = telegram_media_key(message)
+    known = await asyncio.to_thread(find_media_objects, [key], bkey) if key else {}
+    if key in known:
+        # Файл уже выгружен для другого поста — только ссылаемся на него
+        return await _apply_loaded(media_item, known[key])
+
+    if key and should_stream_media(message):
+        limit = DOWNLOAD_SETTINGS.max_file_bytes if max_size is None else max_size
+        size = probe_message(message).size
+        if limit and size > limit:
+            raise ValueError(f"Media is larger than the download limit ({size / 1024 / 1024:.1f} MB)")
+        item = await stream_media_file(client, message, bkey)
+        if not item:
+            raise RuntimeError("Failed to upload media to storage")
+        return await _apply_loaded(media_item, item)
+
+    # Все временные файлы (сырой, брендированный, превью) — в своём каталоге спула
+    with SPOOL.job_dir(f"media{message.id}") as job_dir:
+        raw = await download_media_raw(client, message, max_size=max_size, dest_dir=job_dir)
+        if isinstance(raw, dict):
+            raise ValueError(f"Media is larger than the download limit ({raw.get('size', 0) / 1024 / 1024:.1f} MB)")
+        if not raw:
+            raise RuntimeError("Failed to download media")
+        processed_path = (await brand_media_items([(message, raw)]))[0]
+        if not processed_path:
+            raise RuntimeError("Failed to process media")
+        derived = (await derive_media_items([(message, processed_path)]))[0]
+        item = await store_media_file(message, processed_path, bkey, derived)
+        if not item:
+            raise RuntimeError("Failed to upload media to storage")
+        return await _apply_loaded(media_item, item)
+
+
+async def _apply_loaded(media_item: Dict[str, Any], item: Dict[str, Any]) -> Dict[str, Any]:
+    updates = {
+        "url": item.get("url"),
+        "storage_path": item.get("storage_path"),
+        "mime_type": item.get("mime_type"),
+        "media_type": item.get("media_type"),
+        "width": item.get("width"),
+        "height": item.get("height"),
+        "duration": item.get("duration"),
+        "thumbnail_url": item.get("thumbnail_url"),
+        "thumbnail_path": item.get("thumbnail_path"),
+        "is_loaded": True,
+    }
+    await asyncio.to_thread(update_media_item, media_item["id"], updates)
+    return {**media_item, **updates}
+
+
+async def materialize_media_item(client, media_item: Dict[str, Any], max_size: int = 0) -> Dict[str, Any]:
+    """
+    Загружает медиа заглушки и помечает строку is_loaded=true. Возвращает обновлённую строку.
+    max_size=0 — без ограничения размера (ручная загрузка); иначе политика download_media_raw.
+    """
+    if media_item.get("is_loaded"):
+        return media_item
+    media_id = media_item["id"]
+    pending = _inflight.get(media_id)
+    if pending is not None:
+        return await asyncio.shield(pending)
+    future = asyncio.get_running_loop().create_future()
+    _inflight[media_id] = future
+    try:
+        result = await _materialize(client, media_item, max_size)
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        # Исключение уже отдано вызывающему; ожидающим — через future
+        future.exception()
+        raise
+    finally:
+        _inflight.pop(media_id, None)
+
+
+class MediaFiller:
+    """
+    Фоновая догрузка отложенных медиа (самые свежие первыми).
+    За окно budget_window_seconds скачивается не больше byte_budget_bytes;
+    когда бюджет исчерпан или заглушек нет — заполнитель ждёт.
+    Медиа выше политики download.max_file_mb (oversized) он не трогает.
+    """
+
+    def __init__(self):
+        self.settings = LazyMediaSettings.from_config(CFG.get("lazy_media"))
+        self.running = False
+        self._task: Optional[asyncio.Task] = None
+        self._client = None
+        self._window_started = time.monotonic()
+        self._window_bytes = 0
+        self._failed: set = set()
+        self.loaded = 0
+        self.loaded_bytes = 0
+        self.errors = 0
+        self.skipped = 0
+
+    def start(self, client) -> None:
+        if self.running:
+            return
+        self._client = client
+        # Заполнитель держит клиента без get() — закрепляем его в пуле от закрытия по простою
+        client_manager.pin(client)
+        self.running = True
+        self._task = asyncio.create_task(self._loop())
+        print("Media filler started.")
+
+    async def stop(self) -> None:
+        if not self.running:
+            return
+        self.running = False
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        client_manager.unpin(self._client)
+        print("Media filler stopped.")
+
+    def _budget_left(self) -> int:
+        if time.monotonic() - self._window_started >= self.settings.budget_window_seconds:
+            self._window_started = time.monotonic()
+            self._window_bytes = 0
+        return self.settings.byte_budget_bytes - self._window_bytes
+
+    async def _load(self, item: Dict[str, Any], sem: asyncio.Semaphore) -> None:
+        async with sem:
+            try:
+                await materialize_media_item(self._client, item, max_size=None)
+                self.loaded += 1
+                self.loaded_bytes += int(item.get("file_size_bytes") or 0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Не повторяем ту же заглушку до перезапуска заполнителя
+                self._failed.add(item["id"])
+                self.errors += 1
+                print(f"Media filler: failed to load media {item['id']}: {e}")
+
+    async def _loop(self) -> None:
+        sem = asyncio.Semaphore(self.settings.concurrency)
+        while True:
+            left = self._budget_left()
+            items = []
+            if left > 0:
+                rows = await asyncio.to_thread(list_unloaded_media, self.settings.batch + len(self._failed))
+                for row in rows:
+                    if row["id"] in self._failed or len(items) >= self.settings.batch:
+                        continue
+                    size = int(row.get("file_size_bytes") or 0)
+                    if size > self.settings.byte_budget_bytes:
+                        # В окно не поместится никогда — иначе заполнитель встанет на этой строке навсегда
+                        self._failed.add(row["id"])
+                        self.skipped += 1
+                        print(f"Media filler: media {row['id']} ({size / 1024 / 1024:.1f} MB) exceeds the byte budget, skipped")
+                        continue
+                    if size > left:
+                        break
+                    left -= size
+                    self._window_bytes += size
+                    items.append(row)
+            if not items:
+                await asyncio.sleep(self.settings.idle_seconds)
+                continue
+            await asyncio.gather(*(self._load(item, sem) for item in items))
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "loaded": self.loaded,
+            "loaded_bytes": self.loaded_bytes,
+            "errors": self.errors,
+            "skipped": self.skipped,
+            "window_bytes": self._window_bytes,
+            "byte_budget_bytes": self.settings.byte_budget_bytes,
+            "budget_window_seconds": self.settings.budget_window_seconds,
+        }
+
+
+media_filler = MediaFiller()
@@ -0,0 +1,111 @@
+# media_probe.py
+# Метаданные медиа из самого сообщения Telegram, до загрузки хоть одного байта:
+# PhotoSize (w/h/размер), DocumentAttributeVideo (w/h/длительность/supports_streaming),
+# DocumentAttributeImageSize, mime_type и size документа. По ним конвейер решает,
+# качать ли файл (лимит размера, режим lazy) и как его брендировать, а строки post_media
+# и заглушки сразу получают размеры для разметки в UI.
+
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from telethon.tl.types import (
+    DocumentAttributeAudio,
+    DocumentAttributeFilename,
+    DocumentAttributeImageSize,
+    DocumentAttributeVideo,
+    PhotoCachedSize,
+    PhotoSize,
+    PhotoSizeProgressive,
+)
+
+
+@dataclass(frozen=True)
+class MediaProbe:
+    """Что известно о медиа сообщения без загрузки."""
+    kind: str                            # image / video / other — маршрут обработки
+    media_type: str                      # image / gif / video / other — как в post_media.media_type
+    mime_type: Optional[str] = None
+    size: int = 0
+    width: Optional[int] = None
+    height: Optional[int] = None
+    duration: Optional[float] = None
+    supports_streaming: bool = False
+    file_name: Optional[str] = None
+
+
+def _photo_size_bytes(size: Any) -> int:
+    if isinstance(size, PhotoSizeProgressive):
+        return max(size.sizes or [0])
+    if isinstance(size, PhotoCachedSize):
+        return len(size.bytes or b"")
+    if isinstance(size, PhotoSize):
+        return int(size.size or 0)
+    return 0
+
+
+def _probe_photo(photo: Any) -> MediaProbe:
+    # Telethon качает самый большой вариант — его размеры и берём
+    sizes = [s for s in getattr(photo, "sizes", None) or []
+             if isinstance(s, (PhotoSize, PhotoSizeProgressive, PhotoCachedSize))]
+    best = max(sizes, key=lambda s: (s.w * s.h, _photo_size_bytes(s)), default=None)
+    return MediaProbe(
+        kind="image",
+        media_type="image",
+        mime_type="image/jpeg",
+        size=max((_photo_size_bytes(s) for s in sizes), default=0),
+        width=best.w if best else None,
+        height=best.h if best else None,
+    )
+
+
+def _probe_document(document: Any) -> MediaProbe:
+    mime = getattr(document, "mime_type", None) or ""
+    width = height = duration = file_name = None
+    streaming = False
+    for attr in getattr(document, "attributes", None) or []:
+        if isinstance(attr, DocumentAttributeVideo):
+            width, height = attr.w or None, attr.h or None
+            duration = float(attr.duration or 0) or None
+            streaming = bool(attr.supports_streaming)
+        elif isinstance(attr, DocumentAttributeImageSize) and width is None:
+            width, height = attr.w or None, attr.h or None
+        elif isinstance(attr, DocumentAttributeAudio):
+            duration = float(attr.duration or 0) or None
+        elif isinstance(attr, DocumentAttributeFilename):
+            file_name = attr.file_name
+
+    if mime.startswith("video/"):
+        # «GIF» в Telegram — беззвучный video/mp4: брендируется и хранится как видео
+        kind, media_type = "video", "video"
+    elif mime == "image/gif":
+        kind, media_type = "image", "gif"
+    elif mime.startswith("image/"):
+        kind, media_type = "image", "image"
+    else:
+        kind, media_type = "other", "other"
+    return MediaProbe(
+        kind=kind,
+        media_type=media_type,
+        mime_type=mime or None,
+        size=int(getattr(document, "size", 0) or 0),
+        width=width,
+        height=height,
+        duration=duration,
+        supports_streaming=streaming,
+        file_name=file_name,
+    )
+
+
+def probe_message(message: Any) -> Optional[MediaProbe]:
+    """
+    Метаданные фото/документа сообщения без обращений к сети.
+    None — у сообщения нет медиа-файла (опросы, геоточки, превью ссылок и т.п.), качать нечего.
+    """
+    media = getattr(message, "media", None)
+    photo = getattr(media, "photo", None)
+    if photo is not None:
+        return _probe_photo(photo)
+    document = getattr(media, "document", None)
+    if document is not None:
+        return _probe_document(document)
+    return None
@@ -0,0 +1,259 @@
+# media_stream.py
+# Воспроизведение отложенных и слишком больших медиа прямо из Telegram, без загрузки
+# файла целиком: HTTP Range переводится в номера блоков GetFile (по chunk_bytes,
+# степень двойки от 4 до 512 КБ), блоки живут в общем LRU-кэше — перемотка назад и повторные
+# запросы браузера не ходят в Telegram, а следующие блоки подкачиваются заранее.
+# Выгрузка файла в Storage (materialize) может идти в фоне, пока пользователь смотрит.
+
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+
+from telethon.errors import FileReferenceExpiredError
+
+from app.chunked_download import MAX_PART_SIZE, part_size
+from app.main import CFG, telegram_governor
+from app.media_materializer import materialize_media_item, resolve_media_message
+from app.media_probe import probe_message
+
+MB = 1024 * 1024
+
+
+@dataclass
+class MediaStreamSettings:
+    """Параметры потокового воспроизведения (секция `media_stream` в config.yaml)."""
+    chunk_bytes: int = MAX_PART_SIZE          # один GetFile; степень двойки от 4 до 512 КБ
+    cache_bytes: int = 64 * MB
+    prefetch_chunks: int = 4
+    chunk_timeout: float = 30.0
+    source_ttl_seconds: float = 600.0         # сколько помнить сообщение (file_reference) между запросами
+    materialize_in_background: bool = True
+    materialize_delay_seconds: float = 30.0   # сначала воспроизведение, потом выгрузка в Storage
+
+    @classmethod
+    def from_config(cls, cfg: Optional[Dict[str, Any]]) -> "MediaStreamSettings":
+        cfg = cfg or {}
+        defaults = cls()
+        return cls(
+            chunk_bytes=part_size(float(cfg.get("chunk_kb", defaults.chunk_bytes // 1024))),
+            cache_bytes=int(float(cfg.get("cache_mb", defaults.cache_bytes / MB)) * MB),
+            prefetch_chunks=max(0, int(cfg.get("prefetch_chunks", defaults.prefetch_chunks))),
+            chunk_timeout=float(cfg.get("chunk_timeout", defaults.chunk_timeout)),
+            source_ttl_seconds=float(cfg.get("source_ttl_seconds", defaults.source_ttl_seconds)),
+            materialize_in_background=bool(cfg.get("materialize_in_background", defaults.materialize_in_background)),
+            materialize_delay_seconds=float(cfg.get("materialize_delay_seconds", defaults.materialize_delay_seconds)),
+        )
+
+
+class RangeNotSatisfiable(ValueError):
+    """Запрошенный диапазон за пределами файла (HTTP 416)."""
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Заголовок Range → (start, end) включительно; None — отдавать файл целиком.
+    Поддерживается один диапазон: bytes=a-b, bytes=a-, bytes=-n.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            length = int(last)
+            if length <= 0:
+                raise RangeNotSatisfiable(header)
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        raise RangeNotSatisfiable(header)
+    return start, min(end, size - 1)
+
+
+@dataclass
+class StreamSource:
+    """Документ сообщения, из которого читаются блоки."""
+    media_id: str
+    client: Any
+    media_item: Dict[str, Any]
+    document: Any
+    size: int
+    mime_type: str
+    resolved_at: float = field(default_factory=time.monotonic)
+
+
+class MediaStreamer:
+    """
+    Отдаёт байты документа по диапазонам. Блок chunk_bytes скачивается одним GetFile
+    (через регулятор запросов), одновременные запросы одного блока ждут одну загрузку.
+    """
+
+    def __init__(self):
+        self.settings = MediaStreamSettings.from_config(CFG.get("media_stream"))
+        self._cache: "OrderedDict[Tuple[int, int], bytes]" = OrderedDict()
+        self._cache_size = 0
+        self._inflight: Dict[Tuple[int, int], asyncio.Task] = {}
+        self._sources: Dict[str, StreamSource] = {}
+        self._materializing: Dict[str, asyncio.Task] = {}
+        self.streams = 0
+        self.served_bytes = 0
+        self.fetched_chunks = 0
+        self.cache_hits = 0
+        self.first_byte_seconds = 0.0
+
+    async def open(self, client, media_item: Dict[str, Any]) -> StreamSource:
+        """Источник для строки post_media; сообщение запоминается на source_ttl_seconds."""
+        media_id = media_item["id"]
+        now = time.monotonic()
+        for key in [k for k, s in self._sources.items() if now - s.resolved_at >= self.settings.source_ttl_seconds]:
+            del self._sources[key]
+        source = self._sources.get(media_id)
+        if source is not None:
+            return source
+        message = await resolve_media_message(client, media_item)
+        document = getattr(message.media, "document", None)
+        if document is None:
+            raise ValueError("Streaming is supported for documents (video, files) only")
+        probe = probe_message(message)
+        source = StreamSource(media_id, client, media_item, document, probe.size,
+                              probe.mime_type or "application/octet-stream")
+        self._sources[media_id] = source
+        return source
+
+    async def _refresh(self, source: StreamSource) -> None:
+        # file_reference истёк — берём сообщение заново
+        message = await resolve_media_message(source.client, source.media_item)
+        source.document = message.media.document
+        source.resolved_at = time.monotonic()
+
+    async def _fetch(self, source: StreamSource, index: int) -> bytes:
+        chunk = self.settings.chunk_bytes
+        governor = telegram_governor(source.client)
+
+        async def request() -> bytes:
+            stream = source.client.iter_download(source.document, offset=index * chunk, limit=1,
+                                                 request_size=chunk, file_size=source.size)
+            try:
+                async for data in stream:
+                    return data
+                return b""
+            finally:
+                # Соединение с другим DC (exported sender) возвращается в пул
+                await stream.close()
+
+        try:
+            data = await governor.call("download", lambda: asyncio.wait_for(request(), self.settings.chunk_timeout))
+        except FileReferenceExpiredError:
+            await self._refresh(source)
+            data = await governor.call("download", lambda: asyncio.wait_for(request(), self.settings.chunk_timeout))
+        self.fetched_chunks += 1
+        return data[:source.size - index * chunk]
+
+    def _store(self, key: Tuple[int, int], data: bytes) -> None:
+        self._cache[key] = data
+        self._cache_size += len(data)
+        while self._cache_size > self.settings.cache_bytes and len(self._cache) > 1:
+            _, old = self._cache.popitem(last=False)
+            self._cache_size -= len(old)
+
+    def _chunk_task(self, source: StreamSource, index: int) -> Optional[asyncio.Task]:
+        key = (source.document.id, index)
+        if key in self._cache:
+            return None
+        task = self._inflight.get(key)
+        if task is None:
+            async def load() -> bytes:
+                try:
+                    data = await self._fetch(source, index)
+                    self._store(key, data)
+                    return data
+                finally:
+                    self._inflight.pop(key, None)
+            task = asyncio.create_task(load())
+            # Предзагрузка, которую никто не дождался, не должна ругаться в лог
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._inflight[key] = task
+        return task
+
+    async def _chunk(self, source: StreamSource, index: int) -> bytes:
+        key = (source.document.id, index)
+        data = self._cache.get(key)
+        if data is not None:
+            self._cache.move_to_end(key)
+            self.cache_hits += 1
+        else:
+            data = await asyncio.shield(self._chunk_task(source, index))
+        # Следующие блоки — заранее, пока клиент проигрывает текущий
+        last = (source.size - 1) // self.settings.chunk_bytes
+        for ahead in range(index + 1, min(last, index + self.settings.prefetch_chunks) + 1):
+            self._chunk_task(source, ahead)
+        return data
+
+    async def iter_range(self, source: StreamSource, start: int, end: int) -> AsyncIterator[bytes]:
+        """Байты [start, end] документа блоками кэша."""
+        chunk = self.settings.chunk_bytes
+        started = time.monotonic()
+        self.streams += 1
+        position = start
+        while position <= end:
+            index = position // chunk
+            data = await self._chunk(source, index)
+            if not data:
+                raise IOError(f"Telegram returned no data at offset {index * chunk} of media {source.media_id}")
+            piece = data[position - index * chunk:end - index * chunk + 1]
+            if position == start:
+                self.first_byte_seconds = time.monotonic() - started
+            position += len(piece)
+            self.served_bytes += len(piece)
+            yield piece
+
+    def schedule_materialize(self, client, media_item: Dict[str, Any]) -> None:
+        """Фоновая выгрузка файла в Storage после materialize_delay_seconds (один раз на медиа)."""
+        media_id = media_item["id"]
+        if not self.settings.materialize_in_background or media_id in self._materializing:
+            return
+
+        async def run() -> None:
+            try:
+                await asyncio.sleep(self.settings.materialize_delay_seconds)
+                await materialize_media_item(client, media_item, max_size=0)
+                self._sources.pop(media_id, None)
+                print(f"Media stream: media {media_id} materialized to storage in background")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Media stream: background materialization of {media_id} failed: {e}")
+            finally:
+                self._materializing.pop(media_id, None)
+
+        self._materializing[media_id] = asyncio.create_task(run())
+
+    async def stop(self) -> None:
+        """Отменяет фоновые выгрузки и предзагрузку (остановка сервера)."""
+        tasks = list(self._materializing.values()) + list(self._inflight.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "streams": self.streams,
+            "served_bytes": self.served_bytes,
+            "fetched_chunks": self.fetched_chunks,
+            "cache_hits": self.cache_hits,
+            "cache_bytes": self._cache_size,
+            "cache_limit_bytes": self.settings.cache_bytes,
+            "inflight_chunks": len(self._inflight),
+            "materializing": len(self._materializing),
+            "last_first_byte_seconds": round(self.first_byte_seconds, 3),
+        }
+
+
+media_streamer = MediaStreamer()
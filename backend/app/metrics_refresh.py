@@ -0,0 +1,145 @@
+# metrics_refresh.py
+# Обновление метрик уже сохранённых постов (просмотры, комментарии, реакции) без повторного
+# ингеста: посты группируются по каналу, сообщения перечитываются пачками по 100 id
+# одним GetMessages, в БД пакетно пишутся только изменившиеся строки.
+# Правленые сообщения (edit_date новее сохранённой) заодно обновляют content.
+
+import asyncio
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from app.account_pool import SESSION_ERRORS
+from app.main import (
+    _extract_message_metrics,
+    _group_caption,
+    _group_edit_date,
+    _merge_group_metrics,
+    resolve_channel_cached,
+    telegram_governor,
+)
+from app.supabase_manager import apply_post_metrics, list_posts_for_refresh
+
+# Telegram отдаёт не больше 100 сообщений на один GetMessages(ids=...)
+MESSAGES_PER_CALL = 100
+
+
+@dataclass
+class RefreshStats:
+    """Итог обновления метрик."""
+    posts: int = 0
+    channels: int = 0
+    api_calls: int = 0
+    changed: int = 0
+    content_updated: int = 0
+    missing: int = 0
+    failed_channels: List[str] = field(default_factory=list)
+    seconds: float = 0.0
+
+
+def _parse_datetime(value: Any) -> Optional[datetime]:
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        dt = value
+    else:
+        dt = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+def _post_message_ids(post: Dict[str, Any]) -> List[int]:
+    ids = post.get("original_ids") or [post.get("original_message_id")]
+    return [int(i) for i in ids if i is not None]
+
+
+def diff_post(post: Dict[str, Any], group: list, complete: bool) -> Optional[Dict[str, Any]]:
+    """
+    Сравнивает сохранённый пост со свежими сообщениями его единицы.
+    Возвращает {"id": ..., <только изменившиеся поля>} или None.
+    complete=False (часть альбома удалена) — текст не трогаем, подпись могла быть у удалённого.
+    """
+    merged = _merge_group_metrics([
+        dict(zip(("views", "comments", "likes", "reactions"), _extract_message_metrics(gm)))
+        for gm in group
+    ])
+    views, comments, likes, reactions = merged
+    changes: Dict[str, Any] = {}
+    for column, value in (("original_views", views), ("original_comments", comments), ("original_likes", likes)):
+        if int(post.get(column) or 0) != value:
+            changes[column] = value
+    if (post.get("original_reactions") or {}) != reactions:
+        changes["original_reactions"] = reactions
+
+    edit_date = _group_edit_date(group)
+    stored_edit = _parse_datetime(post.get("original_edit_date"))
+    if complete and edit_date and (stored_edit is None or _parse_datetime(edit_date) > stored_edit):
+        changes["original_edit_date"] = edit_date
+        caption = _group_caption(group)
+        if caption != (post.get("content") or ""):
+            changes["content"] = caption
+    return {"id": post["id"], **changes} if changes else None
+
+
+async def _refresh_channel(client, channel: str, posts: List[Dict[str, Any]], stats: RefreshStats) -> List[Dict[str, Any]]:
+    governor = telegram_governor(client)
+    entity = (await resolve_channel_cached(client, channel)).entity
+    ids = sorted({mid for post in posts for mid in _post_message_ids(post)})
+    by_id: Dict[int, Any] = {}
+    for i in range(0, len(ids), MESSAGES_PER_CALL):
+        chunk = ids[i:i + MESSAGES_PER_CALL]
+        messages = await governor.call("messages", lambda: client.get_messages(entity, ids=chunk))
+        stats.api_calls += 1
+        for msg in messages or []:
+            if msg is not None:
+                by_id[msg.id] = msg
+
+    rows = []
+    for post in posts:
+        wanted = _post_message_ids(post)
+        group = [by_id[mid] for mid in wanted if mid in by_id]
+        if not group:
+            # Сообщение удалено из канала — оставляем последние известные метрики
+            stats.missing += 1
+            continue
+        row = diff_post(post, group, complete=len(group) == len(wanted))
+        if row:
+            rows.append(row)
+    return rows
+
+
+async def refresh_post_metrics(client, user_id: str, channel: Optional[str] = None,
+                               limit: Optional[int] = None) -> RefreshStats:
+    """
+    Обновляет метрики сохранённых постов пользователя (по всем каналам или одному).
+    Ошибка отдельного канала не прерывает остальные; ошибка сессии — прерывает.
+    """
+    stats = RefreshStats()
+    started = time.monotonic()
+    posts = await asyncio.to_thread(list_posts_for_refresh, user_id, channel, limit)
+    stats.posts = len(posts)
+    by_channel: Dict[str, List[Dict[str, Any]]] = {}
+    for post in posts:
+        if post.get("source_channel"):
+            by_channel.setdefault(post["source_channel"], []).append(post)
+    stats.channels = len(by_channel)
+
+    for ch, items in by_channel.items():
+        try:
+            rows = await _refresh_channel(client, ch, items, stats)
+        except SESSION_ERRORS:
+            raise
+        except Exception as e:
+            print(f"Metrics refresh: channel {ch} failed: {e}")
+            stats.failed_channels.append(ch)
+            continue
+        updated = await asyncio.to_thread(apply_post_metrics, rows) if rows else 0
+        # Считаем только то, что функция в БД действительно обновила (ошибка пакета — 0)
+        stats.changed += updated
+        stats.content_updated += min(updated, sum(1 for r in rows if "content" in r))
+        print(f"Metrics refresh: {ch}: {len(rows)}/{len(items)} post(s) changed, {updated} updated")
+
+    stats.seconds = time.monotonic() - started
+    print(f"Metrics refresh for user {user_id}: {stats.changed}/{stats.posts} posts changed "
+          f"in {stats.channels} channel(s), {stats.api_calls} GetMessages call(s), {stats.seconds:.1f}s")
+    return stats
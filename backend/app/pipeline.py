@@ -0,0 +1,360 @@
+# pipeline.py
+# Поэтапный конвейер обработки постов: fetch → download → brand → upload → persist.
+# Стадии связаны ограниченными очередями asyncio, у каждой стадии свой пул воркеров.
+# Финальная стадия (persist) получает посты строго в исходном порядке.
+
+import asyncio
+import inspect
+import shutil
+import time
+import traceback
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterable, Awaitable, Callable, Dict, Iterable, Optional, Tuple, Type, Union
+
+MB = 1024 * 1024
+
+# Маркер завершения для воркеров
+_STOP = object()
+
+
+@dataclass
+class PipelineSettings:
+    """Параметры конвейера (секция `pipeline` в config.yaml)."""
+    download_workers: int = 3
+    brand_workers: int = 2
+    upload_workers: int = 3
+    queue_size: int = 8
+    max_inflight_bytes: int = 1024 * MB
+    min_free_disk_bytes: int = 512 * MB
+
+    @classmethod
+    def from_config(cls, cfg: Optional[Dict[str, Any]]) -> "PipelineSettings":
+        cfg = cfg or {}
+        defaults = cls()
+        return cls(
+            download_workers=max(1, int(cfg.get("download_workers", defaults.download_workers))),
+            brand_workers=max(1, int(cfg.get("brand_workers", defaults.brand_workers))),
+            upload_workers=max(1, int(cfg.get("upload_workers", defaults.upload_workers))),
+            queue_size=max(1, int(cfg.get("queue_size", defaults.queue_size))),
+            max_inflight_bytes=int(float(cfg.get("max_inflight_mb", defaults.max_inflight_bytes / MB)) * MB),
+            min_free_disk_bytes=int(float(cfg.get("min_free_disk_mb", defaults.min_free_disk_bytes / MB)) * MB),
+        )
+
+
+class ByteBudget:
+    """
+    Бюджет байтов «в полёте» (память + временные файлы).
+    acquire() ждёт, пока не освободится место в лимите и на диске.
+    Единичный элемент больше лимита пропускается, когда больше ничего не занято,
+    иначе он бы ждал вечно.
+    """
+
+    def __init__(self, limit_bytes: int, min_free_disk_bytes: int = 0,
+                 disk_path: Optional[str] = None, poll_interval: float = 1.0):
+        self.limit_bytes = max(0, int(limit_bytes))
+        self.min_free_disk_bytes = max(0, int(min_free_disk_bytes))
+        self.disk_path = disk_path
+        self.poll_interval = poll_interval
+        self._in_use = 0
+        self._cond = asyncio.Condition()
+
+    @property
+    def in_use(self) -> int:
+        return self._in_use
+
+    def _disk_has_room(self, nbytes: int) -> bool:
+        if not self.min_free_disk_bytes or not self.disk_path:
+            return True
+        try:
+            free = shutil.disk_usage(self.disk_path).free
+        except OSError:
+            return True
+        return free - nbytes >= self.min_free_disk_bytes
+
+    def _can_take(self, nbytes: int) -> bool:
+        if self._in_use == 0:
+            return True
+        if self.limit_bytes and self._in_use + nbytes > self.limit_bytes:
+            return False
+        return self._disk_has_room(nbytes)
+
+    async def acquire(self, nbytes: int) -> None:
+        nbytes = max(0, int(nbytes))
+        async with self._cond:
+            while not self._can_take(nbytes):
+                # Место на диске освобождается не только через release(), поэтому опрашиваем периодически
+                try:
+                    await asyncio.wait_for(self._cond.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._in_use += nbytes
+
+    async def release(self, nbytes: int) -> None:
+        nbytes = max(0, int(nbytes))
+        async with self._cond:
+            self._in_use = max(0, self._in_use - nbytes)
+            self._cond.notify_all()
+
+
+class FairLimiter:
+    """
+    Общий на несколько каналов лимит параллельных операций со справедливой очередью:
+    свободный слот выдаётся ожидающим ключам (каналам) по кругу, поэтому большой канал
+    не вытесняет маленькие.
+    """
+
+    def __init__(self, slots: int):
+        self.slots = max(1, int(slots))
+        self._busy = 0
+        self._waiters: "OrderedDict[str, deque]" = OrderedDict()
+
+    @property
+    def busy(self) -> int:
+        return self._busy
+
+    @asynccontextmanager
+    async def slot(self, key: str):
+        await self._acquire(key)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, key: str) -> None:
+        if self._busy < self.slots and not self._waiters:
+            self._busy += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(key, deque()).append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # Слот уже выдан, но задачу отменили — возвращаем его
+                self._release()
+            else:
+                waiters = self._waiters.get(key)
+                if waiters and fut in waiters:
+                    waiters.remove(fut)
+                    if not waiters:
+                        del self._waiters[key]
+            raise
+
+    def _release(self) -> None:
+        self._busy -= 1
+        while self._busy < self.slots and self._waiters:
+            key, waiters = next(iter(self._waiters.items()))
+            fut = waiters.popleft()
+            if waiters:
+                self._waiters.move_to_end(key)
+            else:
+                del self._waiters[key]
+            if fut.done():
+                continue
+            self._busy += 1
+            fut.set_result(None)
+
+
+@dataclass
+class Stage:
+    """Стадия конвейера: асинхронный обработчик и число параллельных воркеров."""
+    name: str
+    handler: Callable[[Any], Awaitable[None]]
+    workers: int = 1
+
+
+@dataclass
+class PipelineStats:
+    total: int = 0
+    succeeded: int = 0
+    failed: int = 0
+    stage_seconds: Dict[str, float] = field(default_factory=dict)
+    wall_seconds: float = 0.0
+
+
+@dataclass
+class _Job:
+    seq: int
+    payload: Any
+    reserved: int = 0
+    error: Optional[BaseException] = None
+
+
+async def _maybe_await(value):
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+async def _aiter(source: Union[AsyncIterable[Any], Iterable[Any]]):
+    if hasattr(source, "__aiter__"):
+        async for item in source:
+            yield item
+    else:
+        for item in source:
+            yield item
+
+
+class StagedPipeline:
+    """
+    Конвейер из последовательных стадий, соединённых ограниченными очередями.
+
+    - source: итерируемый (или async-итерируемый) источник элементов — стадия fetch;
+    - stages: промежуточные стадии, каждая со своим числом воркеров;
+    - sink: финальная стадия, вызывается строго в порядке источника как sink(payload, error);
+    - estimate: оценка байтов для элемента (для ByteBudget), вызывается до постановки в очередь;
+    - cleanup: вызывается для незавершённых элементов при отмене.
+
+    Ошибка в стадии не останавливает конвейер: элемент проходит дальше с error,
+    последующие стадии его пропускают, а sink получает ошибку и решает сам.
+    Исключения из fatal (например, отозванная сессия) останавливают весь конвейер
+    и пробрасываются из run() — незавершённые элементы уходят в cleanup.
+    """
+
+    def __init__(
+        self,
+        stages: list[Stage],
+        sink: Callable[[Any, Optional[BaseException]], Awaitable[None]],
+        *,
+        queue_size: int = 8,
+        budget: Optional[ByteBudget] = None,
+        estimate: Optional[Callable[[Any], Union[int, Awaitable[int]]]] = None,
+        cleanup: Optional[Callable[[Any], None]] = None,
+        fatal: Tuple[Type[BaseException], ...] = (),
+    ):
+        self.stages = stages
+        self.sink = sink
+        self.queue_size = max(1, int(queue_size))
+        self.budget = budget
+        self.estimate = estimate
+        self.cleanup = cleanup
+        self.fatal = tuple(fatal)
+        self.stats = PipelineStats(stage_seconds={s.name: 0.0 for s in stages})
+        self._inflight: Dict[int, _Job] = {}
+
+    async def _produce(self, source, out: asyncio.Queue) -> None:
+        seq = 0
+        async for payload in _aiter(source):
+            reserved = 0
+            if self.budget is not None and self.estimate is not None:
+                try:
+                    reserved = int(await _maybe_await(self.estimate(payload)) or 0)
+                except Exception as e:
+                    print(f"Pipeline: size estimate failed: {e}")
+                    reserved = 0
+                # Резервируем в порядке источника, поэтому младший элемент никогда не ждёт старших
+                await self.budget.acquire(reserved)
+            job = _Job(seq=seq, payload=payload, reserved=reserved)
+            self._inflight[seq] = job
+            await out.put(job)
+            seq += 1
+        self.stats.total = seq
+
+    async def _work(self, stage: Stage, inq: asyncio.Queue, outq: asyncio.Queue) -> None:
+        while True:
+            job = await inq.get()
+            if job is _STOP:
+                return
+            if job.error is None:
+                started = time.monotonic()
+                try:
+                    await stage.handler(job.payload)
+                except asyncio.CancelledError:
+                    raise
+                except self.fatal:
+                    raise
+                except Exception as e:
+                    job.error = e
+                    print(f"Pipeline stage '{stage.name}' failed for item #{job.seq}: {e}")
+                    traceback.print_exc()
+                finally:
+                    self.stats.stage_seconds[stage.name] += time.monotonic() - started
+            await outq.put(job)
+
+    async def _finish(self, job: _Job) -> None:
+        started = time.monotonic()
+        try:
+            await self.sink(job.payload, job.error)
+            if job.error is None:
+                self.stats.succeeded += 1
+            else:
+                self.stats.failed += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.stats.failed += 1
+            print(f"Pipeline sink failed for item #{job.seq}: {e}")
+            traceback.print_exc()
+        finally:
+            self.stats.stage_seconds["persist"] = self.stats.stage_seconds.get("persist", 0.0) + time.monotonic() - started
+            self._inflight.pop(job.seq, None)
+            if self.budget is not None:
+                await self.budget.release(job.reserved)
+
+    async def _drain(self, inq: asyncio.Queue) -> None:
+        # Буфер переупорядочивания: стадии параллельны, а сохранять нужно в исходном порядке
+        pending: Dict[int, _Job] = {}
+        next_seq = 0
+        while True:
+            job = await inq.get()
+            if job is _STOP:
+                break
+            pending[job.seq] = job
+            while next_seq in pending:
+                await self._finish(pending.pop(next_seq))
+                next_seq += 1
+        # Сюда попадаем только после всех воркеров, значит пропусков в последовательности нет
+        for seq in sorted(pending):
+            await self._finish(pending.pop(seq))
+
+    async def run(self, source: Union[AsyncIterable[Any], Iterable[Any]]) -> PipelineStats:
+        started = time.monotonic()
+        queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        producer = asyncio.create_task(self._produce(source, queues[0]))
+        stage_tasks = [
+            [asyncio.create_task(self._work(stage, queues[idx], queues[idx + 1]))
+             for _ in range(max(1, int(stage.workers)))]
+            for idx, stage in enumerate(self.stages)
+        ]
+        drainer = asyncio.create_task(self._drain(queues[-1]))
+
+        async def shutdown():
+            await producer
+            # Останавливаем стадии по очереди: каждая завершается после того, как выработала вход
+            for idx, workers in enumerate(stage_tasks):
+                for _ in workers:
+                    await queues[idx].put(_STOP)
+                await asyncio.gather(*workers)
+            await queues[-1].put(_STOP)
+            await drainer
+
+        flow = asyncio.create_task(shutdown())
+        all_tasks = [flow, producer, drainer] + [t for workers in stage_tasks for t in workers]
+        try:
+            # Ждём завершения, но выходим сразу, если какой-то воркер упал с фатальной ошибкой
+            done, _ = await asyncio.wait(all_tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for t in done:
+                if not t.cancelled() and t.exception() is not None:
+                    raise t.exception()
+            flow.result()
+        except BaseException:
+            for t in all_tasks:
+                if not t.done():
+                    t.cancel()
+            await asyncio.gather(*all_tasks, return_exceptions=True)
+            for job in list(self._inflight.values()):
+                if self.cleanup is not None:
+                    try:
+                        self.cleanup(job.payload)
+                    except Exception as e:
+                        print("Cleanup error:", e)
+                # Бюджет может быть общим с другими каналами — возвращаем резерв
+                if self.budget is not None and job.reserved:
+                    await self.budget.release(job.reserved)
+            self._inflight.clear()
+            raise
+        finally:
+            self.stats.wall_seconds = time.monotonic() - started
+        return self.stats
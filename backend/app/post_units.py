@@ -0,0 +1,97 @@
+# post_units.py
+# Постраничный обход истории канала, выдающий целые единицы постов (сообщение или альбом).
+# Останавливается, как только собрано limit единиц, без избыточной выборки limit*4.
+# Альбом, оборванный на последней нужной единице, добирается точечно через get_messages(ids=...).
+
+from typing import AsyncIterator, List, Optional
+
+from app.telegram_governor import HistoryPage
+
+# Telegram допускает не больше 10 медиа в альбоме
+MAX_ALBUM_SIZE = 10
+
+
+def _sorted_unit(unit: list) -> list:
+    # Стабильный порядок внутри альбома: по дате/ID возрастанию
+    return sorted(unit, key=lambda x: (x.date, x.id))
+
+
+async def _complete_album(client, entity, governor, album: list, reverse: bool) -> list:
+    """
+    Добирает сообщения альбома, которые лежат за границей прочитанной истории.
+    Id участников альбома идут подряд, поэтому хватает одного GetMessages по соседним id.
+    """
+    missing = MAX_ALBUM_SIZE - len(album)
+    if missing <= 0:
+        return album
+    gid = album[0].grouped_id
+    ids = [m.id for m in album]
+    if reverse:
+        candidates = [max(ids) + i for i in range(1, missing + 1)]
+    else:
+        candidates = [i for i in range(min(ids) - 1, min(ids) - 1 - missing, -1) if i > 0]
+    if not candidates:
+        return album
+    fetched = await governor.call("messages", lambda: client.get_messages(entity, ids=candidates))
+    for msg in fetched or []:
+        # Идём от границы наружу и останавливаемся на первом сообщении не из альбома
+        if msg is None or getattr(msg, "grouped_id", None) != gid:
+            break
+        album.append(msg)
+    return album
+
+
+async def iter_post_units(client, entity, governor, limit: Optional[int] = None, *,
+                          max_messages: Optional[int] = None, **kwargs) -> AsyncIterator[List]:
+    """
+    Выдаёт единицы постов в порядке обхода истории (по умолчанию от новых к старым;
+    reverse=True вместе с min_id — от старых к новым). Сообщения внутри единицы
+    отсортированы по дате/ID. kwargs передаются в governor.iter_messages (min_id, reverse, ...).
+
+    Альбом считается завершённым, когда встречено сообщение не из него или история кончилась.
+    Если последняя нужная единица — альбом, а страница истории закончилась на нём,
+    следующую страницу не запрашиваем, а добираем недостающие id альбома напрямую.
+    """
+    if limit is not None and limit <= 0:
+        return
+    reverse = bool(kwargs.get("reverse", False))
+    produced = 0
+    seen = 0
+    album: list = []
+    page = HistoryPage()
+
+    async for m in governor.iter_messages(client, entity, limit=max_messages, page=page, **kwargs):
+        seen += 1
+        gid = getattr(m, "grouped_id", None)
+        if album and gid == album[0].grouped_id:
+            album.append(m)
+        else:
+            if album:
+                yield _sorted_unit(album)
+                album = []
+                produced += 1
+                if limit is not None and produced >= limit:
+                    return
+            if gid:
+                album = [m]
+            else:
+                yield [m]
+                produced += 1
+                if limit is not None and produced >= limit:
+                    return
+                continue
+
+        last_needed = limit is not None and produced == limit - 1
+        if len(album) >= MAX_ALBUM_SIZE or (last_needed and page.at_boundary):
+            # Альбом заведомо полон, или на нём кончилась страница, а больше единиц не нужно
+            yield _sorted_unit(await _complete_album(client, entity, governor, album, reverse))
+            album = []
+            produced += 1
+            if limit is not None and produced >= limit:
+                return
+
+    if album:
+        # Упёрлись в max_messages посреди альбома — добираем его; если кончилась история, альбом полон
+        if max_messages is not None and seen >= max_messages:
+            album = await _complete_album(client, entity, governor, album, reverse)
+        yield _sorted_unit(album)
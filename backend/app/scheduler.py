@@ -0,0 +1,83 @@
+# scheduler.py
+# Параллельная обработка нескольких каналов поверх одного авторизованного клиента.
+# Общий бюджет: число одновременно обрабатываемых каналов, справедливые слоты
+# загрузки/выгрузки медиа и единый ByteBudget на память и диск.
+
+import asyncio
+import traceback
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from app.pipeline import ByteBudget, FairLimiter, PipelineSettings
+
+
+@dataclass
+class SchedulerSettings:
+    """Параметры планировщика (секция `scheduler` в config.yaml)."""
+    max_parallel_channels: int = 3
+    download_slots: int = 6
+    upload_slots: int = 6
+
+    @classmethod
+    def from_config(cls, cfg: Optional[Dict[str, Any]]) -> "SchedulerSettings":
+        cfg = cfg or {}
+        defaults = cls()
+        return cls(
+            max_parallel_channels=max(1, int(cfg.get("max_parallel_channels", defaults.max_parallel_channels))),
+            download_slots=max(1, int(cfg.get("download_slots", defaults.download_slots))),
+            upload_slots=max(1, int(cfg.get("upload_slots", defaults.upload_slots))),
+        )
+
+    def scaled(self, accounts: int) -> "SchedulerSettings":
+        """
+        Настройки для пула из нескольких аккаунтов: каналы и загрузки ограничены
+        лимитами Telegram на аккаунт, поэтому растут пропорционально; выгрузка в Storage — нет.
+        """
+        accounts = max(1, int(accounts))
+        return SchedulerSettings(
+            max_parallel_channels=self.max_parallel_channels * accounts,
+            download_slots=self.download_slots * accounts,
+            upload_slots=self.upload_slots,
+        )
+
+
+class ChannelScheduler:
+    """
+    Запускает обработку каналов параллельно (не больше max_parallel_channels одновременно).
+    Конвейеры каналов делят между собой слоты загрузки/выгрузки (по кругу между каналами)
+    и общий бюджет байтов, так что суммарная нагрузка не растёт с числом каналов.
+    Ошибка одного канала не останавливает остальные.
+    """
+
+    def __init__(self, settings: SchedulerSettings, pipeline_settings: PipelineSettings,
+                 disk_path: Optional[str] = None):
+        self.settings = settings
+        self.download_limiter = FairLimiter(settings.download_slots)
+        self.upload_limiter = FairLimiter(settings.upload_slots)
+        self.budget = ByteBudget(
+            pipeline_settings.max_inflight_bytes,
+            pipeline_settings.min_free_disk_bytes,
+            disk_path=disk_path,
+        )
+        self._channel_slots = asyncio.Semaphore(settings.max_parallel_channels)
+
+    async def run(self, channels: List[str], worker: Callable[[str], Awaitable[Any]]) -> Dict[str, Optional[BaseException]]:
+        """Обрабатывает каналы и возвращает {канал: ошибка или None}."""
+        results: Dict[str, Optional[BaseException]] = {}
+
+        async def run_one(ch: str):
+            async with self._channel_slots:
+                try:
+                    await worker(ch)
+                    results[ch] = None
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"ERROR processing channel {ch}: {e}")
+                    traceback.print_exc()
+                    results[ch] = e
+
+        # Дубликаты каналов обрабатывать дважды незачем
+        unique_channels = list(dict.fromkeys(channels))
+        await asyncio.gather(*(run_one(ch) for ch in unique_channels))
+        return results
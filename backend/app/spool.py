@@ -0,0 +1,345 @@
+# spool.py
+# Временные файлы конвейера (сырые загрузки, брендированные копии, превью) в одном
+# управляемом каталоге вместо захардкоженного ~/Library/Caches:
+#   jobs/<run>/<job>/  — каталог на пост: удаляется целиком после выгрузки или ошибки;
+#   partial/           — недокачанные сегментные загрузки (докачка), вытесняются по LRU;
+#   cache/             — долгоживущие файлы (PNG логотипа под разрешения видео).
+# Каталоги процессов, которых уже нет (падение, kill), вычищаются при старте.
+# Общая квота байтов: загрузки ждут, пока место не освободится.
+
+import asyncio
+import os
+import pathlib
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, Optional
+
+MB = 1024 * 1024
+
+
+def _default_root() -> pathlib.Path:
+    if sys.platform == "darwin":
+        return pathlib.Path.home() / "Library" / "Caches" / "tg_pipeline"
+    cache = os.environ.get("XDG_CACHE_HOME") or str(pathlib.Path.home() / ".cache")
+    return pathlib.Path(cache) / "tg_pipeline"
+
+
+@dataclass
+class SpoolSettings:
+    """Параметры каталога временных файлов (секция `spool` в config.yaml)."""
+    path: str = ""                      # пусто — $TG_PIPELINE_SPOOL или кэш пользователя (~/.cache/tg_pipeline)
+    use_tmpfs: bool = False             # держать спул в /dev/shm (RAM), если он есть
+    max_bytes: int = 4096 * MB          # 0 — без квоты
+    partial_ttl_seconds: float = 86400.0
+    poll_seconds: float = 1.0
+
+    @classmethod
+    def from_config(cls, cfg: Optional[Dict[str, Any]]) -> "SpoolSettings":
+        cfg = cfg or {}
+        defaults = cls()
+        return cls(
+            path=str(cfg.get("path") or os.environ.get("TG_PIPELINE_SPOOL") or defaults.path),
+            use_tmpfs=bool(cfg.get("use_tmpfs", defaults.use_tmpfs)),
+            max_bytes=int(float(cfg.get("max_mb", defaults.max_bytes / MB)) * MB),
+            partial_ttl_seconds=float(cfg.get("partial_ttl_seconds", defaults.partial_ttl_seconds)),
+            poll_seconds=max(0.1, float(cfg.get("poll_seconds", defaults.poll_seconds))),
+        )
+
+    def resolve_root(self) -> pathlib.Path:
+        if self.use_tmpfs and os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+            return pathlib.Path("/dev/shm") / "tg_pipeline"
+        return pathlib.Path(self.path).expanduser() if self.path else _default_root()
+
+
+def _tree_size(path: pathlib.Path) -> int:
+    total = 0
+    stack = [str(path)]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        else:
+                            total += entry.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+    return total
+
+
+def _is_legacy(path: pathlib.Path) -> bool:
+    """Файлы прежней раскладки OUT: сырые tg_*, брендированные копии и logo_cache."""
+    name = path.name
+    if path.is_dir():
+        return name == "logo_cache"
+    return name.startswith("tg_") or "_branded" in name or "_faststart" in name
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Spool:
+    """
+    Управляемый каталог временных файлов. Каталог запуска jobs/<pid>-<token> принадлежит
+    одному процессу; при открытии (open) удаляются каталоги умерших процессов, просроченные
+    недокачки и файлы старой плоской раскладки в корне. Конструктор диск не трогает —
+    импорт модуля не создаёт каталогов и не обходит спул.
+    """
+
+    def __init__(self, settings: SpoolSettings):
+        self.settings = settings
+        self.root = settings.resolve_root()
+        self.jobs_root = self.root / "jobs"
+        self.partial_dir = self.root / "partial"
+        self.cache_dir = self.root / "cache"
+        self.run_dir = self.jobs_root / f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._opened = False
+        self._cond: Optional[asyncio.Condition] = None
+        self._pending = 0               # байты загрузок, идущих прямо сейчас
+        self._partials_in_use: set = set()
+        self._waiters: Dict[object, Optional[pathlib.Path]] = {}   # ждущие квоту загрузки (по возрасту) → каталог поста
+        self._usage = 0
+        self._usage_at = 0.0
+        self.active_jobs = 0
+        self.swept_files = 0
+        self.swept_bytes = 0
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+    # --- Обслуживание ---
+
+    def open(self) -> None:
+        """Создаёт каталоги и вычищает осиротевшие файлы (один раз; повторные вызовы — no-op)."""
+        if self._opened:
+            return
+        for folder in (self.run_dir, self.partial_dir, self.cache_dir):
+            folder.mkdir(parents=True, exist_ok=True)
+        self._opened = True
+        self.sweep()
+
+    def sweep(self) -> None:
+        """Удаляет осиротевшие файлы: каталоги умерших процессов, старые недокачки, старую раскладку."""
+        swept = 0
+        for run in self.jobs_root.iterdir():
+            if run == self.run_dir:
+                continue
+            pid = run.name.split("-", 1)[0]
+            if pid.isdigit() and int(pid) != os.getpid() and _pid_alive(int(pid)):
+                continue
+            size = _tree_size(run)
+            shutil.rmtree(run, ignore_errors=True)
+            self.swept_bytes += size
+            swept += 1
+        now = time.time()
+        for entry in list(self.partial_dir.iterdir()) + [p for p in self.root.iterdir() if _is_legacy(p)]:
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            # Файлы прежней плоской раскладки (OUT) в корне — их владельцы давно завершились
+            if entry.parent == self.root or now - stat.st_mtime > self.settings.partial_ttl_seconds:
+                if entry.is_dir():
+                    size = _tree_size(entry)
+                    shutil.rmtree(entry, ignore_errors=True)
+                else:
+                    size = stat.st_size
+                    entry.unlink(missing_ok=True)
+                self.swept_bytes += size
+                swept += 1
+        self.swept_files += swept
+        if swept:
+            print(f"Spool {self.root}: swept {swept} orphaned item(s), {self.swept_bytes / MB:.1f} MB")
+
+    def evict_partials(self, need_bytes: int, in_use: Optional[frozenset] = None) -> int:
+        """
+        Освобождает место, удаляя самые давние недокачки (LRU по mtime). Возвращает освобождённые байты.
+        in_use — снимок занятых недокачек, когда вызов идёт из рабочего потока.
+        """
+        in_use = frozenset(self._partials_in_use) if in_use is None else in_use
+        entries = []
+        for entry in self.partial_dir.iterdir():
+            if any(entry.name.startswith(name) for name in in_use):
+                continue
+            try:
+                entries.append((entry.stat().st_mtime, entry.stat().st_size, entry))
+            except OSError:
+                pass
+        freed = 0
+        for _, size, entry in sorted(entries, key=lambda e: e[0]):
+            if freed >= need_bytes:
+                break
+            entry.unlink(missing_ok=True)
+            freed += size
+            self.evicted_files += 1
+        self.evicted_bytes += freed
+        if freed:
+            self._usage_at = 0.0
+        return freed
+
+    @contextmanager
+    def partial(self, name: str) -> Iterator[pathlib.Path]:
+        """Путь для докачиваемой загрузки в partial/; пока файл качается, он не вытесняется."""
+        self.open()
+        self._partials_in_use.add(name)
+        try:
+            yield self.partial_dir / name
+        finally:
+            self._partials_in_use.discard(name)
+
+    def usage(self, max_age: float = 1.0) -> int:
+        """Занято в спуле, байт (обход каталога не чаще раза в max_age секунд)."""
+        if time.monotonic() - self._usage_at > max_age:
+            self._usage = _tree_size(self.root)
+            self._usage_at = time.monotonic()
+        return self._usage
+
+    async def _usage_async(self, max_age: float = 1.0) -> int:
+        # То же, что usage(), но обход каталога — в рабочем потоке, а не на цикле событий
+        if time.monotonic() - self._usage_at > max_age:
+            self._usage = await asyncio.to_thread(_tree_size, self.root)
+            self._usage_at = time.monotonic()
+        return self._usage
+
+    # --- Каталоги постов ---
+
+    def new_job_dir(self, label: str = "job") -> pathlib.Path:
+        """Отдельный каталог для файлов одного поста: имена из разных постов и запусков не пересекаются."""
+        self.open()
+        self.active_jobs += 1
+        return pathlib.Path(tempfile.mkdtemp(prefix=f"{label}-", dir=self.run_dir))
+
+    def release_job_dir(self, path: Optional[pathlib.Path]) -> None:
+        if path is None:
+            return
+        shutil.rmtree(path, ignore_errors=True)
+        self.active_jobs = max(0, self.active_jobs - 1)
+        self._usage_at = 0.0
+
+    @contextmanager
+    def job_dir(self, label: str = "job") -> Iterator[pathlib.Path]:
+        path = self.new_job_dir(label)
+        try:
+            yield path
+        finally:
+            self.release_job_dir(path)
+
+    def shutdown(self) -> None:
+        """Удаляет каталог этого процесса (недокачки в partial/ остаются для докачки)."""
+        if self._opened:
+            shutil.rmtree(self.run_dir, ignore_errors=True)
+
+    # --- Квота ---
+
+    def _condition(self) -> asyncio.Condition:
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    async def _has_room(self, nbytes: int) -> bool:
+        limit = self.settings.max_bytes
+        if not limit:
+            return True
+        over = await self._usage_async() + self._pending + nbytes - limit
+        if over <= 0:
+            return True
+        # Сначала жертвуем давними недокачками, потом ждём
+        if await asyncio.to_thread(self.evict_partials, over, frozenset(self._partials_in_use)):
+            return await self._usage_async(0) + self._pending + nbytes <= limit
+        return False
+
+    def _held_by_others(self, owners: set) -> int:
+        return _tree_size(self.jobs_root) - sum(_tree_size(owner) for owner in owners)
+
+    async def _nothing_to_free(self, waiter: object) -> bool:
+        """
+        Пропустить ли загрузку сверх квоты. Каталоги постов, чьи загрузки сами ждут квоту,
+        места не освободят: если всё занятое принадлежит ждущим, проходит самая давняя —
+        иначе посты ждали бы друг друга вечно.
+        """
+        if self._pending:
+            return False
+        owners = {o for o in self._waiters.values() if o is not None and o not in (self.run_dir, self.jobs_root)}
+        if await asyncio.to_thread(self._held_by_others, owners) > 0:
+            return False
+        return next(iter(self._waiters)) is waiter
+
+    @asynccontextmanager
+    async def download_slot(self, nbytes: int, owner: Optional[pathlib.Path] = None):
+        """
+        Резервирует место под загрузку файла размером nbytes в каталог поста owner.
+        Если квота занята, ждёт, пока другие посты не освободят каталоги. Если освобождать
+        некому (спул заполнен файлами owner и других ждущих постов), самая давняя загрузка
+        пропускается сверх квоты — иначе альбомы ждали бы сами себя и друг друга.
+        """
+        nbytes = max(0, int(nbytes))
+        self.open()
+        cond = self._condition()
+        started = time.monotonic()
+        waited = False
+        waiter = object()
+        async with cond:
+            self._waiters[waiter] = owner
+            try:
+                while not await self._has_room(nbytes):
+                    if await self._nothing_to_free(waiter):
+                        break
+                    waited = True
+                    # Каталоги постов освобождаются не через этот объект — опрашиваем периодически
+                    try:
+                        await asyncio.wait_for(cond.wait(), timeout=self.settings.poll_seconds)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                del self._waiters[waiter]
+            self._pending += nbytes
+        if waited:
+            self.waits += 1
+            self.wait_seconds += time.monotonic() - started
+        try:
+            yield
+        finally:
+            async with cond:
+                self._pending = max(0, self._pending - nbytes)
+                self._usage_at = 0.0
+                cond.notify_all()
+
+    def status(self) -> Dict[str, Any]:
+        try:
+            disk = shutil.disk_usage(self.root)
+            disk_free = disk.free
+        except OSError:
+            disk_free = None
+        return {
+            "root": str(self.root),
+            "tmpfs": str(self.root).startswith("/dev/shm"),
+            "max_bytes": self.settings.max_bytes,
+            "used_bytes": self.usage(0),
+            "jobs_bytes": _tree_size(self.jobs_root),
+            "partial_bytes": _tree_size(self.partial_dir),
+            "pending_download_bytes": self._pending,
+            "active_jobs": self.active_jobs,
+            "disk_free_bytes": disk_free,
+            "swept_files": self.swept_files,
+            "swept_bytes": self.swept_bytes,
+            "evicted_files": self.evicted_files,
+            "evicted_bytes": self.evicted_bytes,
+            "quota_waits": self.waits,
+            "quota_wait_seconds": round(self.wait_seconds, 2),
+        }
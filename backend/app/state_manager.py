@@ -3,18 +3,26 @@
 
 from typing import Dict, Any
 
-from app.supabase_manager import get_state_document, update_state, set_state
+from app.supabase_manager import (
+    get_state_document,
+    update_state,
+    set_state,
+    get_channel_watermark,
+    advance_channel_watermark,
+)
 
 DEFAULT_STATE = {
     "processed": 0,
     "total": 0,
     "is_running": False,
     "finished": False,
-    "channels": {} # Для хранения last_id по каждому каналу
+    "channels": {} # Устарело: last_id каналов хранится в таблице channel_sync_state
 }
 
 # Кэш для processed count по пользователям (обновляется только при чтении из БД)
 _processed_cache: Dict[str, int] = {}
+# Кэш для total по пользователям: каналы обрабатываются параллельно и добавляют свои посты
+_total_cache: Dict[str, int] = {}
 
 def get_state(user_id: str) -> Dict[str, Any]:
     """
@@ -51,6 +59,7 @@ def reset_state(user_id: str):
     }
     set_state(user_id, new_state)
     _processed_cache[user_id] = 0
+    _total_cache[user_id] = 0
 
 def set_running(user_id: str, running: bool):
     """
@@ -75,18 +84,19 @@ def set_finished(user_id: str, finished: bool):
     """
     update_state(user_id, {"finished": finished})
 
-def increment_processed(user_id: str):
+def increment_processed(user_id: str, count: int = 1):
     """
     Увеличивает счетчик обработанных постов для конкретного пользователя.
     Оптимизировано: использует кэш вместо чтения из БД каждый раз.
     
     Args:
         user_id: UUID пользователя
+        count: На сколько увеличить (пакетное сохранение)
     """
     global _processed_cache
     if user_id not in _processed_cache:
         _processed_cache[user_id] = 0
-    _processed_cache[user_id] += 1
+    _processed_cache[user_id] += count
     update_state(user_id, {"processed": _processed_cache[user_id]})
 
 def set_total(user_id: str, total: int):
@@ -97,8 +107,24 @@ def set_total(user_id: str, total: int):
         user_id: UUID пользователя
         total: Общее количество постов
     """
+    global _total_cache
+    _total_cache[user_id] = int(total)
     update_state(user_id, {"total": total})
 
+def add_total(user_id: str, count: int):
+    """
+    Добавляет посты канала к общему количеству для конкретного пользователя.
+    Используется при параллельной обработке нескольких каналов вместо set_total,
+    который перезаписал бы итог соседнего канала.
+    
+    Args:
+        user_id: UUID пользователя
+        count: Количество постов канала
+    """
+    global _total_cache
+    _total_cache[user_id] = _total_cache.get(user_id, 0) + int(count)
+    update_state(user_id, {"total": _total_cache[user_id]})
+
 def get_last_id(user_id: str, channel: str) -> int:
     """
     Получает последний обработанный ID для указанного канала конкретного пользователя.
@@ -108,20 +134,18 @@ def get_last_id(user_id: str, channel: str) -> int:
         channel: Имя канала
         
     Returns:
-        Последний обработанный ID
+        Последний обработанный ID (0, если канал ещё не синхронизировался)
     """
-    state = get_state(user_id)
-    return state.get("channels", {}).get(channel, 0)
+    return get_channel_watermark(user_id, channel)
 
 def set_last_id(user_id: str, channel: str, last_id: int):
     """
     Обновляет последний обработанный ID для канала конкретного пользователя.
+    Водяной знак только растёт: меньшее значение игнорируется.
     
     Args:
         user_id: UUID пользователя
         channel: Имя канала
         last_id: ID последнего сообщения
     """
-    # Используем "точечную нотацию" для обновления вложенного поля
-    update_key = f"channels.{channel}"
-    update_state(user_id, {update_key: last_id})
+    advance_channel_watermark(user_id, channel, last_id)
@@ -0,0 +1,417 @@
+# storage_uploader.py
+# Асинхронная выгрузка в Supabase Storage: общий httpx.AsyncClient с keep-alive пулом
+# соединений, ограничение параллельных загрузок, таймауты на каждую фазу запроса
+# (вместо SIGALRM, который работает только в главном потоке) и повторы
+# с экспоненциальной задержкой. Файл читается потоково, цикл событий не блокируется.
+# Большие файлы — по протоколу TUS (resumable upload Supabase): блоками из любого
+# асинхронного потока байтов (например, прямо из Telegram) с продолжением с последнего
+# подтверждённого сервером смещения, в том числе после перезапуска процесса.
+
+import asyncio
+import base64
+import json
+import os
+import pathlib
+import random
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Dict, Optional, Tuple, Type
+
+import httpx
+
+from app.supabase_manager import MEDIA_BUCKET, _ensure_media_bucket, _guess_mime_type, supabase_credentials
+
+CHUNK_SIZE = 1024 * 1024
+MB = 1024 * 1024
+TUS_VERSION = "1.0.0"
+
+
+@dataclass
+class StorageUploadSettings:
+    """Параметры выгрузки в Storage (секция `storage_upload` в config.yaml)."""
+    max_parallel: int = 6
+    connect_timeout: float = 10.0
+    io_timeout: float = 60.0            # на чтение ответа / запись очередного блока
+    retries: int = 4
+    backoff_seconds: float = 0.5
+    backoff_max_seconds: float = 15.0
+    keepalive: int = 10
+    resumable_threshold_bytes: int = 50 * MB   # крупнее — TUS-выгрузка потоком без временного файла
+    resumable_chunk_bytes: int = 6 * MB        # Supabase принимает блоки TUS ровно по 6 МБ
+
+    @classmethod
+    def from_config(cls, cfg: Optional[Dict[str, Any]]) -> "StorageUploadSettings":
+        cfg = cfg or {}
+        defaults = cls()
+        return cls(
+            max_parallel=max(1, int(cfg.get("max_parallel", defaults.max_parallel))),
+            connect_timeout=float(cfg.get("connect_timeout", defaults.connect_timeout)),
+            io_timeout=float(cfg.get("io_timeout", defaults.io_timeout)),
+            retries=max(0, int(cfg.get("retries", defaults.retries))),
+            backoff_seconds=float(cfg.get("backoff_seconds", defaults.backoff_seconds)),
+            backoff_max_seconds=float(cfg.get("backoff_max_seconds", defaults.backoff_max_seconds)),
+            keepalive=max(1, int(cfg.get("keepalive", defaults.keepalive))),
+            resumable_threshold_bytes=int(float(cfg.get("resumable_threshold_mb", defaults.resumable_threshold_bytes / MB)) * MB),
+            resumable_chunk_bytes=max(MB, int(float(cfg.get("resumable_chunk_mb", defaults.resumable_chunk_bytes / MB)) * MB)),
+        )
+
+
+class StorageUploadError(RuntimeError):
+    """Файл не выгружен после всех попыток."""
+
+
+class _HttpStatusError(Exception):
+    def __init__(self, response: httpx.Response):
+        super().__init__(f"HTTP {response.status_code}: {response.text[:200]}")
+        self.status_code = response.status_code
+
+
+def _retryable(status: int) -> bool:
+    return status == 429 or status >= 500
+
+
+def _tus_metadata(**values: str) -> str:
+    return ",".join(f"{k} {base64.b64encode(v.encode()).decode()}" for k, v in values.items())
+
+
+class _TusState:
+    """Sidecar с адресом TUS-выгрузки: следующий вызов продолжит ту же выгрузку (сервер хранит её сутки)."""
+
+    def __init__(self, path: Optional[pathlib.Path], dest_path: str, size: int):
+        self.path = path
+        self.dest_path = dest_path
+        self.size = size
+
+    def load(self) -> Optional[str]:
+        if self.path is None:
+            return None
+        try:
+            data = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return None
+        if (data.get("dest_path"), data.get("size")) != (self.dest_path, self.size):
+            return None
+        return data.get("location")
+
+    def save(self, location: str) -> None:
+        if self.path is None:
+            return
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"dest_path": self.dest_path, "size": self.size, "location": location}))
+        os.replace(tmp, self.path)
+
+    def clear(self) -> None:
+        if self.path is not None:
+            self.path.unlink(missing_ok=True)
+
+
+def _is_duplicate(response: httpx.Response) -> bool:
+    if response.status_code == 409:
+        return True
+    text = response.text
+    return response.status_code == 400 and ("Duplicate" in text or "already exists" in text)
+
+
+async def _file_chunks(path: str) -> AsyncIterator[bytes]:
+    with open(path, "rb") as f:
+        while True:
+            chunk = await asyncio.to_thread(f.read, CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+class StorageUploader:
+    """
+    Загрузчик файлов в bucket media. Клиент httpx создаётся на цикл событий
+    (CLI и веб-сервер живут в разных циклах) и переиспользует соединения.
+    """
+
+    def __init__(self, settings: StorageUploadSettings):
+        self.settings = settings
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._sem: Optional[asyncio.Semaphore] = None
+        self.uploaded = 0
+        self.uploaded_bytes = 0
+        self.duplicates = 0
+        self.retries = 0
+        self.failed = 0
+        self.resumable = 0
+        self.resumed = 0
+        self.busy_seconds = 0.0
+
+    def _session(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            url, key = supabase_credentials()
+            s = self.settings
+            self._client = httpx.AsyncClient(
+                base_url=f"{url.rstrip('/')}/storage/v1",
+                headers={"Authorization": f"Bearer {key}", "apikey": key},
+                timeout=httpx.Timeout(s.io_timeout, connect=s.connect_timeout),
+                limits=httpx.Limits(max_connections=s.max_parallel, max_keepalive_connections=s.keepalive),
+            )
+            self._loop = loop
+            self._sem = asyncio.Semaphore(s.max_parallel)
+        return self._client
+
+    def _backoff(self, attempt: int) -> float:
+        delay = min(self.settings.backoff_max_seconds, self.settings.backoff_seconds * (2 ** attempt))
+        return delay * (0.5 + random.random() / 2)
+
+    async def upload(self, local_path: str, dest_path: str, mime: Optional[str] = None, *, upsert: bool = False,
+                     cache_control: str = "3600") -> bool:
+        """
+        Выгружает файл в bucket media по dest_path. Возвращает True, если объект в Storage есть
+        (в том числе уже существовал при upsert=False). Сетевые ошибки, 429 и 5xx повторяются
+        с экспоненциальной задержкой; после последней попытки — StorageUploadError.
+        mime по умолчанию определяется по расширению файла.
+        """
+        client = self._session()
+        mime = mime or _guess_mime_type(local_path)[0]
+        size = os.path.getsize(local_path)
+        headers = {
+            "Content-Type": mime,
+            "Content-Length": str(size),
+            "x-upsert": "true" if upsert else "false",
+            "cache-control": f"max-age={cache_control}",
+        }
+        url = f"/object/{MEDIA_BUCKET}/{dest_path}"
+        bucket_checked = False
+        last_error: Any = None
+        async with self._sem:
+            started = time.monotonic()
+            try:
+                for attempt in range(self.settings.retries + 1):
+                    if attempt:
+                        self.retries += 1
+                        await asyncio.sleep(self._backoff(attempt - 1))
+                    try:
+                        # Тело — новый поток на каждую попытку: прерванный запрос уже прочитал часть файла
+                        response = await client.post(url, content=_file_chunks(local_path), headers=headers)
+                    except httpx.TransportError as exc:
+                        last_error = exc
+                        print(f"Storage upload {dest_path}: {type(exc).__name__}, attempt {attempt + 1}")
+                        continue
+                    if response.is_success:
+                        self.uploaded += 1
+                        self.uploaded_bytes += size
+                        return True
+                    if not upsert and _is_duplicate(response):
+                        self.duplicates += 1
+                        return True
+                    if response.status_code == 404 and not bucket_checked and "Bucket not found" in response.text:
+                        bucket_checked = True
+                        await asyncio.to_thread(_ensure_media_bucket, True)
+                        continue
+                    last_error = f"HTTP {response.status_code}: {response.text[:200]}"
+                    if not _retryable(response.status_code):
+                        break
+                    print(f"Storage upload {dest_path}: {last_error}, attempt {attempt + 1}")
+            finally:
+                self.busy_seconds += time.monotonic() - started
+        self.failed += 1
+        raise StorageUploadError(f"Upload of {local_path} to {dest_path} failed: {last_error}")
+
+    async def upload_resumable(self, dest_path: str, size: int, open_stream: Callable[[int], AsyncIterator[bytes]],
+                               mime: Optional[str] = None, *, state_path: Optional[pathlib.Path] = None,
+                               upsert: bool = False, cache_control: str = "3600",
+                               fatal: Tuple[Type[BaseException], ...] = ()) -> bool:
+        """
+        Выгружает size байт по протоколу TUS. open_stream(offset) отдаёт байты файла с offset
+        (подтверждённого сервером — обычно кратного resumable_chunk_bytes, но не обязательно); блоки по resumable_chunk_bytes уходят PATCH-ами,
+        следующий блок читается, пока отправляется текущий. После сбоя (сеть, Storage или сам поток)
+        выгрузка продолжается с последнего подтверждённого смещения; попытка, не продвинувшая
+        выгрузку, тратит один повтор. Адрес выгрузки хранится в state_path — новый вызов
+        после падения процесса не начинает с нуля. Возвращает True или бросает StorageUploadError.
+        Исключения из fatal (например, отозванная сессия Telegram) не повторяются и пробрасываются как есть.
+        """
+        client = self._session()
+        mime = mime or _guess_mime_type(dest_path)[0]
+        state = _TusState(state_path, dest_path, size)
+        location = state.load()
+        last_error: Any = None
+        failures = 0
+        bucket_checked = False
+        async with self._sem:
+            started = time.monotonic()
+            self.resumable += 1
+            try:
+                while failures <= self.settings.retries:
+                    if failures:
+                        self.retries += 1
+                        await asyncio.sleep(self._backoff(failures - 1))
+                    offset = None
+                    try:
+                        if location is not None:
+                            offset = await self._tus_offset(client, location)
+                            if offset is None:
+                                # Выгрузка истекла на сервере — начинаем новую
+                                location = None
+                                state.clear()
+                        if location is None:
+                            try:
+                                location = await self._tus_create(client, dest_path, size, mime, upsert, cache_control)
+                            except _HttpStatusError as exc:
+                                if exc.status_code != 404 or bucket_checked:
+                                    raise
+                                bucket_checked = True
+                                await asyncio.to_thread(_ensure_media_bucket, True)
+                                continue
+                            if location is None:
+                                self.duplicates += 1
+                                return True
+                            state.save(location)
+                            offset = 0
+                        elif offset:
+                            self.resumed += 1
+                            print(f"Storage upload {dest_path}: resuming at {offset / MB:.1f}/{size / MB:.1f} MB")
+                        offset = await self._tus_send(client, location, offset, size, open_stream)
+                        if offset >= size:
+                            state.clear()
+                            self.uploaded += 1
+                            return True
+                        last_error = f"stream ended at {offset}/{size} bytes"
+                    except (httpx.TransportError, _HttpStatusError) as exc:
+                        last_error = exc
+                        if isinstance(exc, _HttpStatusError) and not (_retryable(exc.status_code) or exc.status_code in (404, 409, 410, 423)):
+                            break
+                    except asyncio.CancelledError:
+                        raise
+                    except fatal:
+                        raise
+                    except Exception as exc:
+                        # Сбой источника (Telegram): место в выгрузке сохранено, продолжим с него
+                        last_error = exc
+                    progressed = await self._tus_progress(client, location, offset)
+                    if not progressed:
+                        failures += 1
+                    print(f"Storage upload {dest_path}: {last_error}, "
+                          f"{'continuing' if progressed else f'attempt {failures}'}")
+            finally:
+                self.busy_seconds += time.monotonic() - started
+        self.failed += 1
+        raise StorageUploadError(f"Resumable upload to {dest_path} failed: {last_error}")
+
+    async def _tus_create(self, client: httpx.AsyncClient, dest_path: str, size: int, mime: str,
+                          upsert: bool, cache_control: str) -> Optional[str]:
+        """Создаёт TUS-выгрузку и возвращает её адрес; None — объект уже есть (без upsert)."""
+        response = await client.post("/upload/resumable", headers={
+            "Tus-Resumable": TUS_VERSION,
+            "Upload-Length": str(size),
+            "Upload-Metadata": _tus_metadata(bucketName=MEDIA_BUCKET, objectName=dest_path,
+                                             contentType=mime, cacheControl=cache_control),
+            "x-upsert": "true" if upsert else "false",
+        })
+        if response.status_code == 201 and response.headers.get("Location"):
+            return response.headers["Location"]
+        if not upsert and _is_duplicate(response):
+            return None
+        raise _HttpStatusError(response)
+
+    async def _tus_offset(self, client: httpx.AsyncClient, location: str) -> Optional[int]:
+        """Подтверждённое сервером смещение; None — выгрузки больше нет (истекла или удалена)."""
+        response = await client.head(location, headers={"Tus-Resumable": TUS_VERSION})
+        if response.status_code in (404, 410):
+            return None
+        if not response.is_success:
+            raise _HttpStatusError(response)
+        return int(response.headers.get("Upload-Offset", 0))
+
+    async def _tus_progress(self, client: httpx.AsyncClient, location: Optional[str], before: Optional[int]) -> bool:
+        """Продвинулась ли выгрузка после before (сервер мог принять блоки до сбоя)."""
+        if location is None or before is None:
+            return False
+        try:
+            after = await self._tus_offset(client, location)
+        except (httpx.TransportError, _HttpStatusError):
+            return False
+        return after is not None and after > before
+
+    async def _tus_send(self, client: httpx.AsyncClient, location: str, offset: int, size: int,
+                        open_stream: Callable[[int], AsyncIterator[bytes]]) -> int:
+        """Отправляет байты с offset блоками; возвращает последнее подтверждённое смещение."""
+        block_size = self.settings.resumable_chunk_bytes
+        blocks: asyncio.Queue = asyncio.Queue(maxsize=1)
+        stopped = False
+
+        async def put(item: Any) -> bool:
+            if stopped:
+                return False
+            await blocks.put(item)
+            return True
+
+        async def produce() -> None:
+            buffer = bytearray()
+            remaining = size - offset
+            stream = open_stream(offset)
+            try:
+                async for chunk in stream:
+                    buffer += chunk[:remaining]
+                    remaining -= min(len(chunk), remaining)
+                    while len(buffer) >= block_size:
+                        if not await put(bytes(buffer[:block_size])):
+                            return
+                        del buffer[:block_size]
+                    if remaining <= 0:
+                        break
+                if buffer and not await put(bytes(buffer)):
+                    return
+                await put(None)
+            except Exception as exc:
+                await put(exc)
+            finally:
+                aclose = getattr(stream, "aclose", None)
+                if aclose is not None:
+                    await aclose()
+
+        producer = asyncio.create_task(produce())
+        try:
+            while True:
+                block = await blocks.get()
+                if block is None:
+                    return offset
+                if isinstance(block, Exception):
+                    raise block
+                response = await client.patch(location, content=block, headers={
+                    "Tus-Resumable": TUS_VERSION,
+                    "Upload-Offset": str(offset),
+                    "Content-Type": "application/offset+octet-stream",
+                })
+                if not response.is_success:
+                    raise _HttpStatusError(response)
+                acked = int(response.headers.get("Upload-Offset", offset + len(block)))
+                self.uploaded_bytes += acked - offset
+                offset = acked
+        finally:
+            # wait_for в источнике может «проглотить» отмену (Python 3.11) — тогда производитель
+            # остановится сам на следующем put; освобождаем ему место в очереди
+            stopped = True
+            producer.cancel()
+            while not blocks.empty():
+                blocks.get_nowait()
+            await asyncio.gather(producer, return_exceptions=True)
+
+    async def close(self) -> None:
+        if self._client is not None:
+            try:
+                await self._client.aclose()
+            except RuntimeError:
+                # Клиент привязан к уже закрытому циклу событий
+                pass
+            self._client = None
+            self._loop = None
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "max_parallel": self.settings.max_parallel,
+            "uploaded": self.uploaded,
+            "uploaded_bytes": self.uploaded_bytes,
+            "duplicates": self.duplicates,
+            "retries": self.retries,
+            "failed": self.failed,
+            "resumable": self.resumable,
+            "resumed": self.resumed,
+            "busy_seconds": round(self.busy_seconds, 2),
+        }
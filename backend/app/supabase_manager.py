@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import json
 import logging
 import mimetypes
 import os
@@ -9,6 +10,7 @@ from copy import deepcopy
 from datetime import datetime, timezone
 from typing import Any, Dict, List, Optional, Tuple
 
+import httpx
 from dotenv import load_dotenv
 from supabase import Client, create_client
 
@@ -19,7 +21,10 @@ logger = logging.getLogger(__name__)
 STATE_TABLE = "pipeline_state"
 POSTS_TABLE = "parsed_posts"
 CHANNELS_TABLE = "saved_channel"
+SYNC_STATE_TABLE = "channel_sync_state"
+ENTITY_CACHE_TABLE = "telegram_entity_cache"
 MEDIA_TABLE = "post_media"
+MEDIA_OBJECTS_TABLE = "media_objects"
 STATE_DOCUMENT_ID = "progress_tracker"
 MEDIA_BUCKET = "media"
 
@@ -33,6 +38,8 @@ DEFAULT_STATE: Dict[str, Any] = {
 }
 
 _supabase: Optional[Client] = None
+# bucket media проверяется один раз на процесс (list_buckets — лишний запрос на каждую выгрузку)
+_media_bucket_ready = False
 
 
 def _has_error(response: Any) -> bool:
@@ -48,6 +55,15 @@ def initialize_supabase() -> Client:
     if _supabase is not None:
         return _supabase
 
+    url, key = supabase_credentials()
+    _supabase = create_client(url, key)
+    _ensure_state_row()
+    _ensure_media_bucket()
+    return _supabase
+
+
+def supabase_credentials() -> Tuple[str, str]:
+    """URL проекта и сервисный ключ из окружения (для клиента Supabase и прямых HTTP-запросов к Storage)."""
     url = os.getenv("SUPABASE_URL")
     key = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("SUPABASE_KEY")
 
@@ -55,11 +71,7 @@ def initialize_supabase() -> Client:
         raise RuntimeError(
             "Переменные окружения SUPABASE_URL и SUPABASE_SERVICE_ROLE_KEY должны быть заданы."
         )
-
-    _supabase = create_client(url, key)
-    _ensure_state_row()
-    _ensure_media_bucket()
-    return _supabase
+    return url, key
 
 
 def _client() -> Client:
@@ -76,10 +88,14 @@ def _ensure_state_row() -> None:
     pass
 
 
-def _ensure_media_bucket() -> None:
+def _ensure_media_bucket(force: bool = False) -> None:
     """
     Гарантирует наличие публичного хранилища для медиа.
+    Проверка выполняется один раз на процесс; force=True — заново (Storage ответил «Bucket not found»).
     """
+    global _media_bucket_ready
+    if _media_bucket_ready and not force:
+        return
     try:
         storage = _client().storage
         # Надежнее проверить через list_buckets()
@@ -95,6 +111,7 @@ def _ensure_media_bucket() -> None:
             # В некоторых версиях API сигнатура: create_bucket(bucket_id: str, public: bool | None)
             storage.create_bucket(MEDIA_BUCKET, public=True)
             logger.info("Создан Storage bucket '%s' (public=True)", MEDIA_BUCKET)
+        _media_bucket_ready = True
     except Exception as exc:
         # Если не удалось создать (например, уже существует или нет прав) — логируем и продолжаем.
         logger.warning("Не удалось гарантировать bucket '%s': %s", MEDIA_BUCKET, exc)
@@ -170,6 +187,23 @@ def set_state(user_id: str, state: Dict[str, Any]) -> None:
         logger.error("Ошибка сохранения состояния в Supabase для user %s: %s", user_id, exc)
 
 
+def _prepare_post_payload(post_data: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+    payload = deepcopy(post_data)
+    payload["user_id"] = user_id
+    payload["original_date"] = _serialize_datetime(payload.get("original_date"))
+    if "original_edit_date" in payload:
+        payload["original_edit_date"] = _serialize_datetime(payload.get("original_edit_date"))
+    payload["saved_at"] = datetime.now(timezone.utc).isoformat()
+    original_ids = payload.get("original_ids")
+    if isinstance(original_ids, list):
+        pass
+    elif original_ids is None:
+        payload["original_ids"] = []
+    else:
+        payload["original_ids"] = [original_ids]
+    return payload
+
+
 def save_post(post_data: Dict[str, Any], user_id: str) -> Optional[str]:
     """
     Сохраняет пост в БД для конкретного пользователя.
@@ -185,17 +219,7 @@ def save_post(post_data: Dict[str, Any], user_id: str) -> Optional[str]:
         logger.error("post_data должен быть словарем, получено: %s", type(post_data))
         return None
 
-    payload = deepcopy(post_data)
-    payload["user_id"] = user_id
-    payload["original_date"] = _serialize_datetime(payload.get("original_date"))
-    payload["saved_at"] = datetime.now(timezone.utc).isoformat()
-    original_ids = payload.get("original_ids")
-    if isinstance(original_ids, list):
-        pass
-    elif original_ids is None:
-        payload["original_ids"] = []
-    else:
-        payload["original_ids"] = [original_ids]
+    payload = _prepare_post_payload(post_data, user_id)
 
     try:
         response = _client().table(POSTS_TABLE).insert(payload).execute()
@@ -216,6 +240,34 @@ def save_post(post_data: Dict[str, Any], user_id: str) -> Optional[str]:
         return None
 
 
+def save_posts_bulk(posts: List[Dict[str, Any]], user_id: str) -> List[Optional[str]]:
+    """
+    Сохраняет несколько постов одним запросом.
+    
+    Args:
+        posts: Данные постов
+        user_id: UUID пользователя
+        
+    Returns:
+        ID созданных постов в том же порядке (None для всех при ошибке)
+    """
+    if not posts:
+        return []
+    payloads = [_prepare_post_payload(post, user_id) for post in posts]
+    try:
+        response = _client().table(POSTS_TABLE).insert(payloads).execute()
+        if _has_error(response):
+            raise RuntimeError(getattr(response, "error", "Unknown Supabase error"))
+        rows = response.data or []
+        # PostgREST возвращает вставленные строки в порядке запроса; сверяем по original_message_id
+        by_message = {row.get("original_message_id"): row.get("id") for row in rows if isinstance(row, dict)}
+        logger.info("%s пост(ов) для user %s сохранено в Supabase таблицу '%s'.", len(rows), user_id, POSTS_TABLE)
+        return [by_message.get(p.get("original_message_id")) for p in payloads]
+    except Exception as exc:
+        logger.error("Ошибка пакетного сохранения постов в Supabase для user %s: %s", user_id, exc)
+        return [None] * len(posts)
+
+
 def _slugify_path_part(value: str) -> str:
     value = value.strip().lower()
     # Разрешаем латиницу/цифры/дефис/подчёркивание/точку
@@ -229,7 +281,7 @@ def _guess_mime_type(path: str) -> Tuple[str, str]:
     if not mime:
         # Фолбэк
         ext = pathlib.Path(path).suffix.lower().lstrip(".")
-        if ext in {"jpg", "jpeg", "png", "webp", "bmp", "tiff"}:
+        if ext in {"jpg", "jpeg", "png", "webp", "avif", "bmp", "tiff"}:
             mime = "image/" + ("jpeg" if ext in {"jpg", "jpeg"} else ext)
         elif ext in {"mp4", "mov", "mkv", "webm", "m4v"}:
             mime = "video/" + ext
@@ -247,39 +299,59 @@ def _guess_mime_type(path: str) -> Tuple[str, str]:
 
 def create_oversized_media_placeholders(oversized_items: List[Dict[str, Any]], channel: str, start_order_index: int = 0) -> List[Dict[str, Any]]:
     """
-    Создает заглушки для больших файлов (>200MB) без загрузки.
+    Создает заглушки для больших файлов (больше лимита download.max_file_mb) без загрузки.
     
     Args:
         oversized_items: Список словарей с информацией о больших файлах
         channel: Канал Telegram
         start_order_index: Начальный индекс для order_index
         
+    Returns:
+        Список метаданных для сохранения в БД
+    """
+    return create_deferred_media_placeholders(oversized_items, channel, start_order_index, oversized=True)
+
+
+def create_deferred_media_placeholders(items: List[Dict[str, Any]], channel: str, start_order_index: int = 0,
+                                       oversized: bool = False) -> List[Dict[str, Any]]:
+    """
+    Создает заглушки медиа (is_loaded=false), которые загружаются позже по telegram_message_id.
+    oversized=False — отложенная загрузка (режим без медиа), True — файл больше лимита.
+    
+    Args:
+        items: Словари с size, message_id, media_type и (если известны до загрузки) mime_type, width, height, duration
+        channel: Канал Telegram
+        start_order_index: Начальный индекс для order_index
+        oversized: Флаг большого файла
+        
     Returns:
         Список метаданных для сохранения в БД
     """
     results: List[Dict[str, Any]] = []
+    scheme = "oversized" if oversized else "deferred"
     
-    for idx, item in enumerate(oversized_items):
+    for idx, item in enumerate(items):
         file_size = item.get('size', 0)
         message_id = item.get('message_id')
         media_type = item.get('media_type', 'video')
         
-        logger.info(f"Creating placeholder for oversized {media_type} ({file_size / 1024 / 1024:.2f} MB) from message {message_id}")
+        if oversized:
+            logger.info(f"Creating placeholder for oversized {media_type} ({file_size / 1024 / 1024:.2f} MB) from message {message_id}")
         
         # URL для заглушки - будет обработан на фронтенде
-        placeholder_url = f"oversized://{channel}/{message_id}"
+        placeholder_url = f"{scheme}://{channel}/{message_id}"
         
         results.append({
             "media_type": media_type,
-            "mime_type": f"{media_type}/placeholder",
+            "mime_type": item.get('mime_type') or f"{media_type}/placeholder",
             "url": placeholder_url,
             "storage_path": None,
-            "width": None,
-            "height": None,
-            "duration": None,
+            "width": item.get('width'),
+            "height": item.get('height'),
+            "duration": item.get('duration'),
             "order_index": start_order_index + idx,
             "file_size_bytes": file_size,
-            "is_oversized": True,
+            "is_oversized": oversized,
             "is_loaded": False,
             "telegram_message_id": message_id,
             "telegram_channel": channel,
@@ -287,6 +359,25 @@ def create_oversized_media_placeholders(oversized_items: List[Dict[str, Any]], c
     
     return results
 
+def _storage_upload(storage: Any, local_path: str, dest_path: str, mime: str, upsert: bool = True) -> None:
+    """
+    Синхронная загрузка файла в Storage (таймауты — у HTTP-клиента storage).
+    Конвейер выгружает асинхронно через app.storage_uploader.
+    """
+    with open(local_path, "rb") as f:
+        # В storage-py параметры upload передаются как HTTP-заголовки.
+        # Нельзя передавать bool, иначе httpx ругается: "Header value must be str or bytes".
+        # Используем корректные заголовки: content-type и x-upsert: "true".
+        storage.upload(
+            file=f,
+            path=dest_path,
+            file_options={
+                "content-type": mime,
+                "x-upsert": "true" if upsert else "false",
+            },
+        )
+
+
 def upload_media_files(local_paths: List[str], channel: str, original_message_id: int | str) -> List[Dict[str, Any]]:
     """
     Загружает файлы в Storage и возвращает метаданные для сохранения в БД.
@@ -298,7 +389,6 @@ def upload_media_files(local_paths: List[str], channel: str, original_message_id
     
     logger.info(f"Starting upload of {len(local_paths)} media files for message {original_message_id}")
     
-    # На всякий случай гарантируем наличие bucket перед загрузкой
     _ensure_media_bucket()
     safe_channel = _slugify_path_part(channel.lstrip("@"))
     folder = f"{safe_channel}/{original_message_id}"
@@ -320,31 +410,7 @@ def upload_media_files(local_paths: List[str], channel: str, original_message_id
             name = pathlib.Path(local_path).name
             dest_path = f"{folder}/{name}"
             
-            with open(local_path, "rb") as f:
-                # В storage-py параметры upload передаются как HTTP-заголовки.
-                # Нельзя передавать bool, иначе httpx ругается: "Header value must be str or bytes".
-                # Используем корректные заголовки: content-type и x-upsert: "true".
-                import signal
-                
-                def timeout_handler(signum, frame):
-                    raise TimeoutError("Upload to Supabase Storage exceeded timeout")
-                
-                # Устанавливаем таймаут 5 минут для загрузки
-                old_handler = signal.signal(signal.SIGALRM, timeout_handler)
-                signal.alarm(300)  # 5 минут
-                
-                try:
-                    storage.upload(
-                        file=f,
-                        path=dest_path,
-                        file_options={
-                            "content-type": mime,
-                            "x-upsert": "true",
-                        },
-                    )
-                finally:
-                    signal.alarm(0)  # Отменяем таймаут
-                    signal.signal(signal.SIGALRM, old_handler)
+            _storage_upload(storage, local_path, dest_path, mime)
             
             public_url = storage.get_public_url(dest_path)
             logger.info(f"Successfully uploaded to: {public_url}")
@@ -359,35 +425,15 @@ def upload_media_files(local_paths: List[str], channel: str, original_message_id
                 "duration": None,
                 "order_index": idx,
             })
-        except TimeoutError as exc:
-            logger.error("TIMEOUT: Загрузка файла '%s' в Storage превысила 5 минут. Пропускаем.", local_path)
+        except httpx.TimeoutException:
+            logger.error("TIMEOUT: Загрузка файла '%s' в Storage превысила таймаут. Пропускаем.", local_path)
         except Exception as exc:
             # Если bucket отсутствует (404), пробуем создать и повторить один раз
             msg = str(exc)
             if "Bucket not found" in msg or "404" in msg:
                 try:
-                    _ensure_media_bucket()
-                    with open(local_path, "rb") as f:
-                        import signal
-                        
-                        def timeout_handler(signum, frame):
-                            raise TimeoutError("Upload to Supabase Storage exceeded timeout")
-                        
-                        old_handler = signal.signal(signal.SIGALRM, timeout_handler)
-                        signal.alarm(300)  # 5 минут
-                        
-                        try:
-                            storage.upload(
-                                file=f,
-                                path=dest_path,
-                                file_options={
-                                    "content-type": mime,
-                                    "x-upsert": "true",
-                                },
-                            )
-                        finally:
-                            signal.alarm(0)
-                            signal.signal(signal.SIGALRM, old_handler)
+                    _ensure_media_bucket(force=True)
+                    _storage_upload(storage, local_path, dest_path, mime)
                     public_url = storage.get_public_url(dest_path)
                     results.append({
                         "media_type": media_type,
@@ -400,8 +446,8 @@ def upload_media_files(local_paths: List[str], channel: str, original_message_id
                         "order_index": idx,
                     })
                     continue
-                except TimeoutError:
-                    logger.error("TIMEOUT: Повторная загрузка файла '%s' превысила 5 минут. Пропускаем.", local_path)
+                except httpx.TimeoutException:
+                    logger.error("TIMEOUT: Повторная загрузка файла '%s' превысила таймаут. Пропускаем.", local_path)
                 except Exception as exc2:
                     logger.error("Повторная загрузка после создания bucket не удалась для '%s': %s", local_path, exc2)
             else:
@@ -409,6 +455,135 @@ def upload_media_files(local_paths: List[str], channel: str, original_message_id
     return results
 
 
+def _media_object_item(obj: Dict[str, Any]) -> Dict[str, Any]:
+    """Строка media_objects → метаданные для post_media."""
+    return {
+        "media_type": obj.get("media_type"),
+        "mime_type": obj.get("mime_type"),
+        "url": obj.get("url"),
+        "storage_path": obj.get("storage_path"),
+        "width": obj.get("width"),
+        "height": obj.get("height"),
+        "duration": obj.get("duration"),
+        "thumbnail_url": obj.get("thumbnail_url"),
+        "thumbnail_path": obj.get("thumbnail_path"),
+        "order_index": 0,
+        "file_size_bytes": obj.get("file_size_bytes"),
+    }
+
+
+def find_media_objects(telegram_keys: List[str], branding_key: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Уже выгруженные медиа по ключам Telegram (photo:<id> / document:<id>) для текущих настроек брендирования.
+    Returns:
+        {telegram_media_key: метаданные для post_media}
+    """
+    if not telegram_keys:
+        return {}
+    try:
+        response = (
+            _client()
+            .table(MEDIA_OBJECTS_TABLE)
+            .select("*")
+            .in_("telegram_media_key", list(set(telegram_keys)))
+            .eq("branding_key", branding_key)
+            .execute()
+        )
+        if _has_error(response):
+            raise RuntimeError(getattr(response, "error", "Unknown Supabase error"))
+        return {row["telegram_media_key"]: _media_object_item(row) for row in response.data or []}
+    except Exception as exc:
+        logger.error("Ошибка поиска медиа в индексе media_objects: %s", exc)
+        return {}
+
+
+def find_media_object_by_hash(content_hash: str) -> Optional[Dict[str, Any]]:
+    """Выгруженный файл с тем же sha256 содержимого (метаданные для post_media) или None."""
+    try:
+        response = (
+            _client()
+            .table(MEDIA_OBJECTS_TABLE)
+            .select("*")
+            .eq("content_hash", content_hash)
+            .limit(1)
+            .execute()
+        )
+        if _has_error(response):
+            raise RuntimeError(getattr(response, "error", "Unknown Supabase error"))
+        rows = response.data or []
+        return _media_object_item(rows[0]) if rows else None
+    except Exception as exc:
+        logger.error("Ошибка поиска медиа по хэшу %s: %s", content_hash, exc)
+        return None
+
+
+def register_media_object(telegram_key: str, branding_key: str, content_hash: str, item: Dict[str, Any]) -> None:
+    """Запоминает выгруженный файл в индексе media_objects."""
+    payload = {
+        "telegram_media_key": telegram_key,
+        "branding_key": branding_key,
+        "content_hash": content_hash,
+        "storage_path": item.get("storage_path"),
+        "url": item.get("url"),
+        "media_type": item.get("media_type"),
+        "mime_type": item.get("mime_type"),
+        "file_size_bytes": item.get("file_size_bytes"),
+        "width": item.get("width"),
+        "height": item.get("height"),
+        "duration": item.get("duration"),
+        "thumbnail_url": item.get("thumbnail_url"),
+        "thumbnail_path": item.get("thumbnail_path"),
+    }
+    try:
+        response = (
+            _client()
+            .table(MEDIA_OBJECTS_TABLE)
+            .upsert(payload, on_conflict="telegram_media_key,branding_key")
+            .execute()
+        )
+        if _has_error(response):
+            raise RuntimeError(getattr(response, "error", "Unknown Supabase error"))
+    except Exception as exc:
+        logger.error("Ошибка сохранения медиа %s в индекс media_objects: %s", telegram_key, exc)
+
+
+def media_object_path(local_path: str, content_hash: str) -> str:
+    """Адрес объекта по содержимому: objects/<hash[:2]>/<hash><ext> (путь неизменяем)."""
+    return f"objects/{content_hash[:2]}/{content_hash}{pathlib.Path(local_path).suffix.lower()}"
+
+
+def media_stream_path(telegram_key: str, ext: str) -> str:
+    """Адрес файла, выгруженного потоком из Telegram (sha256 заранее неизвестен): objects/tg/<ключ><ext>."""
+    return f"objects/tg/{telegram_key.replace(':', '-')}{ext.lower()}"
+
+
+def media_thumbnail_path(local_path: str, storage_path: str) -> str:
+    """Превью (WebP) или постер видео рядом с оригиналом: <оригинал без расширения>_thumb<ext>."""
+    return f"{storage_path.rsplit('.', 1)[0]}_thumb{pathlib.Path(local_path).suffix.lower()}"
+
+
+def media_public_url(storage_path: str) -> str:
+    return _client().storage.from_(MEDIA_BUCKET).get_public_url(storage_path)
+
+
+def media_object_metadata(local_path: str, storage_path: str) -> Dict[str, Any]:
+    """Метаданные для post_media / media_objects только что выгруженного файла."""
+    mime, media_type = _guess_mime_type(local_path)
+    return {
+        "media_type": media_type,
+        "mime_type": mime,
+        "url": media_public_url(storage_path),
+        "storage_path": storage_path,
+        "width": None,
+        "height": None,
+        "duration": None,
+        "thumbnail_url": None,
+        "thumbnail_path": None,
+        "order_index": 0,
+        "file_size_bytes": pathlib.Path(local_path).stat().st_size,
+    }
+
+
 def get_media_item(media_id: str) -> Optional[Dict[str, Any]]:
     """Получает конкретный медиафайл по ID."""
     if not media_id:
@@ -436,6 +611,40 @@ def update_media_item(media_id: str, updates: Dict[str, Any]) -> bool:
         logger.error("Ошибка обновления медиафайла %s в Supabase: %s", media_id, exc)
         return False
 
+def save_media_rows(rows: List[Dict[str, Any]]) -> int:
+    """Сохраняет медиа нескольких постов одним запросом (в каждой строке уже есть post_id)."""
+    if not rows:
+        return 0
+    try:
+        response = _client().table(MEDIA_TABLE).insert(rows).execute()
+        if _has_error(response):
+            raise RuntimeError(getattr(response, "error", "Unknown Supabase error"))
+        data = response.data or []
+        return len(data) if isinstance(data, list) else len(rows)
+    except Exception as exc:
+        logger.error("Ошибка пакетного сохранения медиа: %s", exc)
+        return 0
+
+def list_unloaded_media(limit: int = 20, include_oversized: bool = False) -> List[Dict[str, Any]]:
+    """Отложенные медиа (is_loaded=false), самые свежие первыми — для фоновой догрузки."""
+    try:
+        query = (
+            _client()
+            .table(MEDIA_TABLE)
+            .select("*")
+            .eq("is_loaded", False)
+            .not_.is_("telegram_message_id", "null")
+        )
+        if not include_oversized:
+            query = query.eq("is_oversized", False)
+        response = query.order("created_at", desc=True).limit(limit).execute()
+        if _has_error(response):
+            raise RuntimeError(getattr(response, "error", "Unknown Supabase error"))
+        return response.data or []
+    except Exception as exc:
+        logger.error("Ошибка получения отложенных медиа из Supabase: %s", exc)
+        return []
+
 def save_post_media(post_id: str, media_items: List[Dict[str, Any]]) -> int:
     """
     Сохраняет список медиа для поста.
@@ -491,6 +700,67 @@ def get_all_posts(user_id: str, sort_by: str = "original_date") -> List[Dict[str
         return []
 
 
+# Колонки, нужные для обновления метрик (без тяжёлых переводов)
+REFRESH_POST_COLUMNS = (
+    "id,source_channel,original_message_id,original_ids,content,original_edit_date,"
+    "original_views,original_likes,original_comments,original_reactions"
+)
+
+
+def list_posts_for_refresh(user_id: str, channel: Optional[str] = None, limit: Optional[int] = None,
+                           page_size: int = 1000) -> List[Dict[str, Any]]:
+    """
+    Посты пользователя для обновления метрик (самые свежие первыми), постранично.
+    
+    Args:
+        user_id: UUID пользователя
+        channel: Ограничить одним каналом (source_channel)
+        limit: Максимум постов (None — все)
+    """
+    results: List[Dict[str, Any]] = []
+    try:
+        while limit is None or len(results) < limit:
+            size = page_size if limit is None else min(page_size, limit - len(results))
+            query = _client().table(POSTS_TABLE).select(REFRESH_POST_COLUMNS).eq("user_id", user_id)
+            if channel:
+                query = query.eq("source_channel", channel)
+            start = len(results)
+            response = query.order("original_date", desc=True).range(start, start + size - 1).execute()
+            if _has_error(response):
+                raise RuntimeError(getattr(response, "error", "Unknown Supabase error"))
+            page = response.data or []
+            results.extend(page)
+            if len(page) < size:
+                break
+    except Exception as exc:
+        logger.error("Ошибка получения постов для обновления метрик (user %s): %s", user_id, exc)
+    return results
+
+
+def apply_post_metrics(rows: List[Dict[str, Any]], chunk_size: int = 500) -> int:
+    """
+    Пакетно применяет изменённые метрики/текст постов (функция apply_post_metrics в БД).
+    В каждой строке id поста и только изменившиеся поля. Возвращает число обновлённых постов.
+    """
+    updated = 0
+    for i in range(0, len(rows), chunk_size):
+        chunk = rows[i:i + chunk_size]
+        payload = []
+        for row in chunk:
+            item = dict(row)
+            if "original_edit_date" in item:
+                item["original_edit_date"] = _serialize_datetime(item["original_edit_date"])
+            payload.append(item)
+        try:
+            response = _client().rpc("apply_post_metrics", {"p_rows": payload}).execute()
+            if _has_error(response):
+                raise RuntimeError(getattr(response, "error", "Unknown Supabase error"))
+            updated += int(response.data or 0) if not isinstance(response.data, list) else len(chunk)
+        except Exception as exc:
+            logger.error("Ошибка пакетного обновления метрик (%s постов): %s", len(chunk), exc)
+    return updated
+
+
 def get_all_posts_with_media(user_id: str, sort_by: str = "original_date") -> List[Dict[str, Any]]:
     """
     Возвращает посты конкретного пользователя и вложенные для них медиа (массив media[]).
@@ -526,6 +796,8 @@ def get_all_posts_with_media(user_id: str, sort_by: str = "original_date") -> Li
             "width": row.get("width"),
             "height": row.get("height"),
             "duration": row.get("duration"),
+            "thumbnail_url": row.get("thumbnail_url"),
+            "thumbnail_path": row.get("thumbnail_path"),
             "order_index": row.get("order_index"),
             "file_size_bytes": row.get("file_size_bytes"),
             "is_oversized": row.get("is_oversized"),
@@ -571,6 +843,49 @@ def update_post(post_id: str, updates: Dict[str, Any]) -> bool:
         return False
 
 
+def find_posts_by_message(user_id: str, source_channel: str, message_id: int) -> List[Dict[str, Any]]:
+    """Посты пользователя из канала, в которые входит сообщение (одиночное или часть альбома)."""
+    try:
+        response = (
+            _client()
+            .table(POSTS_TABLE)
+            .select("id, original_message_id, original_ids, content")
+            .eq("user_id", user_id)
+            .eq("source_channel", source_channel)
+            # original_ids — jsonb-массив, поэтому фильтр cs с JSON-литералом
+            .filter("original_ids", "cs", json.dumps([int(message_id)]))
+            .execute()
+        )
+        if _has_error(response):
+            raise RuntimeError(getattr(response, "error", "Unknown Supabase error"))
+        return response.data or []
+    except Exception as exc:
+        logger.error("Ошибка поиска поста по сообщению %s/%s: %s", source_channel, message_id, exc)
+        return []
+
+
+def get_saved_message_ids(user_id: str, source_channel: str, message_ids: List[int]) -> set:
+    """Какие из original_message_id уже сохранены у пользователя для канала."""
+    if not message_ids:
+        return set()
+    try:
+        response = (
+            _client()
+            .table(POSTS_TABLE)
+            .select("original_message_id")
+            .eq("user_id", user_id)
+            .eq("source_channel", source_channel)
+            .in_("original_message_id", [int(i) for i in message_ids])
+            .execute()
+        )
+        if _has_error(response):
+            raise RuntimeError(getattr(response, "error", "Unknown Supabase error"))
+        return {int(row["original_message_id"]) for row in (response.data or [])}
+    except Exception as exc:
+        logger.error("Ошибка проверки сохранённых постов канала %s: %s", source_channel, exc)
+        return set()
+
+
 def delete_post(post_id: str) -> bool:
     if not post_id:
         return False
@@ -695,6 +1010,18 @@ def is_channel_saved(user_id: str, channel_username: str) -> bool:
     return bool(channel and channel.get("username") == clean_username)
 
 
+def list_saved_channels() -> List[Dict[str, Any]]:
+    """Сохранённые каналы всех пользователей (для режима наблюдения)."""
+    try:
+        response = _client().table(CHANNELS_TABLE).select("user_id, username").execute()
+        if _has_error(response):
+            raise RuntimeError(getattr(response, "error", "Unknown Supabase error"))
+        return [row for row in (response.data or []) if row.get("user_id") and row.get("username")]
+    except Exception as exc:
+        logger.error("Ошибка получения сохраненных каналов из Supabase: %s", exc)
+        return []
+
+
 def delete_saved_channel(user_id: str) -> bool:
     """
     Удаляет сохраненный канал конкретного пользователя.
@@ -715,6 +1042,160 @@ def delete_saved_channel(user_id: str) -> bool:
         return False
 
 
+def _normalize_channel_key(channel: str) -> str:
+    return (channel or "").strip().lstrip("@").lower()
+
+
+def get_channel_watermark(user_id: str, channel: str) -> int:
+    """
+    Возвращает последний сохранённый message_id канала для пользователя.
+    
+    Args:
+        user_id: UUID пользователя
+        channel: Имя канала
+        
+    Returns:
+        message_id или 0, если канал ещё не синхронизировался
+    """
+    try:
+        response = (
+            _client()
+            .table(SYNC_STATE_TABLE)
+            .select("last_message_id")
+            .eq("user_id", user_id)
+            .eq("channel", _normalize_channel_key(channel))
+            .limit(1)
+            .execute()
+        )
+        if _has_error(response):
+            raise RuntimeError(getattr(response, "error", "Unknown Supabase error"))
+        rows = response.data or []
+        return int(rows[0].get("last_message_id") or 0) if rows else 0
+    except Exception as exc:
+        logger.error("Ошибка получения водяного знака канала %s для user %s: %s", channel, user_id, exc)
+        return 0
+
+
+def advance_channel_watermark(user_id: str, channel: str, last_message_id: int) -> bool:
+    """
+    Продвигает водяной знак канала вперёд (меньшее значение игнорируется на стороне БД).
+    
+    Args:
+        user_id: UUID пользователя
+        channel: Имя канала
+        last_message_id: ID последнего сохранённого сообщения
+        
+    Returns:
+        True если успешно сохранено
+    """
+    try:
+        response = _client().rpc(
+            "advance_channel_watermark",
+            {
+                "p_user_id": user_id,
+                "p_channel": _normalize_channel_key(channel),
+                "p_last_message_id": int(last_message_id),
+            },
+        ).execute()
+        if _has_error(response):
+            raise RuntimeError(getattr(response, "error", "Unknown Supabase error"))
+        return True
+    except Exception as exc:
+        logger.error("Ошибка сохранения водяного знака канала %s для user %s: %s", channel, user_id, exc)
+        return False
+
+
+def get_cached_channel_entity(account_id: int, channel_key: str) -> Optional[Dict[str, Any]]:
+    """
+    Возвращает закэшированный канал (channel_id, access_hash, title, username, resolved_at).
+    
+    Args:
+        account_id: Telegram ID аккаунта, для которого получен access_hash
+        channel_key: Нормализованное имя/ссылка канала
+    """
+    try:
+        response = (
+            _client()
+            .table(ENTITY_CACHE_TABLE)
+            .select("*")
+            .eq("account_id", account_id)
+            .eq("channel_key", channel_key)
+            .limit(1)
+            .execute()
+        )
+        if _has_error(response):
+            raise RuntimeError(getattr(response, "error", "Unknown Supabase error"))
+        rows = response.data or []
+        return rows[0] if rows else None
+    except Exception as exc:
+        logger.error("Ошибка чтения кэша канала %s: %s", channel_key, exc)
+        return None
+
+
+def save_cached_channel_entity(account_id: int, channel_key: str, channel_id: int, access_hash: int,
+                               title: Optional[str], username: Optional[str],
+                               dc_id: Optional[int] = None) -> bool:
+    """Сохраняет (или обновляет) разрешённый канал в кэше."""
+    payload = {
+        "account_id": account_id,
+        "channel_key": channel_key,
+        "channel_id": channel_id,
+        "access_hash": access_hash,
+        "title": title,
+        "username": username,
+        "dc_id": dc_id,
+        "resolved_at": datetime.now(timezone.utc).isoformat(),
+    }
+    try:
+        response = _client().table(ENTITY_CACHE_TABLE).upsert(payload, on_conflict="account_id,channel_key").execute()
+        if _has_error(response):
+            raise RuntimeError(getattr(response, "error", "Unknown Supabase error"))
+        return True
+    except Exception as exc:
+        logger.error("Ошибка сохранения кэша канала %s: %s", channel_key, exc)
+        return False
+
+
+def get_cached_channel_dc(channel_key: str) -> Optional[int]:
+    """DC канала из кэша любого аккаунта (DC — свойство канала, а не аккаунта)."""
+    try:
+        response = (
+            _client()
+            .table(ENTITY_CACHE_TABLE)
+            .select("dc_id")
+            .eq("channel_key", channel_key)
+            .not_.is_("dc_id", "null")
+            .limit(1)
+            .execute()
+        )
+        if _has_error(response):
+            raise RuntimeError(getattr(response, "error", "Unknown Supabase error"))
+        rows = response.data or []
+        return int(rows[0]["dc_id"]) if rows else None
+    except Exception as exc:
+        logger.error("Ошибка чтения DC канала %s: %s", channel_key, exc)
+        return None
+
+
+def delete_cached_channel_entity(account_id: int, channel_key: str) -> bool:
+    """Удаляет канал из кэша (например, после ChannelPrivateError)."""
+    try:
+        response = (
+            _client()
+            .table(ENTITY_CACHE_TABLE)
+            .delete()
+            .eq("account_id", account_id)
+            .eq("channel_key", channel_key)
+            .execute()
+        )
+        if _has_error(response):
+            raise RuntimeError(getattr(response, "error", "Unknown Supabase error"))
+        return True
+    except Exception as exc:
+        logger.error("Ошибка удаления кэша канала %s: %s", channel_key, exc)
+        return False
+
+
 # ===============================
 # User Profiles and Roles API
 # ===============================
@@ -932,6 +1413,65 @@ def get_global_telegram_credentials() -> Optional[Dict[str, Any]]:
     return None
 
 
+def list_ingest_telegram_credentials() -> List[Dict[str, Any]]:
+    """
+    Возвращает активные credentials, которые участвуют в ингесте:
+    глобальные (первыми) и все, помеченные in_ingest_pool.
+    
+    Returns:
+        Список словарей с credentials (может быть пустым)
+    """
+    try:
+        response = (
+            _client()
+            .table(USER_CREDENTIALS_TABLE)
+            .select("*")
+            .eq("is_active", True)
+            .or_("user_identifier.eq.global,in_ingest_pool.eq.true")
+            .order("created_at")
+            .execute()
+        )
+        if _has_error(response):
+            raise RuntimeError(getattr(response, "error", "Unknown Supabase error"))
+        rows = response.data or []
+        rows.sort(key=lambda row: row.get("user_identifier") != "global")
+        return rows
+    except Exception as exc:
+        logger.error("Ошибка получения пула credentials: %s", exc)
+        global_credentials = get_global_telegram_credentials()
+        return [global_credentials] if global_credentials else []
+
+
+def set_ingest_pool_membership(user_identifier: str, enabled: bool) -> bool:
+    """
+    Включает или исключает аккаунт пользователя из пула ингеста.
+    
+    Args:
+        user_identifier: Уникальный идентификатор пользователя
+        enabled: True — аккаунт участвует в обработке каналов
+        
+    Returns:
+        True если запись найдена и обновлена, False иначе
+    """
+    try:
+        response = (
+            _client()
+            .table(USER_CREDENTIALS_TABLE)
+            .update({"in_ingest_pool": bool(enabled)})
+            .eq("user_identifier", user_identifier)
+            .eq("is_active", True)
+            .execute()
+        )
+        
+        if _has_error(response):
+            raise RuntimeError(getattr(response, "error", "Unknown Supabase error"))
+        
+        return bool(response.data)
+    except Exception as exc:
+        logger.error("Ошибка изменения пула ингеста для %s: %s", user_identifier, exc)
+        return False
+
+
 def validate_telegram_credentials_exist() -> tuple[bool, Optional[str]]:
     """
     Проверяет наличие и валидность глобальных credentials.
@@ -0,0 +1,238 @@
+# telegram_governor.py
+# Центральный регулятор запросов к Telegram: token bucket на класс методов,
+# ожидание FloodWait с джиттером, адаптивное замедление (AIMD) и учёт
+# времени, проведённого в flood wait.
+
+import asyncio
+import random
+import time
+import weakref
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+
+from telethon.errors import FloodWaitError
+
+T = TypeVar("T")
+
+# Классы методов и их скорость по умолчанию: (запросов в секунду, burst)
+DEFAULT_RATES: Dict[str, tuple] = {
+    "resolve": (0.5, 3),    # ResolveUsername / get_entity — самые жёсткие лимиты
+    "history": (3.0, 5),    # GetHistory (страница до 100 сообщений)
+    "messages": (3.0, 5),   # GetMessages по id
+    "download": (8.0, 8),   # загрузка файла целиком (внутри — серия GetFile)
+    "default": (5.0, 5),
+}
+
+
+@dataclass
+class HistoryPage:
+    """Положение обхода истории: закончилась ли страница GetHistory на последнем выданном сообщении."""
+    at_boundary: bool = False
+
+
+def _page_exhausted(it) -> bool:
+    # Буфер RequestIter Telethon выбран, а история не кончилась — следующее сообщение потребует запроса
+    buffer = getattr(it, "buffer", None)
+    return buffer is not None and it.index >= len(buffer) and it.left > 0
+
+
+class TokenBucket:
+    """Token bucket с изменяемой скоростью и временной блокировкой после FloodWait."""
+
+    def __init__(self, rate: float, burst: int):
+        self.base_rate = max(0.01, float(rate))
+        self.rate = self.base_rate
+        self.min_rate = self.base_rate / 16
+        self.burst = max(1, int(burst))
+        self.tokens = float(self.burst)
+        self.blocked_until = 0.0
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def take(self) -> None:
+        # Под замком — чтобы ожидающие получали токены по очереди, а не толпой
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def slow_down(self) -> None:
+        # Мультипликативное снижение после FloodWait
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = min(self.tokens, 0.0)
+
+    def speed_up(self) -> None:
+        # Аддитивное восстановление после успешного запроса
+        if self.rate < self.base_rate:
+            self.rate = min(self.base_rate, self.rate + self.base_rate * 0.05)
+
+
+@dataclass
+class GovernorStats:
+    calls: int = 0
+    flood_waits: int = 0
+    flood_wait_seconds: float = 0.0
+    by_class: Dict[str, float] = field(default_factory=dict)
+
+    def copy(self) -> "GovernorStats":
+        return GovernorStats(self.calls, self.flood_waits, self.flood_wait_seconds, dict(self.by_class))
+
+    def since(self, start: "GovernorStats") -> "GovernorStats":
+        return GovernorStats(
+            calls=self.calls - start.calls,
+            flood_waits=self.flood_waits - start.flood_waits,
+            flood_wait_seconds=self.flood_wait_seconds - start.flood_wait_seconds,
+            by_class={k: v - start.by_class.get(k, 0.0) for k, v in self.by_class.items()},
+        )
+
+
+class TelegramGovernor:
+    """
+    Все вызовы Telethon в пайплайне идут через call()/iter_messages().
+    FloodWait: класс методов блокируется на e.seconds (+джиттер) для всех корутин сразу,
+    скорость класса снижается вдвое и плавно восстанавливается на успешных запросах.
+    Ожидание дольше max_flood_wait не выполняется — ошибка пробрасывается наверх.
+    """
+
+    def __init__(self, cfg: Optional[Dict[str, Any]] = None):
+        cfg = cfg or {}
+        self.max_retries = int(cfg.get("max_retries", 5))
+        self.max_flood_wait = float(cfg.get("max_flood_wait", 900))
+        self.jitter = float(cfg.get("jitter", 0.15))
+        rates = dict(DEFAULT_RATES)
+        for name, value in (cfg.get("rates") or {}).items():
+            value = value or {}
+            base_rate, base_burst = rates.get(name, DEFAULT_RATES["default"])
+            rates[name] = (float(value.get("rate", base_rate)), int(value.get("burst", base_burst)))
+        self._buckets: Dict[str, TokenBucket] = {name: TokenBucket(*rb) for name, rb in rates.items()}
+        self.stats = GovernorStats()
+        # (время, секунды ожидания) последних FloodWait — для распределения работы между аккаунтами
+        self._flood_history: deque = deque(maxlen=256)
+
+    def _bucket(self, method_class: str) -> TokenBucket:
+        if method_class not in self._buckets:
+            self._buckets[method_class] = TokenBucket(*DEFAULT_RATES["default"])
+        return self._buckets[method_class]
+
+    async def acquire(self, method_class: str) -> None:
+        await self._bucket(method_class).take()
+
+    async def on_flood_wait(self, method_class: str, error: FloodWaitError) -> None:
+        seconds = float(getattr(error, "seconds", 0) or 0)
+        if seconds > self.max_flood_wait:
+            print(f"FloodWait {seconds:.0f}s for '{method_class}' exceeds limit {self.max_flood_wait:.0f}s, giving up.")
+            raise error
+        wait = seconds * (1 + random.uniform(0, self.jitter)) + random.uniform(0.5, 1.5)
+        bucket = self._bucket(method_class)
+        bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + wait)
+        bucket.slow_down()
+        self.stats.flood_waits += 1
+        self.stats.flood_wait_seconds += wait
+        self.stats.by_class[method_class] = self.stats.by_class.get(method_class, 0.0) + wait
+        self._flood_history.append((time.monotonic(), wait))
+        print(f"FloodWait: '{method_class}' paused for {wait:.1f}s (Telegram asked {seconds:.0f}s), rate now {bucket.rate:.2f}/s")
+        await asyncio.sleep(max(0.0, bucket.blocked_until - time.monotonic()))
+
+    def recent_flood_seconds(self, window: float = 600.0) -> float:
+        """Суммарное время FloodWait за последние window секунд."""
+        since = time.monotonic() - window
+        return sum(wait for at, wait in self._flood_history if at >= since)
+
+    def blocked_seconds(self) -> float:
+        """Сколько ещё заблокирован самый «наказанный» класс методов."""
+        now = time.monotonic()
+        return max([0.0] + [b.blocked_until - now for b in self._buckets.values()])
+
+    def on_success(self, method_class: str) -> None:
+        self.stats.calls += 1
+        self._bucket(method_class).speed_up()
+
+    async def call(self, method_class: str, factory: Callable[[], Awaitable[T]]) -> T:
+        """Выполняет запрос, созданный factory(), с учётом лимитов и повторами на FloodWait."""
+        attempt = 0
+        while True:
+            await self.acquire(method_class)
+            try:
+                result = await factory()
+            except FloodWaitError as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                await self.on_flood_wait(method_class, e)
+                continue
+            self.on_success(method_class)
+            return result
+
+    async def iter_messages(self, client, entity, limit: Optional[int] = None,
+                            page: Optional[HistoryPage] = None, **kwargs):
+        """
+        Аналог client.iter_messages, переживающий FloodWait посреди обхода:
+        продолжает с последнего выданного id, не повторяя сообщения.
+        Токен класса 'history' берётся перед каждой страницей; границы страниц берутся
+        из самого итератора (первая страница и страница после FloodWait бывают короче 100).
+        page, если передан, обновляется перед каждым выданным сообщением.
+        """
+        reverse = bool(kwargs.get("reverse", False))
+        yielded = 0
+        last_id = None
+        attempt = 0
+        while True:
+            params = dict(kwargs)
+            if last_id is not None:
+                if reverse:
+                    params["min_id"] = max(int(params.get("min_id") or 0), last_id)
+                else:
+                    params["offset_id"] = last_id
+            remaining = None if limit is None else limit - yielded
+            if remaining is not None and remaining <= 0:
+                return
+            await self.acquire("history")
+            try:
+                it = client.iter_messages(entity, limit=remaining, **params)
+                async for m in it:
+                    boundary = _page_exhausted(it)
+                    if page is not None:
+                        page.at_boundary = boundary
+                    yield m
+                    yielded += 1
+                    last_id = m.id
+                    if boundary:
+                        self.on_success("history")
+                        await self.acquire("history")
+                self.on_success("history")
+                return
+            except FloodWaitError as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                await self.on_flood_wait("history", e)
+
+
+# Один регулятор на клиента (аккаунт): лимиты Telegram считаются по аккаунту
+_governors: "weakref.WeakKeyDictionary[Any, TelegramGovernor]" = weakref.WeakKeyDictionary()
+
+
+def governor_for(client, cfg: Optional[Dict[str, Any]] = None) -> TelegramGovernor:
+    """Возвращает регулятор клиента, создавая его при первом обращении."""
+    governor = _governors.get(client)
+    if governor is None:
+        governor = TelegramGovernor(cfg)
+        _governors[client] = governor
+        # FloodWait обрабатываем сами, чтобы учитывать и перераспределять ожидание
+        try:
+            client.flood_sleep_threshold = int((cfg or {}).get("telethon_flood_sleep_threshold", 0))
+        except Exception:
+            pass
+    return governor
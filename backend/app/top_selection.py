@@ -0,0 +1,99 @@
+# top_selection.py
+# Потоковый отбор топ-постов за период: ограниченные кучи по каждой метрике
+# и индекс альбомов grouped_id → message ids. Полные сообщения не храним.
+
+import heapq
+from typing import Dict, List, Optional
+
+METRIC_KEYS = ("likes", "comments", "views")
+
+
+class TopPostSelector:
+    """
+    Повторяет правила отбора process_top_posts без хранения всех сообщений:
+    - по каждой метрике берётся quota лучших (только положительные, если такие есть);
+    - сообщение, уже выбранное по предыдущей метрике, повторно не берётся;
+    - при равных значениях выигрывает более раннее в порядке обхода (более свежее).
+
+    Поэтому куча метрики держит quota + сумма квот предыдущих метрик элементов:
+    столько максимум может «съесть» дедупликация.
+    """
+
+    def __init__(self, top_counts: Dict[str, int], desired_total: Optional[int] = None):
+        self.quotas = {k: max(0, int((top_counts or {}).get(k, 0) or 0)) for k in METRIC_KEYS}
+        self.desired_total = desired_total if isinstance(desired_total, int) and desired_total > 0 else None
+        self._capacity: Dict[str, int] = {}
+        reserved = 0
+        for key in METRIC_KEYS:
+            quota = self.quotas[key]
+            self._capacity[key] = quota + reserved if quota else 0
+            reserved += quota
+        # Мин-кучи (value, -seq, mid): вытесняется меньшее значение, при равенстве — более позднее
+        self._heaps: Dict[str, list] = {k: [] for k in METRIC_KEYS}
+        self.album_index: Dict[int, List[int]] = {}
+        self._grouped_of: Dict[int, int] = {}
+        # Для фолбэка «по дате»: первые N в порядке обхода (обход идёт от новых к старым)
+        self._latest: List[int] = []
+        self.scanned = 0
+
+    def add(self, mid: int, grouped_id: Optional[int], views: int, comments: int, likes: int) -> None:
+        seq = self.scanned
+        self.scanned += 1
+        if grouped_id:
+            self.album_index.setdefault(grouped_id, []).append(mid)
+            self._grouped_of[mid] = grouped_id
+        if self.desired_total is None or len(self._latest) < self.desired_total:
+            self._latest.append(mid)
+        values = {"likes": likes, "comments": comments, "views": views}
+        for key in METRIC_KEYS:
+            cap = self._capacity[key]
+            if not cap:
+                continue
+            entry = (int(values[key] or 0), -seq, mid)
+            heap = self._heaps[key]
+            if len(heap) < cap:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+
+    def _ranked(self, key: str) -> List[int]:
+        ranked = sorted(self._heaps[key], reverse=True)
+        positives = [e for e in ranked if e[0] > 0]
+        return [e[2] for e in (positives or ranked)]
+
+    def select(self) -> List[int]:
+        """Возвращает выбранные message id в порядке отбора (с фолбэком по дате)."""
+        unique_ids = set()
+        selected: List[int] = []
+        for key in METRIC_KEYS:
+            quota = self.quotas[key]
+            if not quota:
+                continue
+            count_added = 0
+            for mid in self._ranked(key):
+                if count_added >= quota:
+                    break
+                if mid in unique_ids:
+                    continue
+                unique_ids.add(mid)
+                selected.append(mid)
+                count_added += 1
+        if self.desired_total is not None:
+            selected = selected[:self.desired_total]
+        if not selected:
+            # Фолбэк: если ничего не набрали по метрикам, берём просто свежие посты
+            selected = list(self._latest)
+        return selected
+
+    def units(self, selected: List[int]) -> List[List[int]]:
+        """Группирует выбранные id в единицы постов: альбом целиком, без повторов."""
+        units: List[List[int]] = []
+        used = set()
+        for mid in selected:
+            gid = self._grouped_of.get(mid)
+            key = ("gid", gid) if gid else ("mid", mid)
+            if key in used:
+                continue
+            used.add(key)
+            units.append(sorted(self.album_index.get(gid, [mid])) if gid else [mid])
+        return units
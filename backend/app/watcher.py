@@ -0,0 +1,358 @@
+# watcher.py
+# Режим наблюдения: долгоживущий клиент получает события Telethon (NewMessage, Album,
+# MessageEdited) по каналам из saved_channel, и каждый новый пост сразу проходит
+# обычный путь download → brand → upload → persist. Пропуски (обрыв соединения,
+# каналы, на которые аккаунт не подписан) добираются запросом истории с min_id.
+
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Set
+
+from telethon import events, functions
+
+from app.client_pool import client_manager
+from app.entity_cache import channel_key
+from app.main import (
+    CFG,
+    PIPELINE_SETTINGS,
+    SPOOL,
+    ingest_post_units,
+    resolve_channel_cached,
+    telegram_governor,
+)
+from app.post_units import iter_post_units
+from app.scheduler import ChannelScheduler, SchedulerSettings
+from app.state_manager import get_last_id, set_last_id
+from app.supabase_manager import (
+    find_posts_by_message,
+    get_saved_message_ids,
+    list_saved_channels,
+    update_post,
+)
+
+
+@dataclass
+class WatchSettings:
+    """Параметры режима наблюдения (секция `watch` в config.yaml)."""
+    autostart: bool = False
+    catchup_interval_seconds: float = 300.0
+    catchup_limit: int = 200
+    connection_check_seconds: float = 5.0
+    batch_delay_seconds: float = 1.0
+    join_channels: bool = False
+
+    @classmethod
+    def from_config(cls, cfg: Optional[Dict[str, Any]]) -> "WatchSettings":
+        cfg = cfg or {}
+        defaults = cls()
+        return cls(
+            autostart=bool(cfg.get("autostart", defaults.autostart)),
+            catchup_interval_seconds=float(cfg.get("catchup_interval_seconds", defaults.catchup_interval_seconds)),
+            catchup_limit=max(1, int(cfg.get("catchup_limit", defaults.catchup_limit))),
+            connection_check_seconds=float(cfg.get("connection_check_seconds", defaults.connection_check_seconds)),
+            batch_delay_seconds=float(cfg.get("batch_delay_seconds", defaults.batch_delay_seconds)),
+            join_channels=bool(cfg.get("join_channels", defaults.join_channels)),
+        )
+
+
+@dataclass
+class WatchedChannel:
+    """Канал под наблюдением: подписанные пользователи, очередь постов и точка догонки."""
+    ch: str
+    users: Set[str] = field(default_factory=set)
+    entity: Any = None
+    channel_id: Optional[int] = None
+    title: str = ""
+    username: str = ""
+    # С этого id догоняем историю; двигается только по непрерывному префиксу сохранённых постов
+    catchup_from: Dict[str, int] = field(default_factory=dict)
+    # Самый ранний пост, который не удалось сохранить: водяной знак не переходит через него,
+    # пока догонка не сохранит его повторно
+    retry_from: Dict[str, int] = field(default_factory=dict)
+    queue: asyncio.Queue = field(default_factory=asyncio.Queue)
+    worker: Optional[asyncio.Task] = None
+    saved: int = 0
+    last_event_at: Optional[float] = None
+
+
+class ChannelWatcher:
+    """
+    Наблюдение за сохранёнными каналами поверх клиента из пула.
+    Посты каждого канала обрабатываются по одному воркеру (в порядке поступления);
+    перед сохранением отбрасываются уже сохранённые, поэтому живые события
+    и догонка по min_id могут пересекаться без дублей.
+    """
+
+    def __init__(self):
+        self.running = False
+        self.settings = WatchSettings.from_config(CFG.get("watch"))
+        self._client = None
+        self._channels: Dict[str, WatchedChannel] = {}
+        self._by_channel_id: Dict[int, str] = {}
+        self._handlers: List[tuple] = []
+        self._monitor: Optional[asyncio.Task] = None
+        self._scheduler: Optional[ChannelScheduler] = None
+        self.started_at: Optional[float] = None
+        self.events = 0
+        self.gap_recoveries = 0
+
+    # --- жизненный цикл ---
+
+    async def start(self, client) -> None:
+        if self.running:
+            return
+        self._client = client
+        # Наблюдение держит клиента часами без get() — пул не должен закрыть его по простою
+        client_manager.pin(client)
+        self._scheduler = ChannelScheduler(SchedulerSettings.from_config(CFG.get("scheduler")),
+                                           PIPELINE_SETTINGS, disk_path=str(SPOOL.root))
+        self._handlers = [
+            (self._on_new_message, events.NewMessage(func=lambda e: e.message.grouped_id is None)),
+            (self._on_album, events.Album()),
+            (self._on_edited, events.MessageEdited()),
+        ]
+        for callback, event in self._handlers:
+            client.add_event_handler(callback, event)
+        self.running = True
+        self.started_at = time.time()
+        await self.refresh()
+        # Всё, что вышло, пока наблюдение было выключено
+        await self.catch_up_all()
+        self._monitor = asyncio.create_task(self._monitor_loop())
+        print(f"Watch mode started for {len(self._channels)} channel(s).")
+
+    async def stop(self) -> None:
+        if not self.running:
+            return
+        self.running = False
+        if self._monitor:
+            self._monitor.cancel()
+            await asyncio.gather(self._monitor, return_exceptions=True)
+            self._monitor = None
+        for callback, event in self._handlers:
+            self._client.remove_event_handler(callback, event)
+        self._handlers = []
+        client_manager.unpin(self._client)
+        workers = [wc.worker for wc in self._channels.values() if wc.worker]
+        for t in workers:
+            t.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        self._channels.clear()
+        self._by_channel_id.clear()
+        print("Watch mode stopped.")
+
+    async def refresh(self) -> None:
+        """Перечитывает saved_channel: подписывает новые каналы и снимает удалённые."""
+        if not self.running:
+            return
+        rows = await asyncio.to_thread(list_saved_channels)
+        wanted: Dict[str, Set[str]] = {}
+        for row in rows:
+            wanted.setdefault(channel_key(row["username"]), set()).add(row["user_id"])
+        # Для каналов с одинаковым ключом берём имя из первой строки
+        names = {channel_key(row["username"]): row["username"] for row in rows}
+
+        for key in list(self._channels):
+            if key not in wanted:
+                wc = self._channels.pop(key)
+                self._by_channel_id.pop(wc.channel_id, None)
+                if wc.worker:
+                    wc.worker.cancel()
+        for key, users in wanted.items():
+            wc = self._channels.get(key)
+            if wc is None:
+                try:
+                    wc = await self._subscribe(names[key])
+                except Exception as e:
+                    print(f"Watch: cannot subscribe to {names[key]}: {e}")
+                    continue
+                self._channels[key] = wc
+            for user_id in users - wc.users:
+                wc.catchup_from[user_id] = await asyncio.to_thread(get_last_id, user_id, wc.ch)
+            wc.users = users
+
+    async def _subscribe(self, ch: str) -> WatchedChannel:
+        channel = await resolve_channel_cached(self._client, ch)
+        wc = WatchedChannel(ch=ch, entity=channel.entity, channel_id=channel.channel_id,
+                            title=channel.title, username=channel.username)
+        if self.settings.join_channels:
+            # Telegram присылает обновления только по каналам, где аккаунт состоит
+            await telegram_governor(self._client).call(
+                "resolve", lambda: self._client(functions.channels.JoinChannelRequest(channel.entity)))
+        if wc.channel_id is not None:
+            self._by_channel_id[int(wc.channel_id)] = channel_key(ch)
+        wc.worker = asyncio.create_task(self._channel_worker(wc))
+        return wc
+
+    # --- события ---
+
+    def _channel_for(self, message) -> Optional[WatchedChannel]:
+        channel_id = getattr(getattr(message, "peer_id", None), "channel_id", None)
+        key = self._by_channel_id.get(channel_id) if channel_id is not None else None
+        return self._channels.get(key) if key else None
+
+    def _enqueue(self, unit: list) -> None:
+        wc = self._channel_for(unit[0])
+        if wc is None:
+            return
+        self.events += 1
+        wc.last_event_at = time.time()
+        wc.queue.put_nowait(sorted(unit, key=lambda m: (m.date, m.id)))
+
+    async def _on_new_message(self, event) -> None:
+        self._enqueue([event.message])
+
+    async def _on_album(self, event) -> None:
+        self._enqueue(list(event.messages))
+
+    async def _on_edited(self, event) -> None:
+        wc = self._channel_for(event.message)
+        if wc is None:
+            return
+        text = (event.message.message or "").strip()
+        for user_id in list(wc.users):
+            posts = await asyncio.to_thread(find_posts_by_message, user_id, wc.ch, event.message.id)
+            for post in posts:
+                # У альбома подпись обычно у одного сообщения: пустая правка другого её не затирает
+                if not text and len(post.get("original_ids") or []) > 1:
+                    continue
+                if text != (post.get("content") or ""):
+                    await asyncio.to_thread(update_post, post["id"], {"content": text})
+                    print(f"Watch: updated post {post['id']} after edit of message {event.message.id} in {wc.ch}")
+
+    # --- обработка ---
+
+    async def _channel_worker(self, wc: WatchedChannel) -> None:
+        while True:
+            units = [await wc.queue.get()]
+            # Короткая пауза собирает всплеск постов в одну пачку конвейера
+            await asyncio.sleep(self.settings.batch_delay_seconds)
+            while not wc.queue.empty():
+                units.append(wc.queue.get_nowait())
+            try:
+                await self._ingest(wc, units)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Watch: failed to process {len(units)} post(s) from {wc.ch}: {e}")
+
+    async def _ingest(self, wc: WatchedChannel, units: list) -> None:
+        # Пачку упорядочиваем по id, дубли (событие + догонка) схлопываем
+        by_root = {min(m.id for m in u): u for u in units}
+        ordered = [by_root[k] for k in sorted(by_root)]
+        for user_id in list(wc.users):
+            saved_ids = await asyncio.to_thread(get_saved_message_ids, user_id, wc.ch, list(by_root))
+            # Уже сохранённые посты (дубль события и догонки) тоже продлевают непрерывный префикс
+            results: Dict[int, bool] = {root: True for root in by_root if root in saved_ids}
+            pending = [u for u in ordered if min(m.id for m in u) not in saved_ids]
+
+            def on_saved(job, saved: bool, results=results):
+                results[min(gm.id for gm in job.group)] = saved
+                if saved:
+                    wc.saved += 1
+
+            if pending:
+                await ingest_post_units(self._client, wc.ch, pending, user_id=user_id, is_top_post=False,
+                                        channel_title=wc.title, channel_username=wc.username,
+                                        on_saved=on_saved, scheduler=self._scheduler, track_progress=False)
+            await self._advance_watermark(wc, user_id, by_root, results)
+
+    async def _advance_watermark(self, wc: WatchedChannel, user_id: str, by_root: Dict[int, list],
+                                 results: Dict[int, bool]) -> None:
+        """
+        Двигает водяной знак и точку догонки по непрерывному префиксу сохранённых постов пачки,
+        как process_channel: упавший пост остаётся выше отметки и повторяется следующей догонкой.
+        """
+        blocked = wc.retry_from.get(user_id)
+        top = 0
+        for root in sorted(by_root):
+            if not results.get(root):
+                blocked = root if blocked is None else min(blocked, root)
+                print(f"Watch: post {root} in {wc.ch} not saved, will retry on next catch-up")
+                break
+            if blocked is not None and root == blocked:
+                # Повторная попытка удалась — отметка снова может идти вперёд
+                blocked = None
+            if blocked is not None and root > blocked:
+                break
+            top = max(m.id for m in by_root[root])
+        if blocked is None:
+            wc.retry_from.pop(user_id, None)
+        else:
+            wc.retry_from[user_id] = blocked
+        if top > wc.catchup_from.get(user_id, 0):
+            wc.catchup_from[user_id] = top
+            # advance_channel_watermark берёт максимум — водяной знак не откатывается
+            await asyncio.to_thread(set_last_id, user_id, wc.ch, top)
+
+    # --- догонка пропусков ---
+
+    async def catch_up(self, wc: WatchedChannel) -> int:
+        """Ставит в очередь посты новее точки догонки (min_id) — для каждого пользователя канала."""
+        if not wc.users:
+            return 0
+        governor = telegram_governor(self._client)
+        min_id = min(wc.catchup_from.get(u, 0) for u in wc.users)
+        if not min_id:
+            # Канал ещё ни разу не синхронизировался — историю забирает обычный запуск
+            latest = await governor.call("messages", lambda: self._client.get_messages(wc.entity, limit=1))
+            top = latest[0].id if latest else 0
+            for u in wc.users:
+                wc.catchup_from[u] = max(wc.catchup_from.get(u, 0), top)
+            return 0
+        units = [u async for u in iter_post_units(self._client, wc.entity, governor, self.settings.catchup_limit,
+                                                  min_id=min_id, reverse=True)]
+        # Точка догонки двигается только после сохранения (_advance_watermark), не при постановке в очередь
+        for unit in units:
+            wc.queue.put_nowait(unit)
+        if units:
+            print(f"Watch: recovered {len(units)} post(s) for {wc.ch} after id {min_id}")
+        return len(units)
+
+    async def catch_up_all(self) -> None:
+        for wc in list(self._channels.values()):
+            try:
+                if await self.catch_up(wc):
+                    self.gap_recoveries += 1
+            except Exception as e:
+                print(f"Watch: catch-up failed for {wc.ch}: {e}")
+
+    async def _monitor_loop(self) -> None:
+        last_catchup = time.monotonic()
+        was_connected = True
+        while True:
+            await asyncio.sleep(self.settings.connection_check_seconds)
+            connected = self._client.is_connected()
+            due = time.monotonic() - last_catchup >= self.settings.catchup_interval_seconds
+            if connected and (not was_connected or due):
+                if not was_connected:
+                    print("Watch: connection restored, recovering missed posts...")
+                try:
+                    await self.refresh()
+                    await self.catch_up_all()
+                except Exception as e:
+                    print(f"Watch: periodic catch-up failed: {e}")
+                last_catchup = time.monotonic()
+            was_connected = connected
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "started_at": self.started_at,
+            "events": self.events,
+            "gap_recoveries": self.gap_recoveries,
+            "channels": [
+                {
+                    "channel": wc.ch,
+                    "users": len(wc.users),
+                    "queued": wc.queue.qsize(),
+                    "saved": wc.saved,
+                    "last_event_at": wc.last_event_at,
+                }
+                for wc in self._channels.values()
+            ],
+        }
+
+
+channel_watcher = ChannelWatcher()
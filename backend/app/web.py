@@ -1,5 +1,5 @@
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 import asyncio
@@ -7,11 +7,18 @@ import os
 import re
 import time
 import hashlib
+from contextlib import asynccontextmanager
+from dataclasses import asdict
 from typing import Dict, Any, Optional
 from pydantic import BaseModel, Field
 
 # Импортируем вашу основную функцию и управление состоянием
-from app.main import main as run_pipeline_main
+from app.main import main as run_pipeline_main, CFG, FFMPEG, IMAGE_BRANDING, SPOOL, STORAGE_UPLOADER
+from app.client_pool import client_manager
+from app.watcher import channel_watcher
+from app.media_materializer import materialize_media_item, media_filler
+from app.media_stream import RangeNotSatisfiable, media_streamer, parse_range
+from app.metrics_refresh import refresh_post_metrics
 from app.state_manager import get_state, set_running, reset_state, set_finished
 from app.supabase_manager import (
     initialize_supabase,
@@ -32,7 +39,44 @@ from app.translation import translate_text
 # Инициализацию Supabase выполняем лениво при первом обращении через _client().
 # Это ускоряет старт и избегает падения, если переменные окружения временно не заданы.
 
-app = FastAPI()
+async def _prewarm_global_client():
+    try:
+        client = await client_manager.get_global()
+    except Exception as e:
+        # Нет credentials или сессия невалидна — клиент подключится при первом запуске
+        print(f"Telegram client pool: prewarm skipped: {e}")
+        return
+    if channel_watcher.settings.autostart:
+        try:
+            await channel_watcher.start(client)
+        except Exception as e:
+            print(f"Watch mode autostart failed: {e}")
+    if media_filler.settings.filler_autostart:
+        media_filler.start(client)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Долгоживущий клиент Telegram: подключаемся в фоне, чтобы не задерживать старт сервера
+    await client_manager.start(CFG.get("telegram_pool"))
+    # Каталоги спула и уборка осиротевших файлов — при старте сервера, а не при импорте
+    await asyncio.to_thread(SPOOL.open)
+    prewarm_task = asyncio.create_task(_prewarm_global_client())
+    try:
+        yield
+    finally:
+        prewarm_task.cancel()
+        await asyncio.gather(prewarm_task, return_exceptions=True)
+        await channel_watcher.stop()
+        await media_filler.stop()
+        await media_streamer.stop()
+        await client_manager.stop()
+        IMAGE_BRANDING.shutdown()
+        await STORAGE_UPLOADER.close()
+        SPOOL.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS для связи фронтенда (Vite/React/Next) с API
 app.add_middleware(
@@ -45,6 +89,9 @@ app.add_middleware(
 
 # Словарь задач по пользователям для поддержки многопользовательского режима
 current_tasks: Dict[str, asyncio.Task] = {}
+# Обновление метрик сохранённых постов: задача и последний итог по пользователю
+metrics_refresh_tasks: Dict[str, asyncio.Task] = {}
+metrics_refresh_results: Dict[str, Dict[str, Any]] = {}
 
 # ===============================
 # Временное хранилище сессий для 2FA
@@ -280,20 +327,24 @@ async def run_pipeline_task(
     period_hours: int | None = None, 
     channel_url: str | None = None, 
     is_top_posts: bool = False,
-    user_identifier: str | None = None
+    user_identifier: str | None = None,
+    incremental: bool = False,
+    media_mode: str | None = None,
 ):
     """Обёртка для запуска задачи и управления состоянием для конкретного пользователя."""
     global current_tasks
     user_id = _get_user_identifier(user_identifier)
     set_running(user_id, True)
     try:
-        print(f"Starting pipeline with limit: {limit}, channel: {channel_url or 'from config'}, top_posts: {is_top_posts}, user: {user_id}")
+        print(f"Starting pipeline with limit: {limit}, channel: {channel_url or 'from config'}, top_posts: {is_top_posts}, incremental: {incremental}, media: {media_mode or 'default'}, user: {user_id}")
         await run_pipeline_main(
             limit=limit, 
             period_hours=period_hours, 
             channel_url=channel_url, 
             is_top_posts=is_top_posts,
-            user_identifier=user_id
+            user_identifier=user_id,
+            incremental=incremental,
+            media_mode=media_mode,
         )
         print(f"Pipeline finished successfully for user {user_id}.")
     except asyncio.CancelledError:
@@ -319,6 +370,10 @@ async def trigger_pipeline(request: Request):
     period_hours = data.get("period_hours")
     channel_url = _normalize_channel_identifier(data.get("channel_url"))
     is_top_posts = data.get("is_top_posts", False)
+    incremental = bool(data.get("incremental", False))
+    media_mode = data.get("media_mode")
+    if media_mode not in (None, "full", "lazy"):
+        return JSONResponse(status_code=400, content={"ok": False, "error": "media_mode must be 'full' or 'lazy'"})
     use_user_credentials = data.get("use_user_credentials", False)
     user_identifier_param = data.get("user_identifier")
 
@@ -350,7 +405,9 @@ async def trigger_pipeline(request: Request):
         period_hours=period_hours,
         channel_url=channel_url,
         is_top_posts=is_top_posts,
-        user_identifier=user_identifier
+        user_identifier=user_identifier,
+        incremental=incremental,
+        media_mode=media_mode,
     ))
     current_tasks[user_identifier] = task
     
@@ -484,101 +541,33 @@ async def translate_post_endpoint(post_id: str, payload: ManualTranslationPayloa
 
 @app.post("/posts/{post_id}/media/{media_id}/load-large")
 async def load_large_media_endpoint(post_id: str, media_id: str):
-    """Загружает большой медиафайл по требованию."""
+    """Загружает отложенный или большой медиафайл по требованию."""
     try:
-        from app.supabase_manager import get_media_item, update_media_item, upload_media_files
-        from telethon import TelegramClient
-        from telethon.sessions import StringSession
-        import os
-        import pathlib
-        from app.main import download_and_brand, _get_telegram_credentials, OUT
+        from app.supabase_manager import get_media_item
         
         # Получаем информацию о медиафайле
         media_item = get_media_item(media_id)
         if not media_item:
             return JSONResponse(status_code=404, content={"ok": False, "error": "Media item not found"})
         
-        if not media_item.get('is_oversized'):
-            return JSONResponse(status_code=400, content={"ok": False, "error": "Media item is not oversized"})
-        
         if media_item.get('is_loaded'):
             return JSONResponse(status_code=200, content={"ok": True, "message": "Media already loaded", "url": media_item.get('url')})
         
-        telegram_channel = media_item.get('telegram_channel')
-        telegram_message_id = media_item.get('telegram_message_id')
-        
-        if not telegram_channel or not telegram_message_id:
+        if not media_item.get('telegram_channel') or not media_item.get('telegram_message_id'):
             return JSONResponse(status_code=400, content={"ok": False, "error": "Missing telegram info"})
         
-        # Подключаемся к Telegram
-        api_id, api_hash = _get_telegram_credentials()
-        session_string = os.getenv("TELEGRAM_STRING_SESSION")
-        session_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "session")
-        
-        client = None
-        if session_string:
-            client = TelegramClient(StringSession(session_string), api_id, api_hash)
-        else:
-            client = TelegramClient(session_path, api_id, api_hash)
+        # Клиент из долгоживущего пула: уже подключён, соединения с DC прогреты
+        client = await client_manager.get_global()
         
+        # Без ограничения размера: большие файлы без обработки — потоком в Storage (TUS, с докачкой),
+        # остальные — параллельные сегменты с докачкой, брендирование, выгрузка
+        print(f"Loading deferred media from message {media_item.get('telegram_message_id')}...")
         try:
-            await client.start()
-            
-            # Получаем сообщение из Telegram
-            entity = await client.get_entity(telegram_channel)
-            message = await client.get_messages(entity, ids=telegram_message_id)
-            
-            if not message or not message.media:
-                return JSONResponse(status_code=404, content={"ok": False, "error": "Message not found in Telegram"})
-            
-            # Загружаем медиа (без ограничения размера)
-            print(f"Loading large media from message {telegram_message_id}...")
-            raw = await client.download_media(message)
-            
-            if not raw:
-                return JSONResponse(status_code=500, content={"ok": False, "error": "Failed to download media"})
-            
-            # Обрабатываем файл (брендирование)
-            from app.main import brand_video, add_logo_image, CFG
-            processed_path = raw
-            
-            # Определяем тип медиа
-            low = raw.lower()
-            if low.endswith((".mp4", ".mov", ".mkv", ".webm", ".m4v")):
-                processed_path = brand_video(raw, CFG["logo"]["path"])
-            elif low.endswith((".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tiff")):
-                processed_path = add_logo_image(raw, CFG["logo"]["path"], CFG["logo"]["position"], CFG["logo"]["margin"])
-                try:
-                    os.remove(raw)
-                except:
-                    pass
-            
-            # Загружаем в Supabase Storage
-            uploaded = upload_media_files([processed_path], telegram_channel, telegram_message_id)
-            
-            if uploaded and len(uploaded) > 0:
-                uploaded_item = uploaded[0]
-                # Обновляем запись в БД
-                update_media_item(media_id, {
-                    "url": uploaded_item.get('url'),
-                    "storage_path": uploaded_item.get('storage_path'),
-                    "mime_type": uploaded_item.get('mime_type'),
-                    "is_loaded": True,
-                })
-                
-                # Чистим временные файлы
-                try:
-                    pathlib.Path(processed_path).unlink(missing_ok=True)
-                except:
-                    pass
-                
-                return {"ok": True, "message": "Large media loaded successfully", "url": uploaded_item.get('url')}
-            else:
-                return JSONResponse(status_code=500, content={"ok": False, "error": "Failed to upload media to storage"})
-            
-        finally:
-            if client.is_connected():
-                await client.disconnect()
+            loaded = await materialize_media_item(client, media_item, max_size=0)
+        except LookupError as e:
+            return JSONResponse(status_code=404, content={"ok": False, "error": str(e)})
+        
+        return {"ok": True, "message": "Media loaded successfully", "url": loaded.get('url')}
         
     except Exception as e:
         print(f"Load large media endpoint error: {e}")
@@ -586,6 +575,49 @@ async def load_large_media_endpoint(post_id: str, media_id: str):
         traceback.print_exc()
         return JSONResponse(status_code=500, content={"ok": False, "error": str(e)})
 
+@app.get("/posts/{post_id}/media/{media_id}/stream")
+async def stream_media_endpoint(post_id: str, media_id: str, request: Request):
+    """
+    Воспроизведение медиа прямо из Telegram с поддержкой HTTP Range — без загрузки файла целиком.
+    Уже выгруженный файл — редирект на Storage. Выгрузка в Storage запускается в фоне.
+    """
+    from app.supabase_manager import get_media_item
+
+    media_item = await asyncio.to_thread(get_media_item, media_id)
+    if not media_item:
+        return JSONResponse(status_code=404, content={"ok": False, "error": "Media item not found"})
+    if media_item.get('is_loaded') and media_item.get('url'):
+        return RedirectResponse(media_item['url'], status_code=307)
+    if not media_item.get('telegram_channel') or not media_item.get('telegram_message_id'):
+        return JSONResponse(status_code=400, content={"ok": False, "error": "Missing telegram info"})
+
+    try:
+        client = await client_manager.get_global()
+        source = await media_streamer.open(client, media_item)
+    except LookupError as e:
+        return JSONResponse(status_code=404, content={"ok": False, "error": str(e)})
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"ok": False, "error": str(e)})
+    except Exception as e:
+        # Нет credentials, сессия отозвана, Telegram недоступен
+        print(f"Stream media endpoint error: {e}")
+        return JSONResponse(status_code=500, content={"ok": False, "error": str(e)})
+
+    headers = {"Accept-Ranges": "bytes", "Cache-Control": "private, max-age=3600"}
+    try:
+        byte_range = parse_range(request.headers.get("range"), source.size)
+    except RangeNotSatisfiable:
+        return JSONResponse(status_code=416, content={"ok": False, "error": "Range not satisfiable"},
+                            headers={**headers, "Content-Range": f"bytes */{source.size}"})
+    start, end = byte_range or (0, source.size - 1)
+    headers["Content-Length"] = str(end - start + 1)
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{source.size}"
+
+    media_streamer.schedule_materialize(client, media_item)
+    return StreamingResponse(media_streamer.iter_range(source, start, end), status_code=206 if byte_range else 200,
+                             media_type=source.mime_type, headers=headers)
+
 @app.delete("/posts/{post_id}")
 async def delete_post_endpoint(post_id: str):
     """Удаляет конкретный пост по ID."""
@@ -599,6 +631,41 @@ async def delete_post_endpoint(post_id: str):
         print(f"Delete post endpoint error: {e}")
         return JSONResponse(status_code=500, content={"ok": False, "error": str(e)})
 
+class MetricsRefreshPayload(BaseModel):
+    user_identifier: Optional[str] = None
+    channel: Optional[str] = None
+    limit: Optional[int] = Field(default=None, ge=1)
+
+async def _run_metrics_refresh(user_id: str, channel: str | None, limit: int | None):
+    started_at = time.time()
+    metrics_refresh_results[user_id] = {"running": True, "started_at": started_at}
+    try:
+        client = await client_manager.get_global()
+        stats = await refresh_post_metrics(client, user_id, channel=channel, limit=limit)
+        metrics_refresh_results[user_id] = {"running": False, "started_at": started_at, **asdict(stats)}
+    except Exception as e:
+        print(f"Metrics refresh error for user {user_id}: {e}")
+        metrics_refresh_results[user_id] = {"running": False, "started_at": started_at, "error": str(e)}
+    finally:
+        metrics_refresh_tasks.pop(user_id, None)
+
+@app.post("/posts/refresh-metrics")
+async def refresh_metrics_endpoint(payload: MetricsRefreshPayload):
+    """Перечитывает метрики (и правки текста) сохранённых постов пачками по 100 сообщений."""
+    user_id = _get_user_identifier(payload.user_identifier)
+    task = metrics_refresh_tasks.get(user_id)
+    if task and not task.done():
+        return JSONResponse(status_code=409, content={"ok": False, "error": "Metrics refresh is already running."})
+    channel = _normalize_channel_identifier(payload.channel) if payload.channel else None
+    metrics_refresh_tasks[user_id] = asyncio.create_task(_run_metrics_refresh(user_id, channel, payload.limit))
+    return {"ok": True, "message": "Metrics refresh started."}
+
+@app.get("/posts/refresh-metrics/status")
+async def refresh_metrics_status_endpoint(user_identifier: str | None = None):
+    """Итог последнего обновления метрик пользователя."""
+    user_id = _get_user_identifier(user_identifier)
+    return {"ok": True, **metrics_refresh_results.get(user_id, {"running": False})}
+
 @app.delete("/posts")
 async def delete_all_posts_endpoint(user_identifier: str | None = None):
     """Удаляет все сохраненные посты конкретного пользователя."""
@@ -622,6 +689,8 @@ async def save_channel_endpoint(payload: ChannelPayload, user_identifier: str |
         user_id = _get_user_identifier(user_identifier)
         success = save_channel(user_id, payload.username)
         if success:
+            if channel_watcher.running:
+                asyncio.create_task(channel_watcher.refresh())
             return {"ok": True, "message": "Channel saved successfully."}
         else:
             return JSONResponse(status_code=400, content={"ok": False, "error": "Failed to save channel"})
@@ -658,6 +727,8 @@ async def delete_current_channel_endpoint(user_identifier: str | None = None):
         user_id = _get_user_identifier(user_identifier)
         success = delete_saved_channel(user_id)
         if success:
+            if channel_watcher.running:
+                asyncio.create_task(channel_watcher.refresh())
             return {"ok": True, "message": "Channel deleted successfully."}
         else:
             return JSONResponse(status_code=404, content={"ok": False, "error": "No saved channel found"})
@@ -665,6 +736,83 @@ async def delete_current_channel_endpoint(user_identifier: str | None = None):
         print(f"Delete current channel endpoint error: {e}")
         return JSONResponse(status_code=500, content={"ok": False, "error": str(e)})
 
+# --- Режим наблюдения за сохранёнными каналами ---
+
+@app.post("/watch/start")
+async def start_watch_endpoint():
+    """Включает наблюдение за каналами из saved_channel (новые посты — по событиям Telegram)."""
+    try:
+        if channel_watcher.running:
+            return {"ok": True, "message": "Watch mode is already running.", "status": channel_watcher.status()}
+        client = await client_manager.get_global()
+        await channel_watcher.start(client)
+        return {"ok": True, "message": "Watch mode started.", "status": channel_watcher.status()}
+    except Exception as e:
+        print(f"Start watch endpoint error: {e}")
+        return JSONResponse(status_code=500, content={"ok": False, "error": str(e)})
+
+@app.post("/watch/stop")
+async def stop_watch_endpoint():
+    """Выключает наблюдение."""
+    try:
+        await channel_watcher.stop()
+        return {"ok": True, "message": "Watch mode stopped."}
+    except Exception as e:
+        print(f"Stop watch endpoint error: {e}")
+        return JSONResponse(status_code=500, content={"ok": False, "error": str(e)})
+
+@app.get("/watch/status")
+async def watch_status_endpoint():
+    """Состояние наблюдения: каналы, очередь, сохранённые посты, восстановленные пропуски."""
+    return {"ok": True, **channel_watcher.status()}
+
+# --- Фоновая догрузка отложенных медиа (media_mode=lazy) ---
+
+@app.post("/media/filler/start")
+async def start_media_filler_endpoint():
+    """Включает фоновую догрузку заглушек is_loaded=false в пределах бюджета байтов."""
+    try:
+        if not media_filler.running:
+            media_filler.start(await client_manager.get_global())
+        return {"ok": True, "status": media_filler.status()}
+    except Exception as e:
+        print(f"Start media filler endpoint error: {e}")
+        return JSONResponse(status_code=500, content={"ok": False, "error": str(e)})
+
+@app.post("/media/filler/stop")
+async def stop_media_filler_endpoint():
+    """Выключает фоновую догрузку медиа."""
+    await media_filler.stop()
+    return {"ok": True, "status": media_filler.status()}
+
+@app.get("/media/filler/status")
+async def media_filler_status_endpoint():
+    """Состояние фоновой догрузки: загружено файлов/байт, расход бюджета окна."""
+    return {"ok": True, **media_filler.status()}
+
+@app.get("/media/ffmpeg/status")
+async def ffmpeg_status_endpoint():
+    """Очередь ffmpeg: выполняющиеся задачи с прогрессом, очередь и время последних задач."""
+    return {"ok": True, **FFMPEG.status()}
+
+
+@app.get("/media/uploads/status")
+async def uploads_status_endpoint():
+    """Выгрузка в Storage: число и объём загрузок, дубликаты, повторы и ошибки."""
+    return {"ok": True, **STORAGE_UPLOADER.status()}
+
+
+@app.get("/media/stream/status")
+async def media_stream_status_endpoint():
+    """Потоковое воспроизведение из Telegram: отданные байты, кэш блоков, фоновые выгрузки."""
+    return {"ok": True, **media_streamer.status()}
+
+
+@app.get("/media/spool/status")
+async def spool_status_endpoint():
+    """Спул временных файлов: занятость и квота, активные посты, вычищенные и вытесненные файлы."""
+    return {"ok": True, **(await asyncio.to_thread(SPOOL.status))}
+
 
 # --- Эндпоинты для работы с User Telegram Credentials ---
 
@@ -718,6 +866,7 @@ async def save_global_telegram_credentials_endpoint(payload: TelegramCredentials
         )
         
         if success:
+            client_manager.invalidate_credentials()
             return {"ok": True, "message": "Telegram credentials сохранены успешно"}
         else:
             return JSONResponse(
@@ -775,6 +924,7 @@ async def delete_global_telegram_credentials_endpoint():
         success = delete_user_telegram_credentials(user_id)
         
         if success:
+            client_manager.invalidate_credentials()
             return {"ok": True, "message": "Credentials удалены успешно"}
         else:
             return JSONResponse(
@@ -795,12 +945,9 @@ async def validate_global_telegram_credentials_endpoint():
     пытаясь подключиться к Telegram API.
     """
     try:
-        from app.supabase_manager import get_global_telegram_credentials
-        from app.crypto_utils import decrypt_string
-        from telethon import TelegramClient
-        from telethon.sessions import StringSession
-        
-        credentials = get_global_telegram_credentials()
+        # Проверку выполняем свежими данными из БД, а не кэшем пула
+        client_manager.invalidate_credentials()
+        credentials = client_manager.global_credentials()
         
         if not credentials:
             return JSONResponse(
@@ -808,38 +955,18 @@ async def validate_global_telegram_credentials_endpoint():
                 content={"ok": False, "error": "Credentials не найдены"}
             )
         
-        # Расшифровываем session
-        decrypted_session = decrypt_string(credentials["telegram_string_session"])
-        
-        # Пробуем подключиться
-        client = TelegramClient(
-            StringSession(decrypted_session),
-            credentials["telegram_api_id"],
-            credentials["telegram_api_hash"]
-        )
-        
+        # Клиент из пула: при валидной сессии он уже подключён и сразу готов к запуску
         try:
-            await client.connect()
-            if await client.is_user_authorized():
-                me = await client.get_me()
-                await client.disconnect()
-                return {
-                    "ok": True,
-                    "valid": True,
-                    "message": f"Credentials валидны. Подключен как {me.first_name}",
-                    "username": me.username,
-                    "phone": me.phone
-                }
-            else:
-                await client.disconnect()
-                return {
-                    "ok": True,
-                    "valid": False,
-                    "message": "Пользователь не авторизован в Telegram"
-                }
+            client = await client_manager.get(credentials)
+            me = client_manager.me(client) or await client.get_me()
+            return {
+                "ok": True,
+                "valid": True,
+                "message": f"Credentials валидны. Подключен как {me.first_name}",
+                "username": me.username,
+                "phone": me.phone
+            }
         except Exception as conn_error:
-            if client.is_connected():
-                await client.disconnect()
             return {
                 "ok": True,
                 "valid": False,
@@ -854,6 +981,43 @@ async def validate_global_telegram_credentials_endpoint():
             content={"ok": False, "error": str(e)}
         )
 
+class IngestPoolPayload(BaseModel):
+    user_identifier: str
+    enabled: bool = True
+
+@app.get("/telegram-accounts/pool")
+async def get_ingest_pool_endpoint():
+    """Аккаунты, участвующие в ингесте (без чувствительных данных)."""
+    try:
+        from app.supabase_manager import list_ingest_telegram_credentials
+        
+        accounts = [
+            {
+                "user_identifier": row.get("user_identifier"),
+                "telegram_api_id": row.get("telegram_api_id"),
+                "phone_number": row.get("phone_number"),
+                "in_ingest_pool": row.get("user_identifier") == "global" or bool(row.get("in_ingest_pool")),
+            }
+            for row in list_ingest_telegram_credentials()
+        ]
+        return {"ok": True, "accounts": accounts}
+    except Exception as e:
+        print(f"Get ingest pool error: {e}")
+        return JSONResponse(status_code=500, content={"ok": False, "error": str(e)})
+
+@app.put("/telegram-accounts/pool")
+async def set_ingest_pool_endpoint(payload: IngestPoolPayload):
+    """Добавляет аккаунт пользователя в пул ингеста или исключает из него."""
+    try:
+        from app.supabase_manager import set_ingest_pool_membership
+        
+        if set_ingest_pool_membership(payload.user_identifier, payload.enabled):
+            return {"ok": True, "user_identifier": payload.user_identifier, "enabled": payload.enabled}
+        return JSONResponse(status_code=404, content={"ok": False, "error": "Credentials не найдены"})
+    except Exception as e:
+        print(f"Set ingest pool error: {e}")
+        return JSONResponse(status_code=500, content={"ok": False, "error": str(e)})
+
 # ===============================
 # 2FA Authorization Endpoints
 # ===============================
@@ -1071,6 +1235,7 @@ async def verify_telegram_code(payload: VerifyCodePayload):
                 await client.disconnect()
                 
                 if success:
+                    client_manager.invalidate_credentials()
                     return {
                         "ok": True,
                         "authorized": True,
@@ -1198,6 +1363,7 @@ async def verify_telegram_password(payload: VerifyPasswordPayload):
                 await client.disconnect()
                 
                 if success:
+                    client_manager.invalidate_credentials()
                     return {
                         "ok": True,
                         "authorized": True,
@@ -2,14 +2,20 @@
 
 import { Button } from "@/components/ui/button";
 import { Card } from "@/components/ui/card";
-import { IconDownload, IconVideo, IconPhoto, IconLoader2 } from "@tabler/icons-react";
+import { useState } from "react";
+import { IconDownload, IconVideo, IconPhoto, IconLoader2, IconPlayerPlay } from "@tabler/icons-react";
 import { useLargeMediaLoad } from "@/hooks/useLargeMediaLoad";
+import { mediaStreamUrl } from "@/services/api";
 
 interface OversizedMediaPlaceholderProps {
   mediaId: string;
   postId: string;
   mediaType: "image" | "video" | "gif";
   fileSizeBytes: number;
+  isOversized?: boolean;
+  width?: number | null;
+  height?: number | null;
+  duration?: number | null;
   onLoad?: (newUrl: string) => void;
 }
 
@@ -18,6 +24,10 @@ export function OversizedMediaPlaceholder({
   postId,
   mediaType,
   fileSizeBytes,
+  isOversized = true,
+  width,
+  height,
+  duration,
   onLoad,
 }: OversizedMediaPlaceholderProps) {
   const loadMediaMutation = useLargeMediaLoad({
@@ -25,28 +35,68 @@ export function OversizedMediaPlaceholder({
     mediaId,
     onSuccess: onLoad,
   });
+  const [streaming, setStreaming] = useState(false);
 
   const formatFileSize = (bytes: number): string => {
     const mb = bytes / (1024 * 1024);
     return `${mb.toFixed(1)} МБ`;
   };
 
+  const formatDuration = (seconds: number): string => {
+    const total = Math.round(seconds);
+    const m = Math.floor(total / 60);
+    const s = total % 60;
+    return `${m}:${s.toString().padStart(2, "0")}`;
+  };
+
   const Icon = mediaType === "video" ? IconVideo : IconPhoto;
 
+  // Размеры известны из атрибутов Telegram ещё до загрузки — заглушка сразу в пропорциях файла
+  const hasSize = Boolean(width && height);
+  const details = [
+    hasSize ? `${width}×${height}` : null,
+    duration ? formatDuration(duration) : null,
+  ].filter(Boolean);
+
+  // Видео играет сразу из Telegram, а файл тем временем выгружается в хранилище на сервере
+  if (streaming) {
+    return (
+      <video
+        src={mediaStreamUrl(postId, mediaId)}
+        controls
+        autoPlay
+        className="w-full h-full object-contain bg-black"
+        style={hasSize ? { aspectRatio: `${width} / ${height}` } : undefined}
+      />
+    );
+  }
+
   return (
-    <Card className="relative w-full aspect-video bg-gray-100 dark:bg-gray-800 flex flex-col items-center justify-center gap-4 p-6">
+    <Card
+      className={`relative ${hasSize ? "h-full max-w-full mx-auto" : "w-full aspect-video"} bg-gray-100 dark:bg-gray-800 flex flex-col items-center justify-center gap-4 p-6`}
+      style={hasSize ? { aspectRatio: `${width} / ${height}` } : undefined}
+    >
       <div className="absolute top-4 right-4 bg-black/50 text-white text-xs px-2 py-1 rounded">
         {formatFileSize(fileSizeBytes)}
       </div>
+      {details.length > 0 && (
+        <div className="absolute top-4 left-4 bg-black/50 text-white text-xs px-2 py-1 rounded">
+          {details.join(" · ")}
+        </div>
+      )}
 
       <Icon className="w-16 h-16 text-gray-400" />
 
       <div className="text-center space-y-2">
         <p className="text-lg font-medium text-gray-700 dark:text-gray-300">
-          Медиафайл весит больше 200 МБ
+          {isOversized
+            ? "Медиафайл превышает лимит автоматической загрузки"
+            : "Медиафайл ещё не загружен"}
         </p>
         <p className="text-sm text-gray-500 dark:text-gray-400">
-          Файл не был загружен автоматически для экономии ресурсов
+          {isOversized
+            ? "Файл не был загружен автоматически для экономии ресурсов"
+            : "Посты сохранены без медиа — файл загрузится по запросу"}
         </p>
       </div>
 
@@ -56,24 +106,33 @@ export function OversizedMediaPlaceholder({
         </p>
       )}
 
-      <Button
-        onClick={() => loadMediaMutation.mutate()}
-        disabled={loadMediaMutation.isPending}
-        className="gap-2"
-        size="lg"
-      >
-        {loadMediaMutation.isPending ? (
-          <>
-            <IconLoader2 className="w-4 h-4 animate-spin" />
-            Загрузка...
-          </>
-        ) : (
-          <>
-            <IconDownload className="w-4 h-4" />
-            Загрузить файл
-          </>
+      <div className="flex gap-2">
+        {mediaType === "video" && (
+          <Button onClick={() => setStreaming(true)} className="gap-2" size="lg">
+            <IconPlayerPlay className="w-4 h-4" />
+            Смотреть
+          </Button>
         )}
-      </Button>
+        <Button
+          onClick={() => loadMediaMutation.mutate()}
+          disabled={loadMediaMutation.isPending}
+          className="gap-2"
+          size="lg"
+          variant={mediaType === "video" ? "outline" : "default"}
+        >
+          {loadMediaMutation.isPending ? (
+            <>
+              <IconLoader2 className="w-4 h-4 animate-spin" />
+              Загрузка...
+            </>
+          ) : (
+            <>
+              <IconDownload className="w-4 h-4" />
+              Загрузить файл
+            </>
+          )}
+        </Button>
+      </div>
 
       {loadMediaMutation.isPending && (
         <p className="text-xs text-gray-500 dark:text-gray-400">
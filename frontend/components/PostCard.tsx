@@ -144,24 +144,29 @@ export default function PostCard({ post, onTranslate, onDelete }: PostCardProps)
         </div>
         {firstMedia ? (
           <div className='relative h-64 md:h-80 3xl:h-96 rounded-md overflow-hidden border bg-muted'>
-            {firstMedia.is_oversized && !firstMedia.is_loaded ? (
+            {firstMedia.is_loaded === false && !mediaUrl ? (
               <OversizedMediaPlaceholder
                 mediaId={firstMedia.id}
                 postId={post.id}
                 mediaType={firstMedia.media_type as 'image' | 'video' | 'gif'}
                 fileSizeBytes={firstMedia.file_size_bytes || 0}
+                isOversized={Boolean(firstMedia.is_oversized)}
+                width={firstMedia.width}
+                height={firstMedia.height}
+                duration={firstMedia.duration}
                 onLoad={handleMediaLoad}
               />
             ) : isVideoMedia(firstMedia) ? (
               <video
                 src={mediaUrl || firstMedia.url}
                 controls
-                preload='metadata'
+                poster={firstMedia.thumbnail_url || undefined}
+                preload={firstMedia.thumbnail_url ? 'none' : 'metadata'}
                 className='w-full h-full object-contain bg-black'
               />
             ) : (
               <Image
-                src={mediaUrl || firstMedia.url}
+                src={mediaUrl || firstMedia.thumbnail_url || firstMedia.url}
                 alt={`Media from ${post.source_channel}`}
                 fill
                 className='object-contain'
@@ -6,6 +6,7 @@ import type {
   CheckChannelResponse,
   CurrentChannelResponse,
   SortBy,
+  MediaMode,
 } from '@/types/api';
 
 class PipelineAPI {
@@ -15,7 +16,8 @@ class PipelineAPI {
     channel_url: string | null = null,
     is_top_posts = false,
     use_user_credentials = false,
-    user_identifier: string | null = null
+    user_identifier: string | null = null,
+    media_mode: MediaMode | null = null
   ): Promise<OkResponse> {
     return apiClient.post('/run', {
       limit,
@@ -24,6 +26,7 @@ class PipelineAPI {
       is_top_posts,
       use_user_credentials,
       user_identifier,
+      ...(media_mode ? { media_mode } : {}),
     });
   }
 
@@ -70,6 +73,19 @@ export const deleteAllPosts = (user_identifier: string | null = null): Promise<O
   return apiClient.delete(`/posts${params}`);
 };
 
+export const refreshPostMetrics = (
+  user_identifier: string | null = null,
+  channel: string | null = null
+): Promise<OkResponse> => apiClient.post('/posts/refresh-metrics', { user_identifier, channel });
+
+export const getMetricsRefreshStatus = (
+  signal?: AbortSignal,
+  user_identifier: string | null = null
+): Promise<import('@/types/api').MetricsRefreshStatus> => {
+  const params = user_identifier ? `?user_identifier=${user_identifier}` : '';
+  return apiClient.get(`/posts/refresh-metrics/status${params}`, signal);
+};
+
 export const saveChannel = (username: string, user_identifier: string | null = null): Promise<OkResponse> => {
   const params = user_identifier ? `?user_identifier=${user_identifier}` : '';
   return apiClient.post(`/channels${params}`, { username });
@@ -100,6 +116,10 @@ export const loadLargeMedia = (
 ): Promise<OkResponse & { url?: string }> =>
   apiClient.post(`/posts/${postId}/media/${mediaId}/load-large`);
 
+// Воспроизведение прямо из Telegram (HTTP Range) — без ожидания загрузки файла
+export const mediaStreamUrl = (postId: string, mediaId: string): string =>
+  apiClient.url(`/posts/${postId}/media/${mediaId}/stream`);
+
 // User Telegram Credentials API
 export const saveTelegramCredentials = (
   credentials: import('@/types/api').TelegramCredentials
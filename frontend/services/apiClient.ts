@@ -34,8 +34,13 @@ export class FetchClient {
     this.timeout = timeout;
   }
 
+  // Полный адрес эндпоинта — для ссылок, которые браузер грузит сам (<video src>)
+  url(endpoint: string): string {
+    return `${this.baseURL}${endpoint}`;
+  }
+
   private async request<T>(endpoint: string, config: RequestConfig = {}): Promise<T> {
-    const url = `${this.baseURL}${endpoint}`;
+    const url = this.url(endpoint);
     const controller = new AbortController();
     const timeoutId = setTimeout(() => controller.abort(), this.timeout);
 
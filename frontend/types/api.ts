@@ -11,6 +11,23 @@ export type OkResponse = {
   error?: string;
 };
 
+export type MediaMode = 'full' | 'lazy';
+
+export type MetricsRefreshStatus = {
+  ok: boolean;
+  running: boolean;
+  started_at?: number;
+  posts?: number;
+  channels?: number;
+  api_calls?: number;
+  changed?: number;
+  content_updated?: number;
+  missing?: number;
+  failed_channels?: string[];
+  seconds?: number;
+  error?: string;
+};
+
 export type MediaItem = {
   id: string;
   media_type: 'image' | 'gif' | 'video' | 'other';
@@ -20,6 +37,9 @@ export type MediaItem = {
   width?: number | null;
   height?: number | null;
   duration?: number | null;
+  // WebP-превью изображения или постер видео (лента грузит его вместо оригинала)
+  thumbnail_url?: string | null;
+  thumbnail_path?: string | null;
   order_index?: number | null;
   file_size_bytes?: number | null;
   is_oversized?: boolean;
@@ -52,6 +72,8 @@ export type Post = {
   original_likes?: number | null;
   original_comments?: number | null;
   original_reactions?: Record<string, number> | null;
+  original_edit_date?: string | null;
+  metrics_refreshed_at?: string | null;
   is_top_post?: boolean;
   content?: string | null;
   translated_content?: string | null;
@@ -0,0 +1,48 @@
+-- Водяной знак инкрементальной синхронизации: последний сохранённый message_id
+-- для каждой пары (пользователь, канал). Заменяет pipeline_state.channels,
+-- который нельзя обновлять точечной нотацией через PostgREST.
+
+create table if not exists public.channel_sync_state (
+  user_id uuid not null references auth.users(id) on delete cascade,
+  channel text not null,
+  last_message_id bigint not null default 0,
+  updated_at timestamptz not null default timezone('utc', now()),
+  primary key (user_id, channel)
+);
+
+alter table public.channel_sync_state enable row level security;
+
+create policy "Users can view their own sync state"
+  on public.channel_sync_state for select
+  using (auth.uid() = user_id);
+
+create policy "Service role has full access to sync state"
+  on public.channel_sync_state for all
+  using (auth.jwt()->>'role' = 'service_role');
+
+-- Атомарно продвигает водяной знак только вперёд (greatest), без гонок read-modify-write
+create or replace function public.advance_channel_watermark(
+  p_user_id uuid,
+  p_channel text,
+  p_last_message_id bigint
+)
+returns bigint
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  result bigint;
+begin
+  insert into public.channel_sync_state as s (user_id, channel, last_message_id, updated_at)
+  values (p_user_id, p_channel, p_last_message_id, timezone('utc', now()))
+  on conflict (user_id, channel) do update
+    set last_message_id = greatest(s.last_message_id, excluded.last_message_id),
+        updated_at = timezone('utc', now())
+  returning last_message_id into result;
+  return result;
+end;
+$$;
+
+comment on table public.channel_sync_state is
+  'Водяной знак инкрементальной синхронизации каналов (последний сохранённый message_id)';
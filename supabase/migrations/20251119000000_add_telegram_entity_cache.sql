@@ -0,0 +1,26 @@
+-- Кэш разрешённых каналов Telegram: id, access_hash, title и username.
+-- access_hash привязан к аккаунту, поэтому ключ — (account_id, channel_key).
+-- Позволяет не вызывать ResolveUsername (сильно ограничен FloodWait) при повторных запусках.
+
+create table if not exists public.telegram_entity_cache (
+  account_id bigint not null,
+  channel_key text not null,
+  channel_id bigint not null,
+  access_hash bigint not null,
+  title text,
+  username text,
+  resolved_at timestamptz not null default timezone('utc', now()),
+  primary key (account_id, channel_key)
+);
+
+create index if not exists idx_telegram_entity_cache_channel_id
+  on public.telegram_entity_cache(account_id, channel_id);
+
+alter table public.telegram_entity_cache enable row level security;
+
+create policy "Service role has full access to entity cache"
+  on public.telegram_entity_cache for all
+  using (auth.jwt()->>'role' = 'service_role');
+
+comment on table public.telegram_entity_cache is
+  'Кэш разрешённых каналов Telegram (id, access_hash) по аккаунту; TTL задаётся в config.yaml';
@@ -0,0 +1,19 @@
+-- Пул аккаунтов для ингеста: помимо глобальных credentials в обработке каналов
+-- участвуют аккаунты с in_ingest_pool = true (лимиты Telegram считаются по аккаунту).
+-- dc_id в кэше каналов — подсказка, на каком DC лежат медиа канала.
+
+alter table public.user_telegram_credentials
+  add column if not exists in_ingest_pool boolean not null default false;
+
+create index if not exists idx_user_telegram_creds_ingest_pool
+  on public.user_telegram_credentials(in_ingest_pool)
+  where is_active = true;
+
+comment on column public.user_telegram_credentials.in_ingest_pool is
+  'Аккаунт используется для параллельного ингеста каналов наряду с глобальными credentials';
+
+alter table public.telegram_entity_cache
+  add column if not exists dc_id integer;
+
+comment on column public.telegram_entity_cache.dc_id is
+  'DC канала (по фото канала); используется для выбора аккаунта с тем же домашним DC';
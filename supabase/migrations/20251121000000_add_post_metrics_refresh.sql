@@ -0,0 +1,34 @@
+-- Обновление метрик уже сохранённых постов без повторного ингеста:
+-- дата последней правки исходного сообщения и время последнего обновления метрик,
+-- плюс пакетное применение изменений одной функцией (PostgREST не умеет bulk update).
+
+alter table if exists public.parsed_posts
+  add column if not exists original_edit_date timestamptz,
+  add column if not exists metrics_refreshed_at timestamptz;
+
+-- p_rows: [{"id": uuid, "original_views": int, ..., "content"?: text, "original_edit_date"?: timestamptz}]
+-- Отсутствующий ключ оставляет колонку как есть
+create or replace function public.apply_post_metrics(p_rows jsonb)
+returns integer
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  result integer;
+begin
+  update public.parsed_posts as p
+  set original_views = case when r ? 'original_views' then (r->>'original_views')::integer else p.original_views end,
+      original_likes = case when r ? 'original_likes' then (r->>'original_likes')::integer else p.original_likes end,
+      original_comments = case when r ? 'original_comments' then (r->>'original_comments')::integer else p.original_comments end,
+      original_reactions = case when r ? 'original_reactions' then r->'original_reactions' else p.original_reactions end,
+      content = case when r ? 'content' then r->>'content' else p.content end,
+      original_edit_date = case when r ? 'original_edit_date' then (r->>'original_edit_date')::timestamptz else p.original_edit_date end,
+      metrics_refreshed_at = timezone('utc', now()),
+      updated_at = timezone('utc', now())
+  from jsonb_array_elements(p_rows) as r
+  where p.id = (r->>'id')::uuid;
+  get diagnostics result = row_count;
+  return result;
+end;
+$$;
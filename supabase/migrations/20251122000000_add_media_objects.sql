@@ -0,0 +1,31 @@
+-- Индекс медиа по содержимому: один и тот же файл Telegram (photo.id / document.id)
+-- брендируется и выгружается в Storage один раз, а строки post_media всех постов
+-- и пользователей ссылаются на общий storage_path.
+-- branding_key — отпечаток настроек брендирования (логотип, формат, профиль):
+-- при их смене файл обрабатывается заново.
+
+create table if not exists public.media_objects (
+  id uuid primary key default uuid_generate_v4(),
+  telegram_media_key text not null,
+  branding_key text not null,
+  content_hash text not null,
+  storage_path text not null,
+  url text not null,
+  media_type text not null,
+  mime_type text,
+  file_size_bytes bigint,
+  created_at timestamptz not null default timezone('utc', now()),
+  unique (telegram_media_key, branding_key)
+);
+
+create index if not exists idx_media_objects_content_hash
+  on public.media_objects(content_hash);
+
+alter table public.media_objects enable row level security;
+
+create policy "Service role has full access to media objects"
+  on public.media_objects for all
+  using (auth.jwt()->>'role' = 'service_role');
+
+comment on table public.media_objects is
+  'Общие брендированные медиа в Storage по ключу Telegram (photo/document id) и sha256 содержимого';
@@ -0,0 +1,16 @@
+-- Превью для ленты постов: WebP-миниатюра изображения или постер (кадр) видео
+-- лежит в Storage рядом с оригиналом (<оригинал>_thumb.<ext>).
+-- Лента грузит превью, оригинал — только по клику/воспроизведению.
+
+ALTER TABLE post_media ADD COLUMN IF NOT EXISTS thumbnail_url TEXT;
+ALTER TABLE post_media ADD COLUMN IF NOT EXISTS thumbnail_path TEXT;
+
+COMMENT ON COLUMN post_media.thumbnail_url IS 'Публичный URL превью (WebP) или постера видео';
+COMMENT ON COLUMN post_media.thumbnail_path IS 'Путь превью в Storage';
+
+-- Размеры и превью хранятся и в индексе media_objects, чтобы переиспользованные файлы их не теряли
+ALTER TABLE media_objects ADD COLUMN IF NOT EXISTS width INTEGER;
+ALTER TABLE media_objects ADD COLUMN IF NOT EXISTS height INTEGER;
+ALTER TABLE media_objects ADD COLUMN IF NOT EXISTS duration NUMERIC;
+ALTER TABLE media_objects ADD COLUMN IF NOT EXISTS thumbnail_url TEXT;
+ALTER TABLE media_objects ADD COLUMN IF NOT EXISTS thumbnail_path TEXT;
@@ -0,0 +1,5 @@
+-- apply_post_metrics работает в обход RLS (security definer): вызывать её через /rpc
+-- может только бэкенд с service-role ключом, но не anon/authenticated ключ фронтенда.
+
+revoke execute on function public.apply_post_metrics(jsonb) from public, anon, authenticated;
+grant execute on function public.apply_post_metrics(jsonb) to service_role;
@@ -0,0 +1,5 @@
+-- advance_channel_watermark работает в обход RLS (security definer): вызывать её через /rpc
+-- может только бэкенд с service-role ключом — иначе любой ключ фронтенда сдвинет чужой водяной знак.
+
+revoke execute on function public.advance_channel_watermark(uuid, text, bigint) from public, anon, authenticated;
+grant execute on function public.advance_channel_watermark(uuid, text, bigint) to service_role;